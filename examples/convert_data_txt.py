@@ -0,0 +1,15 @@
+import argparse
+from pykt.preprocess.utils import txt_to_columnar
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert an existing data.txt into the columnar format read by data_preprocess.py")
+    parser.add_argument("-i", "--input", type=str, default="../data/assist2009/data.txt")
+    parser.add_argument("-o", "--output", type=str, default="", help="the output directory, data_columnar next to the input if empty")
+    args = parser.parse_args()
+    print(args)
+
+    output = args.output
+    if output == "":
+        output = args.input.replace("data.txt", "data_columnar") if args.input.endswith("data.txt") else args.input + "_columnar"
+    txt_to_columnar(args.input, output)
+    print(f"write {output}")
@@ -1,9 +1,11 @@
 import os
 import sys
+import json
 import argparse
 from pykt.preprocess.split_datasets import main as split_concept
 from pykt.preprocess.split_datasets_que import main as split_question
 from pykt.preprocess import data_proprocess, process_raw_data
+from pykt.preprocess.stages import preprocess_stages, preprocess_many, STAGE_FILE
 
 dname2paths = {
     "assist2009": "../data/assist2009/skill_builder_data_corrected_collapsed.csv",
@@ -26,7 +28,13 @@ configf = "../configs/data_config.json"
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--dataset_name", type=str, default="assist2015")
+    parser.add_argument(
+        "-d",
+        "--dataset_name",
+        type=str,
+        default="assist2015",
+        help="a dataset, or several separated by commas (e.g. assist2009,algebra2005) preprocessed in a process pool",
+    )
     parser.add_argument(
         "-f",
         "--file_path",
@@ -36,6 +44,28 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--min_seq_len", type=int, default=3)
     parser.add_argument("-l", "--maxlen", type=int, default=200)
     parser.add_argument("-k", "--kfold", type=int, default=5)
+    parser.add_argument("--data_format", type=str, default="columnar", help="columnar or txt")
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=0,
+        help="stream the raw log in chunks of this many rows and partition it by user on disk, 0 reads it in memory",
+    )
+    parser.add_argument("--num_partitions", type=int, default=64)
+    parser.add_argument(
+        "--append",
+        type=str,
+        default="",
+        help="raw file of new interactions, in its own directory laid out like the dataset's raw one, appended to the existing split with the existing id mapping",
+    )
+    parser.add_argument("--dry_run", action="store_true", help="only print the stages that would be rebuilt")
+    parser.add_argument("--force", action="store_true", help="rebuild every stage")
+    parser.add_argument(
+        "--num_workers", type=int, default=0, help="processes of the several datasets mode, 0 uses all cpus"
+    )
+    parser.add_argument(
+        "--log_dir", type=str, default="../data/preprocess_logs", help="the logs of the several datasets mode, one file per dataset"
+    )
     # parser.add_argument("--mode", type=str, default="concept",help="question or concept")
     args = parser.parse_args()
 
@@ -45,11 +75,55 @@ if __name__ == "__main__":
     if args.dataset_name == "peiyou":
         dname2paths["peiyou"] = args.file_path
         print(f"fpath: {args.file_path}")
-    dname, writef = process_raw_data(args.dataset_name, dname2paths)
+    chunksize = args.chunksize if args.chunksize > 0 else None
+    append = args.append != ""
+    dataset_names = args.dataset_name.split(",")
+    if len(dataset_names) > 1:
+        assert not append, "--append takes one dataset"
+        failed = preprocess_many(
+            dataset_names,
+            dname2paths,
+            configf,
+            args.log_dir,
+            args.num_workers if args.num_workers > 0 else None,
+            dry_run=args.dry_run,
+            force=args.force,
+            data_format=args.data_format,
+            min_seq_len=args.min_seq_len,
+            maxlen=args.maxlen,
+            kfold=args.kfold,
+            chunksize=chunksize,
+            num_partitions=args.num_partitions,
+        )
+        sys.exit(1 if len(failed) > 0 else 0)
+    if not append:
+        # only the stale stages are rebuilt, see pykt.preprocess.stages
+        graph = preprocess_stages(
+            args.dataset_name,
+            dname2paths,
+            configf,
+            args.data_format,
+            args.min_seq_len,
+            args.maxlen,
+            args.kfold,
+            chunksize,
+            args.num_partitions,
+        )
+        graph.run(dry_run=args.dry_run, force=args.force)
+        sys.exit(0)
+
+    # the new interactions are preprocessed next to their raw file, the split is the existing one
+    with open(configf) as fin:
+        dname = json.load(fin)[args.dataset_name]["dpath"]
+    dname2paths[args.dataset_name] = args.append
+    _, writef = process_raw_data(
+        args.dataset_name, dname2paths, args.data_format, chunksize, args.num_partitions
+    )
     print("-" * 50)
-    print(f"dname: {dname}, writef: {writef}")
-    # split
-    os.system("rm " + dname + "/*.pkl")
+    print(f"append {writef} to {dname}")
+    # the split no longer matches the raw log, the next run rebuilds every stage
+    if os.path.exists(os.path.join(dname, STAGE_FILE)):
+        os.remove(os.path.join(dname, STAGE_FILE))
 
     # for concept level model
     split_concept(
@@ -60,6 +134,7 @@ if __name__ == "__main__":
         args.min_seq_len,
         args.maxlen,
         args.kfold,
+        append,
     )
     print("=" * 100)
 
@@ -72,4 +147,5 @@ if __name__ == "__main__":
         args.min_seq_len,
         args.maxlen,
         args.kfold,
+        append,
     )
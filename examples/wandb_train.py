@@ -33,6 +33,10 @@ os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:2"
 
 local_rank = 0
 node_rank = 0
+
+# data loading options, they are not model hyper-parameters
+data_args = ["compact_data", "bucket_batch", "pack_seqs", "window_data", "window_offset", "stream_shards",
+             "mix_weights", "mix_temperature", "prefetch", "block_shuffle"]
  
 
 def rank0_print(*args):
@@ -180,7 +184,7 @@ def main(params, args=None):
         )
 
     params_str = "_".join(
-        [str(v) for k, v in params.items() if not k in ["other_config","pretrain_path","pretrain_epoch"]]
+        [str(v) for k, v in params.items() if not k in ["other_config","pretrain_path","pretrain_epoch"] + data_args]
     )
 
     rank0_print(f"params: {params}, params_str: {params_str}")
@@ -226,7 +230,7 @@ def main(params, args=None):
         "num_workers",
         "pretrain_epoch",
         "project_name"
-    ]:
+    ] + data_args:
         if remove_item in model_config:
             del model_config[remove_item]
 
@@ -254,7 +258,7 @@ def main(params, args=None):
                     "pretrain_path",
                     "pretrain_epoch",
                     "project_name"
-                ]:
+                ] + data_args:
                     if remove_item in model_config:
                         del model_config[remove_item]
                 trained_params = config["params"]
@@ -42,6 +42,16 @@ if __name__ == "__main__":
     parser.add_argument("--num_gpus", type=int, default=8)
     parser.add_argument("--global_bs", type=int, default=512)
     parser.add_argument("--train_ratio", type=float, default=1.0)
+    parser.add_argument("--compact_data", type=int, default=0)
+    parser.add_argument("--bucket_batch", type=int, default=0)
+    parser.add_argument("--pack_seqs", type=int, default=0)
+    parser.add_argument("--window_data", type=int, default=0)
+    parser.add_argument("--window_offset", type=int, default=0)
+    parser.add_argument("--stream_shards", type=int, default=0)
+    parser.add_argument("--mix_weights", type=str, default="")
+    parser.add_argument("--mix_temperature", type=float, default=1.0)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--block_shuffle", type=int, default=0)
     
 
     parser.add_argument("--pretrain_path", type=str, default="")
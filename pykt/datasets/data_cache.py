@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import json
+import shutil
+from contextlib import contextmanager
+import numpy as np
+import torch
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST_NAME = "manifest.json"
+CACHE_VERSION = 2
+
+
+def has_tensor_cache(cache_dir):
+    """Check whether cache_dir holds a complete columnar tensor cache.
+
+    Args:
+        cache_dir (str): the cache directory
+
+    Returns:
+        bool: True if the manifest exists and has the current version
+    """
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as fin:
+        manifest = json.load(fin)
+    return manifest.get("version") == CACHE_VERSION
+
+
+def save_tensor_cache(dori, cache_dir, meta=None):
+    """Save a dict of tensors as one .npy file per field plus a small json manifest.
+
+    The files are written to a temporary directory which is renamed to cache_dir at the end,
+    so readers never see a half written cache.
+
+    Args:
+        dori (dict): field name -> torch.Tensor or np.ndarray
+        cache_dir (str): the cache directory
+        meta (dict, optional): extra information stored in the manifest. Defaults to None.
+    """
+    with atomic_dir(cache_dir) as tmp_dir:
+        fields = dict()
+        for key, value in dori.items():
+            arr = value.numpy() if torch.is_tensor(value) else np.asarray(value)
+            fname = f"{key}.npy"
+            np.save(os.path.join(tmp_dir, fname), np.ascontiguousarray(arr))
+            fields[key] = {"file": fname, "dtype": str(arr.dtype), "shape": list(arr.shape)}
+        manifest = {"version": CACHE_VERSION, "fields": fields, "meta": meta or dict()}
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), "w") as fout:
+            json.dump(manifest, fout, indent=4)
+
+
+@contextmanager
+def atomic_dir(final_dir):
+    """Yield a temporary directory next to final_dir and rename it to final_dir when the block succeeds.
+
+    A stale final_dir (e.g. left by a crashed run) is replaced, the temporary directory is removed on errors.
+
+    Args:
+        final_dir (str): the directory to publish
+    """
+    final_dir = os.path.abspath(final_dir)
+    tmp_dir = f"{final_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        yield tmp_dir
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.rename(tmp_dir, final_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextmanager
+def cache_lock(path):
+    """Exclusive file lock on path + ".lock", shared by all processes (ranks, workers, runs) of one machine.
+
+    Without fcntl (e.g. on Windows) nothing is locked.
+
+    Args:
+        path (str): the cache being built
+    """
+    if fcntl is None:
+        yield
+        return
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+def build_once(path, is_built, build):
+    """Run build() for path in only one process.
+
+    Under torch.distributed every rank calls this: the first one to take the lock builds and publishes
+    the cache, the others block on the lock and then find it built. With the caches on a local disk this
+    is one build per node.
+
+    Args:
+        path (str): the cache path
+        is_built (function): is_built(path) is True once the cache is complete, e.g. has_tensor_cache
+        build (function): builds and publishes the cache
+    """
+    if is_built(path):
+        return
+    with cache_lock(path):
+        if is_built(path):
+            print(f"cache built by another process: {path}")
+            return
+        build()
+
+
+def load_tensor_cache(cache_dir):
+    """Memory-map every field of a columnar tensor cache.
+
+    The arrays are opened copy-on-write, so all ranks and DataLoader workers reading
+    the same cache share the page-cache pages and nothing is deserialized.
+
+    Args:
+        cache_dir (str): the cache directory
+
+    Returns:
+        (tuple): tuple containing
+
+        - **dori (dict)**: field name -> torch.Tensor backed by the mapped file
+        - **meta (dict)**: the meta information stored in the manifest
+    """
+    with open(os.path.join(cache_dir, MANIFEST_NAME)) as fin:
+        manifest = json.load(fin)
+    dori = dict()
+    for key, info in manifest["fields"].items():
+        arr = np.load(os.path.join(cache_dir, info["file"]), mmap_mode="c")
+        dori[key] = torch.from_numpy(arr)
+    return dori, manifest["meta"]
@@ -4,7 +4,10 @@ import json
 import torch
 from torch.utils.data import DataLoader
 import numpy as np
-from .que_data_loader import KTQueDataset
+from .que_data_loader import KTQueDataset, KTQueWindowDataset, init_que_loader, parse_mix_weights
+from .shard_data_loader import KTQueShardDataset, has_shards, write_shards
+from .data_cache import build_once
+from .samplers import BlockShuffleSampler, CurriculumSampler
 from pykt.config import que_type_models
 from .split_dataset import get_sub_dataset
 
@@ -93,7 +96,10 @@ def init_test_datasets(data_config, model_name, batch_size,i,dataset_name=None,
             test_question_window_dataset = KTDataset(os.path.join(data_config["dpath"], data_config["test_question_window_file"]), data_config["input_type"], {-1}, True)
 
     test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
-    test_window_loader = DataLoader(test_window_dataset, batch_size=batch_size, shuffle=False)
+    if isinstance(test_window_dataset, KTQueDataset):
+        test_window_loader = init_que_loader(test_window_dataset, batch_size)
+    else:
+        test_window_loader = DataLoader(test_window_dataset, batch_size=batch_size, shuffle=False)
     # if "test_question_file" in data_config:
     #     print(f"has test_question_file!")
     #     test_question_loader,test_question_window_loader = None,None
@@ -134,10 +140,12 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
             curtrain = CL4KTDataset(train_valid_path, sorted_df, data_config["input_type"], all_folds - {i})  
             # print(f"curtrain:{len(curtrain)}")
         else:
+            # the rows are ordered by difficulty in the sampler, see CurriculumSampler
             train_valid_path = os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"])
-            sorted_df = sort_samples(train_valid_path)
-            curvalid = KTQueDataset4CL(train_valid_path, sorted_df, data_config["input_type"], {i}, concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'])
-            curtrain = KTQueDataset4CL(train_valid_path, sorted_df, data_config["input_type"], all_folds - {i}, concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'])  
+            compact = getattr(args, "compact_data", 0) == 1
+            ragged = getattr(args, "bucket_batch", 0) == 1
+            curvalid = KTQueDataset(train_valid_path, data_config["input_type"], {i}, concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], compact=compact, ragged=ragged)
+            curtrain = KTQueDataset(train_valid_path, data_config["input_type"], all_folds - {i}, concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], compact=compact, ragged=ragged)
     elif model_name in ["dkt_forget", "bakt_time"]:
         max_rgap, max_sgap, max_pcount, max_it = 0, 0, 0, 0
         curvalid = DktForgetDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], {i})
@@ -160,16 +168,40 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
     elif model_name in que_type_models:
         if emb_type.find("pt") != -1:
             max_rgap, max_sgap, max_pcount, max_it = 0, 0, 0, 0
-            curvalid = KTQueDataset4PT(os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"]),
+            # the time gaps and the pretext labels are computed once when the cache is built
+            compact = getattr(args, "compact_data", 0) == 1
+            ragged = getattr(args, "bucket_batch", 0) == 1 or getattr(args, "pack_seqs", 0) == 1 or getattr(args, "stream_shards", 0) == 1
+            dataset_name = args.dataset_name if model_name == "unikt" else None
+            curvalid = KTQueDataset(os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"]),
                             input_type=data_config["input_type"], folds={i}, 
-                            concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'])
-            curtrain = KTQueDataset4PT(os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"]),
+                            concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], dataset_name=dataset_name, compact=compact, ragged=ragged, gaps=True)
+            curtrain = KTQueDataset(os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"]),
                             input_type=data_config["input_type"], folds=all_folds - {i}, 
-                            concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'])  
+                            concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], dataset_name=dataset_name, compact=compact, ragged=ragged, gaps=True)
             max_sgap = curtrain.max_sgap if curtrain.max_sgap > max_sgap else max_sgap
             max_sgap = curvalid.max_sgap if curvalid.max_sgap > max_sgap else max_sgap        
         else:
-            if model_name in ["gpt4kt"]:
+            compact = getattr(args, "compact_data", 0) == 1
+            ragged = getattr(args, "bucket_batch", 0) == 1 or getattr(args, "pack_seqs", 0) == 1 or getattr(args, "stream_shards", 0) == 1
+            if model_name in ["gpt4kt", "unikt"] and getattr(args, "window_data", 0) == 1:
+                # cut the windows of seq_len from the full histories at load time
+                seq_len = args.seq_len
+                train_ratio = args.train_ratio
+                dataset_name = args.dataset_name if model_name == "unikt" else None
+                if train_ratio < 1.0 and not_select_dataset is None:
+                    dpath = os.path.join(data_config["dpath"], f"train_valid_quelevel_{train_ratio}.csv")
+                else:
+                    dpath = os.path.join(data_config["dpath"], f"train_valid_quelevel.csv")
+                print(f"train_data_path:{dpath}")
+                if not os.path.exists(dpath):
+                    get_sub_dataset(data_config, train_ratio)
+                curvalid = KTQueWindowDataset(dpath,
+                                input_type=data_config["input_type"], folds={i}, seq_len=seq_len,
+                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio, dataset_name=dataset_name, compact=compact)
+                curtrain = KTQueWindowDataset(dpath,
+                                input_type=data_config["input_type"], folds=all_folds - {i}, seq_len=seq_len, random_offset=getattr(args, "window_offset", 0) == 1,
+                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio, dataset_name=dataset_name, compact=compact)
+            elif model_name in ["gpt4kt"]:
                 seq_len = args.seq_len
                 train_ratio = args.train_ratio
                 if train_ratio < 1.0 and not_select_dataset is None:
@@ -187,10 +219,10 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
 
                 curvalid = KTQueDataset(dpath,
                                 input_type=data_config["input_type"], folds={i}, 
-                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio)
+                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio, compact=compact, ragged=ragged)
                 curtrain = KTQueDataset(dpath,
                                 input_type=data_config["input_type"], folds=all_folds - {i}, 
-                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio)
+                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio, compact=compact, ragged=ragged)
             elif model_name in ["unikt"]:
                 seq_len = args.seq_len
                 train_ratio = args.train_ratio
@@ -206,10 +238,10 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
                     get_sub_dataset(data_config, train_ratio)
                 curvalid = KTQueDataset(dpath,
                                 input_type=data_config["input_type"], folds={i}, 
-                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio,dataset_name=dataset_name)
+                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio,dataset_name=dataset_name, compact=compact, ragged=ragged)
                 curtrain = KTQueDataset(dpath,
                                 input_type=data_config["input_type"], folds=all_folds - {i}, 
-                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio,dataset_name=dataset_name)
+                                concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], not_select_dataset=not_select_dataset, train_ratio=train_ratio,dataset_name=dataset_name, compact=compact, ragged=ragged)
 
             else:        
                 curvalid = KTQueDataset(os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"]),
@@ -243,7 +275,13 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
     else:
         curvalid = KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], {i})
         curtrain = KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], all_folds - {i})
-    if emb_type.find("cl") != -1:
+    if emb_type.find("cl") != -1 and isinstance(curtrain, KTQueDataset):
+        # only the easiest rows of each epoch are read, train_model sets the fraction every epoch
+        sampler = torch.utils.data.distributed.DistributedSampler(curtrain)
+        sampler = CurriculumSampler(curtrain.get_difficulty(), num_replicas=sampler.num_replicas, rank=sampler.rank, seed=sampler.seed)
+        train_loader = init_que_loader(curtrain, batch_size, sampler=sampler, bucket=curtrain.ragged)
+        valid_loader = init_que_loader(curvalid, batch_size, bucket=curvalid.ragged)
+    elif emb_type.find("cl") != -1:
         # train_loader = None
         train_loader = DataLoader(curtrain, batch_size=batch_size)
         valid_loader = DataLoader(curvalid, batch_size=batch_size)
@@ -253,9 +291,35 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
         # torch.distributed.init_process_group(backend='nccl')
         # torch.cuda.set_device(args.local_rank)
         sampler = torch.utils.data.distributed.DistributedSampler(curtrain)
-        train_loader = DataLoader(curtrain, batch_size=batch_size,sampler=sampler)
-        # train_loader = DataLoader(curtrain, batch_size=batch_size)
-        valid_loader = DataLoader(curvalid, batch_size=batch_size)
+        if isinstance(curtrain, KTQueDataset) and getattr(args, "block_shuffle", 0) > 0:
+            # the packed, mixture and shard loaders draw their own order and would ignore the sampler
+            if getattr(args, "pack_seqs", 0) == 1 or getattr(args, "stream_shards", 0) == 1 \
+                    or parse_mix_weights(getattr(args, "mix_weights", "")) is not None or getattr(args, "mix_temperature", 1.0) != 1.0:
+                raise ValueError("--block_shuffle can not be combined with --pack_seqs, --stream_shards, --mix_weights or --mix_temperature")
+            # shuffle blocks of consecutive rows, the mapped cache is then read a few blocks at a time
+            sampler = BlockShuffleSampler(len(curtrain), block_size=args.block_shuffle,
+                                          num_replicas=sampler.num_replicas, rank=sampler.rank, seed=sampler.seed)
+        if isinstance(curtrain, KTQueDataset) and getattr(args, "stream_shards", 0) == 1:
+            if isinstance(curtrain, KTQueWindowDataset):
+                raise ValueError("--stream_shards can not be used with --window_data")
+            # stream the train set from shards, every rank only maps the shard it reads
+            shard_dir = curtrain.cache_dir + curtrain.view_str + "_shards"
+            build_once(shard_dir, has_shards, lambda: write_shards(curtrain.dori, shard_dir, index=curtrain.index))
+            curtrain = KTQueShardDataset(shard_dir, batch_size)
+            train_loader = DataLoader(curtrain, batch_size=None)
+            valid_loader = init_que_loader(curvalid, batch_size, bucket=curvalid.ragged)
+        elif isinstance(curtrain, KTQueDataset):
+            pack_len = args.seq_len if getattr(args, "pack_seqs", 0) == 1 else None
+            mix_weights = parse_mix_weights(getattr(args, "mix_weights", ""))
+            mix_temperature = getattr(args, "mix_temperature", 1.0)
+            bucket = curtrain.ragged and mix_weights is None and mix_temperature == 1.0
+            train_loader = init_que_loader(curtrain, batch_size, sampler=sampler, bucket=bucket, pack_len=pack_len,
+                                           mix_weights=mix_weights, mix_temperature=mix_temperature)
+            valid_loader = init_que_loader(curvalid, batch_size, bucket=curvalid.ragged)
+        else:
+            train_loader = DataLoader(curtrain, batch_size=batch_size,sampler=sampler)
+            # train_loader = DataLoader(curtrain, batch_size=batch_size)
+            valid_loader = DataLoader(curvalid, batch_size=batch_size)
     
     # try:
     if model_name in ["dkt_forget", "bakt_time"]:
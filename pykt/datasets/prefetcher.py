@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import queue
+import threading
+import torch
+
+_END = object()
+
+
+def map_batch(batch, fn):
+    """apply fn to every tensor of a batch, a dict or a pair of dicts (dcur, dgaps)"""
+    if isinstance(batch, (tuple, list)):
+        return tuple(map_batch(part, fn) for part in batch)
+    return {key: fn(value) for key, value in batch.items()}
+
+
+class BatchPrefetcher(object):
+    """Iterate a DataLoader on a background thread and keep the next depth batches ready.
+
+    The thread collates the batches, and with CUDA it pins them and copies them to the device
+    with non-blocking copies on a side stream, so the copies overlap with the training step.
+    On CPU the batches are only prepared ahead. The other attributes (sampler, dataset,
+    batch_size, ...) are those of the wrapped loader.
+
+    The time the loop spent waiting for a batch is counted in wait_time (seconds) and
+    num_batches, both are reset at the start of every pass.
+
+    Args:
+        loader (DataLoader): the loader, its batches are dicts of tensors or pairs of them (dcur, dgaps)
+        device (torch.device): the training device
+        depth (int, optional): number of batches prepared ahead. Defaults to 2.
+        transform (function, optional): transform(batch, device) moves the batch to device, e.g. upcast_batch.
+            Defaults to None, which moves every tensor with a non-blocking copy.
+    """
+    def __init__(self, loader, device, depth=2, transform=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.transform = transform
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.wait_time = 0.0
+        self.num_batches = 0
+
+    def __getattr__(self, name):
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        if isinstance(batch, (tuple, list)):
+            return tuple(self.to_device(part) for part in batch)
+        if self.transform is not None:
+            return self.transform(batch, self.device)
+        return {key: value.to(self.device, non_blocking=True) for key, value in batch.items()}
+
+    def __produce__(self, out, stop):
+        """the background thread: prepare the batches and put them into out"""
+        try:
+            stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+            for batch in self.loader:
+                if stop.is_set():
+                    return
+                event = None
+                if self.use_cuda:
+                    batch = map_batch(batch, lambda value: value.pin_memory())
+                    with torch.cuda.stream(stream):
+                        batch = self.to_device(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self.to_device(batch)
+                out.put((batch, event))
+            out.put(_END)
+        except Exception as e:
+            out.put(e)
+
+    def __iter__(self):
+        self.wait_time, self.num_batches = 0.0, 0
+        out, stop = queue.Queue(maxsize=self.depth), threading.Event()
+        thread = threading.Thread(target=self.__produce__, args=(out, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = out.get()
+                self.wait_time += time.perf_counter() - start
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the tensors were allocated on the side stream and are used on the current one
+                    map_batch(batch, lambda value: value.record_stream(current))
+                self.num_batches += 1
+                yield batch
+        finally:
+            # unblock and finish the thread if the loop stopped early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
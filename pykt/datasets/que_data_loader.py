@@ -4,10 +4,12 @@
 import os, sys
 import pandas as pd
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
 # from torch.cuda import FloatTensor, LongTensor
 from torch import FloatTensor, LongTensor
 import numpy as np
+from .data_cache import has_tensor_cache, save_tensor_cache, load_tensor_cache, build_once
+from .samplers import BucketBatchSampler, PackedBatchSampler, MixtureBatchSampler
 
 datasets_dic = {"ednet_all": 0,"assist2009": 1, "algebra2005": 2, "bridge2algebra2006": 3, "nips_task34": 4, "peiyou": 5}
 
@@ -22,8 +24,11 @@ class KTQueDataset(Dataset):
         input_type (list[str]): the input type of the dataset, values are in ["questions", "concepts"]
         folds (set(int)): the folds used to generate dataset, -1 for test data
         qtest (bool, optional): is question evaluation or not. Defaults to False.
+        compact (bool, optional): keep the sequences in the smallest dtypes (see compact_dori), the batch is upcast by upcast_batch on the training device. Defaults to False.
+        ragged (bool, optional): store the sequences unpadded as values plus offsets (see to_ragged), each batch is padded only to its own max length. Must be read with init_que_loader. Defaults to False.
+        gaps (bool, optional): also store the time gap buckets and the pretext labels of the "pt" emb_type (see add_time_gaps), the items are then (dcur, dgaps). Defaults to False.
     """
-    def __init__(self, file_path, input_type, folds,concept_num,max_concepts, qtest=False, not_select_dataset=None, train_ratio=1.0, dataset_name=None):
+    def __init__(self, file_path, input_type, folds,concept_num,max_concepts, qtest=False, not_select_dataset=None, train_ratio=1.0, dataset_name=None, compact=False, ragged=False, gaps=False):
         super(KTQueDataset, self).__init__()
         sequence_path = file_path
         self.input_type = input_type
@@ -35,23 +40,39 @@ class KTQueDataset(Dataset):
 
         folds = sorted(list(folds))
         folds_str = "_" + "_".join([str(_) for _ in folds])
+        self.view_str = folds_str + (f"_non_{not_select_dataset}_{train_ratio}" if not_select_dataset is not None else "")
 
-        if not_select_dataset is not None:
-            processed_data = file_path + folds_str + f"_non_{not_select_dataset}_{train_ratio}_qlevel.pkl"
-        else:
-            processed_data = file_path + folds_str + "_qlevel.pkl"
-
-        if not os.path.exists(processed_data):
-            print(f"file path {file_path}")
-            print(f"Start preprocessing {file_path} fold: {folds_str}...")
+        # one cache of all the rows of the file, the folds and the selection are index views over it
+        processed_data = file_path + "_qlevel_all"
+        cache_dir = processed_data + ("_gaps" if gaps else "") + ("_ragged" if ragged else "") + ("_compact" if compact else "")
+        self.ragged = ragged
+        self.cache_dir = cache_dir
 
-            self.dori = self.__load_data__(sequence_path, folds, not_select_dataset=not_select_dataset, train_ratio=train_ratio, dataset_name=self.dataset_name)
-            save_data = self.dori
-            pd.to_pickle(save_data, processed_data)
-        else:
-            print(f"Read data from processed file: {processed_data}")
-            self.dori = pd.read_pickle(processed_data)
-        print(f"file path: {file_path}, qlen: {len(self.dori['qseqs'])}, clen: {len(self.dori['cseqs'])}, rlen: {len(self.dori['rseqs'])}")
+        def build():
+            if cache_dir != processed_data and has_tensor_cache(processed_data):
+                save_data, _ = load_tensor_cache(processed_data)
+            else:
+                print(f"file path {file_path}")
+                print(f"Start preprocessing {file_path} all folds...")
+                save_data = self.__load_data__(sequence_path, dataset_name=self.dataset_name)
+            if gaps:
+                save_data = add_time_gaps(save_data)
+            if compact:
+                save_data = compact_dori(save_data)
+            if ragged:
+                save_data = to_ragged(save_data)
+            save_tensor_cache(save_data, cache_dir, meta={"file_path": file_path, "compact": compact, "ragged": ragged, "gaps": gaps})
+        # only one process builds the cache, the other ranks wait and then map it
+        build_once(cache_dir, has_tensor_cache, build)
+        print(f"Read data from processed cache: {cache_dir}")
+        self.dori, _ = load_tensor_cache(cache_dir)
+        self.row_folds, self.row_keys = self.dori.pop("fold"), self.dori.pop("rowkey")
+        self.index = select_rows(self.row_folds, self.dori["dataset"], self.row_keys, folds, not_select_dataset, train_ratio)
+        if ragged:
+            self.lengths = (self.dori["offsets"][1:] - self.dori["offsets"][:-1])[self.index]
+        if gaps:
+            self.max_sgap = int(self.dori["sgaps"].max()) if self.dori["sgaps"].numel() > 0 else 0
+        print(f"file path: {file_path}, fold: {folds_str}, rows: {len(self.index)} of {len(self.row_folds)}")
 
     def __len__(self):
         """return the dataset length
@@ -59,12 +80,13 @@ class KTQueDataset(Dataset):
         Returns:
             int: the length of the dataset
         """
-        return len(self.dori["rseqs"])
+        return len(self.index)
 
     def __getitem__(self, index):
         """
         Args:
-            index (int): the index of the data want to get
+            index (int or list[int]): the index of the data want to get, a list of indices returns the whole batch at once,
+                a list of index lists returns a packed batch (ragged store only)
 
         Returns:
             (tuple): tuple containing:
@@ -78,7 +100,17 @@ class KTQueDataset(Dataset):
             - **mask_seqs (torch.tensor)**: masked value sequence, shape is seqlen-1
             - **select_masks (torch.tensor)**: is select to calculate the performance or not, 0 is not selected, 1 is selected, only available for 1~seqlen-1, shape is seqlen-1
             - **dcur (dict)**: used only self.qtest is True, for question level evaluation
+            - **dgaps (dict)**: only with gaps, sgaps, shft_sgaps, pretlabel and shft_pretlabel, see split_gaps
         """
+        if self.ragged:
+            if isinstance(index, (int, np.integer)):
+                return split_gaps({key: value[0] for key, value in self.__get_ragged_batch__([index]).items()})
+            if len(index) > 0 and isinstance(index[0], (list, tuple)):
+                return split_gaps(self.__get_packed_batch__(index))
+            return split_gaps(self.__get_ragged_batch__(index))
+        if not isinstance(index, (int, np.integer)):
+            return split_gaps(self.__get_batch__(index))
+        index = int(self.index[index])
         dcur = dict()
         mseqs = self.dori["masks"][index]
         for key in self.dori:
@@ -104,20 +136,140 @@ class KTQueDataset(Dataset):
         dcur["smasks"] = self.dori["smasks"][index]
         dcur["dataset_id"] = self.dori["dataset"][index]
         # print("tseqs", dcur["tseqs"])
+        return split_gaps(dcur)
+
+    def get_dataset_ids(self):
+        """return the dataset id of every item, e.g. for MixtureBatchSampler"""
+        return self.dori["dataset"][self.index]
+
+    def get_difficulty(self):
+        """return the error rate of every item, e.g. the curriculum order of CurriculumSampler"""
+        if self.ragged:
+            starts, lens, _ = self.__get_spans__(torch.arange(len(self)))
+            wrong = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum((self.dori["rseqs"] == 0).long(), dim=0)])
+            errors = wrong[starts + lens] - wrong[starts]
+        else:
+            rseqs = self.dori["rseqs"][self.index]
+            errors, lens = (rseqs == 0).sum(dim=1), (rseqs != -1).sum(dim=1)
+        return errors / lens.clamp(min=1)
+
+    def __get_batch__(self, index):
+        """Slice a whole batch with one fancy-index per field, then shift and mask it at once.
+
+        Args:
+            index (list[int] or torch.tensor): the indices of the batch
+
+        Returns:
+            dict: the same keys as __getitem__, every value has the batch dimension first
+        """
+        index = self.index[torch.as_tensor(index, dtype=torch.long)]
+        dcur = dict()
+        mseqs = self.dori["masks"][index]
+        for key in self.dori:
+            if key in ["masks", "smasks","dataset"]:
+                continue
+            if len(self.dori[key]) == 0:
+                empty = self.dori[key].new_zeros((len(index), 0))
+                dcur[key] = empty
+                dcur["shft_"+key] = empty
+                continue
+            seqs = self.dori[key][index]
+            if key=='cseqs':
+                dcur[key] = seqs[:,:-1,:]
+                dcur["shft_"+key] = seqs[:,1:,:]
+            else:
+                dcur[key] = seqs[:,:-1] * mseqs
+                dcur["shft_"+key] = seqs[:,1:] * mseqs
+        dcur["masks"] = mseqs
+        dcur["smasks"] = self.dori["smasks"][index]
+        dcur["dataset_id"] = self.dori["dataset"][index]
+        return dcur
+
+    def __get_ragged_batch__(self, index, pad_val=-1):
+        """Gather a batch from the ragged store and pad it only to the longest sequence in the batch.
+
+        The result is the same as the dense batch truncated to that length.
+
+        Args:
+            index (list[int] or torch.tensor): the indices of the batch
+
+        Returns:
+            dict: the same keys as __getitem__
+        """
+        starts, lens, dataset_id = self.__get_spans__(torch.as_tensor(index, dtype=torch.long))
+        flat_index, valid = ragged_index(starts, lens)
+        dcur = gather_ragged(self.dori, flat_index, valid, pad_val)
+        dcur["dataset_id"] = dataset_id
+        return dcur
+
+    def __get_packed_batch__(self, rows, pad_val=-1):
+        """Gather a batch where every row is several sequences of the ragged store packed back to back.
+
+        A "segments" field gives the sequence each position belongs to (-1 for padding), the model uses it
+        to restart the positions and to keep the attention inside each sequence. masks is False where the
+        next interaction starts a new sequence, and dataset_id is given per position.
+
+        Args:
+            rows (list[list[int]]): the indices packed into each row
+
+        Returns:
+            dict: the same keys as __getitem__ plus "segments"
+        """
+        index = torch.as_tensor([idx for row in rows for idx in row], dtype=torch.long)
+        row_of_seg = torch.repeat_interleave(torch.arange(len(rows)), torch.as_tensor([len(row) for row in rows]))
+        starts, lens, seg_dataset = self.__get_spans__(index)
+        # one entry per interaction: its segment, its row and its column in the packed batch
+        seg_of_pos = torch.repeat_interleave(torch.arange(len(index)), lens)
+        flat_pos = torch.arange(len(seg_of_pos))
+        seg_first = torch.cumsum(lens, dim=0) - lens
+        row_lens = torch.zeros(len(rows), dtype=torch.long).index_add_(0, row_of_seg, lens)
+        row_first = torch.cumsum(row_lens, dim=0) - row_lens
+        row = row_of_seg[seg_of_pos]
+        col = flat_pos - row_first[row]
+
+        shape = (len(rows), int(row_lens.max()))
+        flat_index = torch.zeros(shape, dtype=torch.long)
+        flat_index[row, col] = starts[seg_of_pos] + flat_pos - seg_first[seg_of_pos]
+        valid = torch.zeros(shape, dtype=torch.bool)
+        valid[row, col] = True
+        segments = torch.full(shape, -1, dtype=torch.long)
+        segments[row, col] = seg_of_pos
+        dataset_id = self.dori["dataset"].new_zeros(shape)
+        dataset_id[row, col] = seg_dataset[seg_of_pos]
+
+        dcur = gather_ragged(self.dori, flat_index, valid, pad_val)
+        dcur["masks"] = dcur["masks"] * (segments[:,:-1] == segments[:,1:])
+        dcur["dataset_id"] = dataset_id
+        dcur["segments"] = segments
         return dcur
 
+    def __get_spans__(self, index):
+        """Locate the sequences of index in the ragged store.
+
+        Args:
+            index (torch.tensor): the indices of the sequences
+
+        Returns:
+            (tuple): the start in the ragged store, the length and the dataset id of every sequence
+        """
+        index = self.index[index]
+        starts = self.dori["offsets"][index]
+        lens = self.dori["offsets"][index+1] - starts
+        return starts, lens, self.dori["dataset"][index]
+
     def get_skill_multi_hot(self, this_skills):
         skill_emb = [0] * self.concept_num
         for s in this_skills:
             skill_emb[s] = 1
         return skill_emb
 
-    def __load_data__(self, sequence_path, folds, pad_val=-1, not_select_dataset=None, train_ratio=1.0, dataset_name=None):
-        """
+    def __load_data__(self, sequence_path, pad_val=-1, dataset_name=None, vectorized=True):
+        """Parse all the rows of the file, with the fold and a stable random key (see select_rows) of every row.
+
         Args:
             sequence_path (str): file path of the sequences
-            folds (list[int]): 
             pad_val (int, optional): pad value. Defaults to -1.
+            vectorized (bool, optional): parse every column in one numpy pass instead of row by row, both give identical tensors. Defaults to True.
 
         Returns: 
             (tuple): tuple containing
@@ -131,20 +283,44 @@ class KTQueDataset(Dataset):
         """
         dori = {"qseqs": [], "cseqs": [], "rseqs": [], "tseqs": [], "utseqs": [], "smasks": [],"dataset":[]}
 
+        df = self.__read_rows__(sequence_path, dataset_name)
+        if vectorized:
+            dori = self.__parse_columns__(df, dori)
+        else:
+            dori = self.__parse_rows__(df, dori)
+        interaction_num = int((np.asarray(dori["smasks"]) == 1).sum())
+
+        for key in dori:
+            if key not in ["rseqs"]:#in ["smasks", "tseqs"]:
+                dori[key] = torch.as_tensor(dori[key], dtype=torch.long)
+            else:
+                dori[key] = torch.as_tensor(dori[key], dtype=torch.float)
+
+        mask_seqs = (dori["rseqs"][:,:-1] != pad_val) * (dori["rseqs"][:,1:] != pad_val)
+        dori["masks"] = mask_seqs
+
+        dori["smasks"] = (dori["smasks"][:, 1:] != pad_val)
+        dori["fold"] = torch.as_tensor(np.array(df["fold"], dtype=np.int64))
+        dori["rowkey"] = row_keys(df)
+        print(f"interaction_num: {interaction_num}")
+        # print("load data tseqs: ", dori["tseqs"])
+        return dori
+
+    def __read_rows__(self, sequence_path, dataset_name=None):
+        """read all the rows of the csv and set the dataset id of every row, 0 if the csv has no dataset column and dataset_name is None"""
         df = pd.read_csv(sequence_path)
-        df = df[df["fold"].isin(folds)].copy()#[0:1000]
-        df['dataset'] = datasets_dic[dataset_name]
-        if not_select_dataset is not None:
-            not_select_dataset = [int(dataset_id) for dataset_id in not_select_dataset.split(",")]
-            print(f"before_not_select_dataset:{df.shape}")
-            new_df = df[~(df.dataset.isin(not_select_dataset))]
-            print(f"before_not_select_dataset1:{new_df.shape}")
-            if train_ratio < 1.0:
-                sub_df = df[df.dataset.isin(not_select_dataset)].sample(frac=train_ratio, random_state=1024)
-                new_df = pd.concat([new_df,sub_df],ignore_index=True)
-            df = new_df
-            print(f"after_not_select_dataset2:{df.shape}")
-        interaction_num = 0
+        if dataset_name is None and "dataset" in df.columns:
+            # merged files (e.g. the pretrain file) keep the dataset of every row, names are mapped by datasets_dic
+            df['dataset'] = df['dataset'].map(lambda d: datasets_dic[d] if d in datasets_dic else int(d))
+        elif dataset_name is None:
+            # a single dataset file written by the split, e.g. for gpt4kt which does not use the dataset id
+            df['dataset'] = 0
+        else:
+            df['dataset'] = datasets_dic[dataset_name]
+        return df
+
+    def __parse_rows__(self, df, dori):
+        """parse the sequence columns row by row with python split and int"""
         for i, row in df.iterrows():
             #use kc_id or question_id as input
             if "concepts" in self.input_type:
@@ -172,20 +348,559 @@ class KTQueDataset(Dataset):
             dori["rseqs"].append([int(_) for _ in row["responses"].split(",")])
             dori["smasks"].append([int(_) for _ in row["selectmasks"].split(",")])
             dori["dataset"].append(int(row["dataset"]))
+        return dori
 
-            interaction_num += dori["smasks"][-1].count(1)
+    def __parse_columns__(self, df, dori):
+        """parse the sequence columns in bulk, see parse_int_seqs and parse_concept_seqs"""
+        if "concepts" in self.input_type:
+            dori["cseqs"] = parse_concept_seqs(df["concepts"], self.max_concepts)
+        if "questions" in self.input_type:
+            dori["qseqs"] = parse_int_seqs(df["questions"])
+        if "timestamps" in df.columns:
+            dori["tseqs"] = parse_int_seqs(df["timestamps"])
+        if "usetimes" in df.columns:
+            dori["utseqs"] = parse_int_seqs(df["usetimes"])
+        dori["rseqs"] = parse_int_seqs(df["responses"])
+        dori["smasks"] = parse_int_seqs(df["selectmasks"])
+        dori["dataset"] = np.array(df["dataset"], dtype=np.int64)
+        return dori
 
 
-        for key in dori:
-            if key not in ["rseqs"]:#in ["smasks", "tseqs"]:
-                dori[key] = LongTensor(dori[key])
-            else:
-                dori[key] = FloatTensor(dori[key])
+class KTQueWindowDataset(KTQueDataset):
+    """Dataset which stores every student's full history once and cuts the windows of seq_len at load time.
 
-        mask_seqs = (dori["rseqs"][:,:-1] != pad_val) * (dori["rseqs"][:,1:] != pad_val)
-        dori["masks"] = mask_seqs
+    The full histories (e.g. train_valid_quelevel.csv) are kept in the ragged store, so runs with
+    different seq_len share one cache and need no train_valid_sequences_quelevel_{seq_len}.csv.
+    With offset 0 the windows are the same as generate_sequences: windows of seq_len from the
+    start of the history and the rest if it has at least min_seq_len interactions. With random_offset
+    the window boundaries are shifted by a random offset per student and epoch (see set_epoch),
+    the number of windows of every student stays the same.
 
-        dori["smasks"] = (dori["smasks"][:, 1:] != pad_val)
-        print(f"interaction_num: {interaction_num}")
-        # print("load data tseqs: ", dori["tseqs"])
+    Args:
+        file_path (str): the full history file, one row per student
+        input_type (list[str]): the input type of the dataset, values are in ["questions", "concepts"]
+        folds (set(int)): the folds used to generate dataset
+        seq_len (int): max number of interactions of one window
+        min_seq_len (int, optional): shorter rests are dropped. Defaults to 3.
+        random_offset (bool, optional): shift the windows randomly every epoch. Defaults to False.
+        seed (int, optional): random seed of the offsets, combined with the epoch. Defaults to 0.
+        compact (bool, optional): keep the sequences in the smallest dtypes, see KTQueDataset. Defaults to False.
+    """
+    def __init__(self, file_path, input_type, folds, concept_num, max_concepts, seq_len, min_seq_len=3, random_offset=False, seed=0, not_select_dataset=None, train_ratio=1.0, dataset_name=None, compact=False):
+        self.input_type = input_type
+        self.concept_num = concept_num
+        self.dataset_name = dataset_name
+        self.max_concepts = max_concepts
+        self.seq_len = seq_len
+        self.min_seq_len = min_seq_len
+        self.random_offset = random_offset
+        self.seed = seed
+        self.ragged = True
+        if "questions" not in input_type or "concepts" not in input_type:
+            raise("The input types must contain both questions and concepts")
+
+        folds = sorted(list(folds))
+        folds_str = "_" + "_".join([str(_) for _ in folds])
+        self.view_str = folds_str + (f"_non_{not_select_dataset}_{train_ratio}" if not_select_dataset is not None else "")
+        cache_dir = file_path + "_qlevel_full" + ("_compact" if compact else "")
+        self.cache_dir = cache_dir
+
+        def build():
+            print(f"Start preprocessing {file_path} all folds...")
+            save_data = self.__load_full_data__(file_path, dataset_name=dataset_name)
+            if compact:
+                save_data = compact_dori(save_data)
+            save_tensor_cache(save_data, cache_dir, meta={"file_path": file_path, "compact": compact, "ragged": True, "full": True})
+        build_once(cache_dir, has_tensor_cache, build)
+        print(f"Read data from processed cache: {cache_dir}")
+        self.dori, _ = load_tensor_cache(cache_dir)
+        self.row_folds, self.row_keys = self.dori.pop("fold"), self.dori.pop("rowkey")
+        self.index = select_rows(self.row_folds, self.dori["dataset"], self.row_keys, folds, not_select_dataset, train_ratio)
+        self.history_lens = (self.dori["offsets"][1:] - self.dori["offsets"][:-1])[self.index].numpy()
+        self.set_epoch(0)
+        print(f"file path: {file_path}, fold: {folds_str}, students: {len(self.history_lens)}, windows of {seq_len}: {len(self.lengths)}")
+
+    def __len__(self):
+        """return the number of windows"""
+        return len(self.lengths)
+
+    def set_epoch(self, epoch):
+        """Cut the windows for this epoch.
+
+        A student with n interactions has n // seq_len full windows plus the rest r if r >= min_seq_len.
+        The random offset moves the free room of the windows (seq_len - r) from the last window to the
+        first one, or drops a random part of a short rest at the start instead of at the end.
+        self.lengths is updated in place, so the samplers which hold it see the new lengths.
+
+        Args:
+            epoch (int): the epoch, seeds the offsets
+        """
+        n, L = self.history_lens, self.seq_len
+        r = n % L
+        keep_rest = r >= self.min_seq_len
+        k = n // L + keep_rest
+        # a: the last window is the rest (or there is no rest), b: the short rest is dropped
+        a = keep_rest | (r == 0)
+        max_offset = np.where(a, np.where((k > 1) & (r > 0), np.minimum(L - r, L - self.min_seq_len), 0), r)
+        if self.random_offset:
+            rng = np.random.default_rng(self.seed + epoch)
+            offset = rng.integers(0, max_offset + 1)
+        else:
+            offset = np.zeros_like(n)
+        rows = np.repeat(np.arange(len(n)), k)
+        j = np.arange(len(rows)) - np.repeat(np.cumsum(k) - k, k)
+        o, nw, aw = offset[rows], n[rows], a[rows]
+        starts = np.where(aw, np.maximum(0, j * L - o), j * L + o)
+        ends = np.where(aw, np.minimum(nw, (j + 1) * L - o), j * L + o + L)
+        self.window_rows = self.index[torch.from_numpy(rows)]
+        self.window_starts = torch.from_numpy(starts)
+        if hasattr(self, "lengths"):
+            self.lengths[:] = torch.from_numpy(ends - starts)
+        else:
+            self.lengths = torch.from_numpy(ends - starts)
+
+    def get_dataset_ids(self):
+        """return the dataset id of every window"""
+        return self.dori["dataset"][self.window_rows]
+
+    def __get_spans__(self, index):
+        """Locate the windows of index in the ragged store of the full histories."""
+        rows = self.window_rows[index]
+        starts = self.dori["offsets"][rows] + self.window_starts[index]
+        return starts, self.lengths[index], self.dori["dataset"][rows]
+
+    def __load_full_data__(self, sequence_path, dataset_name=None):
+        """Parse all the full histories of the file into the ragged store, the same layout as to_ragged.
+
+        Args:
+            sequence_path (str): file path of the full histories
+
+        Returns:
+            dict: the ragged sequences with the "offsets" field
+        """
+        df = self.__read_rows__(sequence_path, dataset_name)
+        dori = {"qseqs": [], "cseqs": [], "rseqs": [], "tseqs": [], "utseqs": []}
+        dori["cseqs"] = parse_concept_seqs(df["concepts"], self.max_concepts, ragged=True)
+        dori["qseqs"], lens = parse_int_seqs(df["questions"], ragged=True)
+        if "timestamps" in df.columns:
+            dori["tseqs"], _ = parse_int_seqs(df["timestamps"], ragged=True)
+        if "usetimes" in df.columns:
+            dori["utseqs"], _ = parse_int_seqs(df["usetimes"], ragged=True)
+        dori["rseqs"], _ = parse_int_seqs(df["responses"], ragged=True)
+        if "selectmasks" in df.columns:
+            smasks, _ = parse_int_seqs(df["selectmasks"], ragged=True)
+            smasks = smasks != -1
+        else:
+            smasks = np.ones(lens.sum(), dtype=bool)
+        offsets = np.concatenate([[0], np.cumsum(lens)])
+        # the first interaction of a history is never predicted
+        smasks[offsets[:-1]] = False
+        for key in dori:
+            dori[key] = torch.as_tensor(dori[key], dtype=torch.float if key == "rseqs" else torch.long)
+        dori["smasks"] = torch.from_numpy(smasks)
+        dori["dataset"] = torch.as_tensor(np.array(df["dataset"], dtype=np.int64))
+        dori["offsets"] = torch.from_numpy(offsets.astype(np.int64))
+        dori["fold"] = torch.as_tensor(np.array(df["fold"], dtype=np.int64))
+        dori["rowkey"] = row_keys(df)
+        print(f"interaction_num: {int(lens.sum())}")
         return dori
+
+
+# the smallest dtypes tried in order for each field of the compact store
+COMPACT_DTYPES = {
+    "qseqs": [torch.int32],
+    "cseqs": [torch.int16, torch.int32],
+    "rseqs": [torch.int8],
+    "tseqs": [torch.int64],
+    "utseqs": [torch.int32, torch.int64],
+    "dataset": [torch.int8, torch.int16],
+    "fold": [torch.int8, torch.int16],
+}
+
+# the fields added by add_time_gaps, returned apart from dcur as dgaps
+GAP_KEYS = ["sgaps", "pretlabel"]
+
+# fields with one value per row instead of one per interaction
+ROW_KEYS = ["dataset", "fold", "rowkey"]
+
+
+def compact_dori(dori):
+    """Cast every field of dori to the smallest dtype in COMPACT_DTYPES which holds all its values.
+
+    masks and smasks stay bool, a field which does not fit in any candidate keeps its dtype.
+
+    Args:
+        dori (dict): the sequences loaded by KTQueDataset.__load_data__
+
+    Returns:
+        dict: the compact sequences
+    """
+    dnew = dict()
+    for key, value in dori.items():
+        dnew[key] = value
+        if key not in COMPACT_DTYPES or value.numel() == 0:
+            continue
+        vmin, vmax = value.min().item(), value.max().item()
+        for dtype in COMPACT_DTYPES[key]:
+            info = torch.iinfo(dtype)
+            if info.min <= vmin and vmax <= info.max:
+                dnew[key] = value.to(dtype)
+                break
+    return dnew
+
+
+def upcast_batch(dcur, device):
+    """Move a batch to device and restore the training dtypes there.
+
+    The compact batch is copied to the device first, so the host only handles the small dtypes.
+    rseqs become float, masks and smasks bool, the pretext labels float in [0, 1] and all the other sequences long.
+    An upcast batch is returned unchanged, e.g. the batches of BatchPrefetcher(transform=upcast_batch).
+
+    Args:
+        dcur (dict): a batch from KTQueDataset, or its dgaps
+        device (torch.device): the training device
+
+    Returns:
+        dict: the batch on device
+    """
+    dnew = dict()
+    for key, value in dcur.items():
+        value = value.to(device, non_blocking=True)
+        if key in ["masks", "smasks"]:
+            value = value.bool()
+        elif key in ["rseqs", "shft_rseqs"]:
+            value = value.float()
+        elif key in ["pretlabel", "shft_pretlabel"]:
+            # stored as percents, only the integer labels are scaled
+            if not value.is_floating_point():
+                value = value.float() / 100
+        else:
+            value = value.long()
+        dnew[key] = value
+    return dnew
+
+
+def add_time_gaps(dori, pad_val=-1):
+    """Compute the time features of the "pt" emb_type for all the rows at once, the same values as MIKT_calC.
+
+    sgaps is the gap to the previous interaction in minutes, bucketed as round(log2(minutes + 1)) + 1,
+    0 for the first interaction and the padding. pretlabel is the pretext label
+    1 - (t_i - t_{i-1} + 0.01s) / (t_i - t_{i-2} + 0.01s) in hundredths, 50 for the second interaction
+    and 0 for the first one and the padding. Both are stored as int16 per interaction.
+
+    Args:
+        dori (dict): the padded sequences loaded by KTQueDataset.__load_data__, with the timestamps in tseqs (ms)
+        pad_val (int, optional): pad value. Defaults to -1.
+
+    Returns:
+        dict: dori with the extra "sgaps" and "pretlabel" fields
+    """
+    t = np.asarray(dori["tseqs"], dtype=np.int64)
+    if t.ndim != 2 or t.shape[1] != dori["rseqs"].shape[1]:
+        raise ValueError("the time gaps need the timestamps of every interaction")
+    valid = t != pad_val
+    sgaps = np.zeros(t.shape, dtype=np.int16)
+    minutes = np.maximum(t[:,1:] - t[:,:-1], 0) / 1000 / 60
+    buckets = np.round(np.log(minutes + 1) / np.log(2)) + 1
+    sgaps[:,1:] = np.where(valid[:,:-1] & valid[:,1:], buckets, 0)
+
+    pretlabel = np.zeros(t.shape, dtype=np.int16)
+    if t.shape[1] > 1:
+        pretlabel[:,1] = np.where(valid[:,1], 50, 0)
+    last_it = (t[:,2:] - t[:,1:-1]) / 1000
+    post_it = (t[:,2:] - t[:,:-2]) / 1000
+    label = np.round(np.round(1 - (last_it + 0.01) / (post_it + 0.01), 2) * 100)
+    # the labels are probabilities, out of order timestamps are clipped
+    label = np.clip(label, 0, 100)
+    pretlabel[:,2:] = np.where(valid[:,:-2] & valid[:,1:-1] & valid[:,2:], label, 0)
+
+    dnew = dict(dori)
+    dnew["sgaps"] = torch.from_numpy(sgaps)
+    dnew["pretlabel"] = torch.from_numpy(pretlabel)
+    return dnew
+
+
+def split_gaps(dcur):
+    """Move the time features of a batch (see add_time_gaps) from dcur into dgaps.
+
+    Args:
+        dcur (dict): a batch from KTQueDataset
+
+    Returns:
+        dict or tuple: dcur if it has no time features, else (dcur, dgaps)
+    """
+    if "sgaps" not in dcur:
+        return dcur
+    dgaps = dict()
+    for key in GAP_KEYS:
+        dgaps[key] = dcur.pop(key)
+        dgaps["shft_"+key] = dcur.pop("shft_"+key)
+    return dcur, dgaps
+
+
+def to_ragged(dori, pad_val=-1):
+    """Convert the padded sequences into an unpadded values plus offsets store.
+
+    Every per-interaction field keeps only the valid (non padded) interactions of each row,
+    concatenated along the first dimension, and offsets[i]:offsets[i+1] is the slice of row i.
+    smasks is stored per interaction with False at the first position of each row.
+
+    Args:
+        dori (dict): the padded sequences loaded by KTQueDataset.__load_data__
+        pad_val (int, optional): pad value. Defaults to -1.
+
+    Returns:
+        dict: the ragged sequences with an extra "offsets" field
+    """
+    valid = dori["rseqs"] != pad_val
+    lens = valid.sum(dim=1)
+    if not torch.equal(valid, torch.arange(valid.size(1))[None,:] < lens[:,None]):
+        raise ValueError("the padding of some sequences is not at the end")
+    dnew = dict()
+    for key, value in dori.items():
+        if key in ["masks"] + ROW_KEYS:
+            continue
+        if key == "smasks":
+            value = torch.cat([torch.zeros_like(value[:,0:1]), value], dim=1)
+        if len(value) == 0:
+            dnew[key] = value
+        else:
+            dnew[key] = value[valid]
+    for key in ROW_KEYS:
+        if key in dori:
+            dnew[key] = dori[key]
+    dnew["offsets"] = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(lens, dim=0)])
+    return dnew
+
+
+def row_keys(df, seed=1024):
+    """A random key in [0, 1) for every row of a file.
+
+    The key hashes the dataset id, the uid and the number of the row among the rows of its student
+    (the window of the student) with the seed, so the key of a row stays the same when the file is
+    rebuilt or reordered, e.g. when appended rows are merged in by student (see split_datasets.merge_sequences).
+    Without a uid column the row number is used.
+
+    Args:
+        df (pd.DataFrame): the rows, with the dataset id of every row (see __read_rows__)
+        seed (int, optional): random seed. Defaults to 1024.
+
+    Returns:
+        torch.tensor: float32 keys
+    """
+    if "uid" not in df.columns:
+        ids = pd.DataFrame({"row": np.arange(len(df))})
+    else:
+        uids = df["uid"].astype(str)
+        ids = pd.DataFrame({"dataset": df["dataset"].to_numpy(), "uid": uids.to_numpy(),
+                            "window": uids.groupby([df["dataset"].to_numpy(), uids.to_numpy()]).cumcount().to_numpy()})
+    ids["seed"] = seed
+    hashes = pd.util.hash_pandas_object(ids, index=False).to_numpy()
+    # the top 24 bits are exact in float32
+    return torch.from_numpy(((hashes >> np.uint64(40)).astype(np.float32) / np.float32(2 ** 24)))
+
+
+def select_rows(row_folds, row_datasets, row_keys, folds, not_select_dataset=None, train_ratio=1.0):
+    """Select the rows of a dataset view over the cache of all rows.
+
+    The rows of folds are kept. If not_select_dataset is given ("1,3"), the rows of those dataset ids are
+    dropped, except the train_ratio part of them with the smallest keys, so the same rows are kept in
+    every run and a larger train_ratio keeps a superset of a smaller one.
+
+    Args:
+        row_folds (torch.tensor): the fold of every row
+        row_datasets (torch.tensor): the dataset id of every row
+        row_keys (torch.tensor): the random key of every row, see row_keys
+        folds (list[int]): the folds to keep
+        not_select_dataset (str, optional): comma separated dataset ids. Defaults to None.
+        train_ratio (float, optional): the ratio of the rows of not_select_dataset to keep. Defaults to 1.0.
+
+    Returns:
+        torch.tensor: the selected row indices, in file order
+    """
+    row_folds, row_datasets = np.asarray(row_folds), np.asarray(row_datasets)
+    keep = np.isin(row_folds, folds)
+    if not_select_dataset is not None:
+        not_select_dataset = [int(dataset_id) for dataset_id in not_select_dataset.split(",")]
+        other = keep & np.isin(row_datasets, not_select_dataset)
+        keep = keep & ~other
+        print(f"not_select_dataset: {not_select_dataset}, rows: {int(other.sum())}, other rows: {int(keep.sum())}")
+        if train_ratio < 1.0:
+            candidates = np.flatnonzero(other)
+            num = int(round(train_ratio * len(candidates)))
+            keep[candidates[np.argsort(np.asarray(row_keys)[candidates], kind="stable")[:num]]] = True
+    return torch.from_numpy(np.flatnonzero(keep))
+
+
+def ragged_index(starts, lens):
+    """Positions in the ragged store of a batch of sequences, padded to the longest one.
+
+    Args:
+        starts (torch.tensor): the start of every sequence in the ragged store
+        lens (torch.tensor): the length of every sequence
+
+    Returns:
+        (tuple): flat_index [batch_size, max_len] and valid, False for padding
+    """
+    pos = torch.arange(int(lens.max()))
+    valid = pos[None,:] < lens[:,None]
+    flat_index = torch.where(valid, starts[:,None] + pos[None,:], 0)
+    return flat_index, valid
+
+
+def gather_ragged(dori, flat_index, valid, pad_val=-1):
+    """Gather the per interaction fields of a ragged store at flat_index and shift them.
+
+    Args:
+        dori (dict): the ragged store, see to_ragged
+        flat_index (torch.tensor): [batch_size, seqlen], the position in the ragged store
+        valid (torch.tensor): [batch_size, seqlen], False for padding
+        pad_val (int, optional): pad value. Defaults to -1.
+
+    Returns:
+        dict: the same keys as KTQueDataset.__getitem__ except dataset_id
+    """
+    mseqs = valid[:,:-1] * valid[:,1:]
+    dcur = dict()
+    for key in dori:
+        if key in ["masks", "smasks","dataset","offsets"]:
+            continue
+        if len(dori[key]) == 0:
+            empty = dori[key].new_zeros((len(flat_index), 0))
+            dcur[key] = empty
+            dcur["shft_"+key] = empty
+            continue
+        seqs = dori[key][flat_index]
+        seqs[~valid] = pad_val
+        if key=='cseqs':
+            dcur[key] = seqs[:,:-1,:]
+            dcur["shft_"+key] = seqs[:,1:,:]
+        else:
+            dcur[key] = seqs[:,:-1] * mseqs
+            dcur["shft_"+key] = seqs[:,1:] * mseqs
+    dcur["masks"] = mseqs
+    dcur["smasks"] = (dori["smasks"][flat_index] * valid)[:,1:]
+    return dcur
+
+
+def init_que_loader(dataset, batch_size, sampler=None, bucket=False, pack_len=None, mix_weights=None, mix_temperature=1.0):
+    """Build a DataLoader which hands a whole batch of indices to dataset[...] at once.
+
+    The batch sampler yields index lists and automatic batching is disabled, so the
+    dataset slices each field once per batch and no per-sample dict is collated.
+
+    Args:
+        dataset (KTQueDataset): the dataset
+        batch_size (int): batch size
+        sampler (Sampler, optional): e.g. a DistributedSampler, sequential order if None. Defaults to None.
+        bucket (bool, optional): batch sequences of similar length together with BucketBatchSampler, needs a ragged dataset. Defaults to False.
+        pack_len (int, optional): pack several sequences into rows of pack_len interactions with PackedBatchSampler, needs a ragged dataset. The ranks and the seed are taken from sampler if it is a DistributedSampler. Defaults to None.
+        mix_weights (dict, optional): dataset id -> weight, draw the batches from the datasets with MixtureBatchSampler. Defaults to None.
+        mix_temperature (float, optional): temperature of MixtureBatchSampler, a value other than 1.0 also turns it on. Defaults to 1.0.
+
+    Returns:
+        DataLoader: the batched loader
+    """
+    if mix_weights is not None or mix_temperature != 1.0:
+        if pack_len is not None or bucket:
+            raise ValueError("the mixture sampler can not be combined with packing or bucketing")
+        batch_sampler = MixtureBatchSampler(dataset.get_dataset_ids(), batch_size, weights=mix_weights, temperature=mix_temperature,
+                                            num_replicas=getattr(sampler, "num_replicas", 1), rank=getattr(sampler, "rank", 0), seed=getattr(sampler, "seed", 0))
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+    if pack_len is not None:
+        batch_sampler = PackedBatchSampler(dataset.lengths, batch_size, pack_len,
+                                           num_replicas=getattr(sampler, "num_replicas", 1), rank=getattr(sampler, "rank", 0),
+                                           shuffle=getattr(sampler, "shuffle", sampler is not None), seed=getattr(sampler, "seed", 0))
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+    # without a sampler (valid and test) the batches keep the sequential order
+    shuffle = sampler is not None
+    if sampler is None:
+        sampler = SequentialSampler(dataset)
+    if bucket:
+        batch_sampler = BucketBatchSampler(sampler, dataset.lengths, batch_size, shuffle=shuffle)
+    else:
+        batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+
+
+def parse_mix_weights(mix_weights):
+    """Parse the mixture weights of the command line, e.g. "assist2009:4,ednet_all:0.5" or "1:4,0:0.5".
+
+    Args:
+        mix_weights (str): comma separated dataset:weight pairs, the dataset is a name of datasets_dic or an id
+
+    Returns:
+        dict: dataset id -> weight, None for an empty string
+    """
+    if mix_weights is None or mix_weights == "":
+        return None
+    weights = dict()
+    for item in mix_weights.split(","):
+        name, weight = item.split(":")
+        weights[datasets_dic[name] if name in datasets_dic else int(name)] = float(weight)
+    return weights
+
+
+def parse_int_seqs(col, ragged=False):
+    """Parse a column of comma-joined int strings into a 2-D array in one pass.
+
+    Args:
+        col (pd.Series): each value is like "1,2,-1", all rows have the same length
+        ragged (bool, optional): the rows may have different lengths, the values are returned flat. Defaults to False.
+
+    Returns:
+        np.ndarray: int64 array of shape [num_rows, seqlen], or of shape [total_len] plus the row lengths if ragged
+    """
+    values = col.tolist()
+    if len(values) == 0:
+        empty = np.zeros((0, 0), dtype=np.int64)
+        return (empty.reshape(0), np.zeros(0, dtype=np.int64)) if ragged else empty
+    lens = col.str.count(",").to_numpy() + 1
+    if not ragged and (lens != lens[0]).any():
+        raise ValueError(f"column {col.name} has rows with different lengths")
+    flat = np.fromstring(",".join(values), dtype=np.int64, sep=",")
+    if flat.size != lens.sum():
+        raise ValueError(f"column {col.name} contains non integer values")
+    if ragged:
+        return flat, lens
+    return flat.reshape(len(values), lens[0])
+
+
+def parse_concept_seqs(col, max_concepts, pad_val=-1, ragged=False):
+    """Parse a column of comma-joined concept lists such as "3_5,7,-1" into a padded 3-D array.
+
+    The "_" separated concepts of one interaction are scattered into the last dimension
+    and padded with pad_val up to max_concepts, the same as the row by row parser.
+
+    Args:
+        col (pd.Series): the concepts column, all rows have the same length
+        max_concepts (int): the max number of concepts of one question
+        pad_val (int, optional): pad value. Defaults to -1.
+        ragged (bool, optional): the rows may have different lengths, the interactions are returned flat. Defaults to False.
+
+    Returns:
+        np.ndarray: int64 array of shape [num_rows, seqlen, max_concepts], or of shape [total_len, max_concepts] if ragged
+    """
+    values = col.tolist()
+    if len(values) == 0:
+        return np.zeros((0, max_concepts) if ragged else (0, 0, max_concepts), dtype=np.int64)
+    lens = col.str.count(",").to_numpy() + 1
+    if not ragged and (lens != lens[0]).any():
+        raise ValueError(f"column {col.name} has rows with different lengths")
+    joined = ",".join(values)
+    flat = np.fromstring(joined.replace("_", ","), dtype=np.int64, sep=",")
+    raw = np.frombuffer(joined.encode(), dtype=np.uint8)
+    # every separator ends one concept, a "," also ends one interaction
+    is_comma = raw[(raw == ord(",")) | (raw == ord("_"))] == ord(",")
+    if flat.size != is_comma.size + 1:
+        raise ValueError(f"column {col.name} contains non integer values")
+    token_ids = np.concatenate([[0], np.cumsum(is_comma)])
+    token_starts = np.flatnonzero(np.concatenate([[True], is_comma]))
+    positions = np.arange(flat.size) - token_starts[token_ids]
+    if positions.max() >= max_concepts:
+        raise ValueError(f"some questions have more than max_concepts={max_concepts} concepts")
+    skills = np.full((token_starts.size, max_concepts), pad_val, dtype=np.int64)
+    skills[token_ids, positions] = flat
+    if ragged:
+        return skills
+    return skills.reshape(len(values), lens[0], max_concepts)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler which groups sequences of similar length.
+
+    The indices of the wrapped sampler (e.g. a DistributedSampler, so every rank keeps its own
+    partition) are cut into pools of batch_size * bucket_size, each pool is sorted by length and
+    split into batches, and the order of the batches is shuffled. Every rank gets the same number
+    of batches as with a plain BatchSampler.
+
+    Args:
+        sampler (Sampler): the sampler providing the indices
+        lengths (torch.tensor or np.ndarray): the sequence length of every row of the dataset
+        batch_size (int): batch size
+        bucket_size (int, optional): number of batches sorted together. Defaults to 50.
+        shuffle (bool, optional): shuffle the order of the batches. Defaults to True.
+        seed (int, optional): random seed, combined with the epoch. Defaults to 0.
+    """
+    def __init__(self, sampler, lengths, batch_size, bucket_size=50, shuffle=True, seed=0):
+        self.sampler = sampler
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """set the epoch of this sampler and of the wrapped one, both are used to seed the shuffle"""
+        self.epoch = epoch
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            for j in range(0, len(pool), self.batch_size):
+                batches.append(pool[j:j + self.batch_size].tolist())
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        num_samples = len(self.sampler)
+        pool_size = self.batch_size * self.bucket_size
+        num_full, rest = divmod(num_samples, pool_size)
+        return num_full * self.bucket_size + (rest + self.batch_size - 1) // self.batch_size
+
+
+class PackedBatchSampler(Sampler):
+    """Batch sampler which packs several short sequences into each row of a batch.
+
+    The indices are shuffled, cut into pools of batch_size * bucket_size and each pool is packed
+    first-fit decreasing into rows of at most seq_len interactions. The rows are grouped into
+    batches of batch_size rows. The packing is done over the whole dataset with the same seed
+    on every rank, the batches are then dealt out to the ranks, so each rank gets its own
+    batches and the same number of them. The batches of an epoch are packed once and kept for
+    __len__ and __iter__.
+
+    Args:
+        lengths (torch.tensor or np.ndarray): the sequence length of every row of the dataset
+        batch_size (int): number of packed rows per batch
+        seq_len (int): max number of interactions per packed row
+        num_replicas (int, optional): number of ranks. Defaults to 1.
+        rank (int, optional): rank of this process. Defaults to 0.
+        shuffle (bool, optional): shuffle the sequences and the batches. Defaults to True.
+        seed (int, optional): random seed, combined with the epoch. Defaults to 0.
+        bucket_size (int, optional): number of batches packed together. Defaults to 50.
+    """
+    def __init__(self, lengths, batch_size, seq_len, num_replicas=1, rank=0, shuffle=True, seed=0, bucket_size=50):
+        self.lengths = np.asarray(lengths)
+        if self.lengths.max() > seq_len:
+            raise ValueError(f"the longest sequence ({self.lengths.max()}) does not fit in seq_len={seq_len}")
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        # (seed, epoch) -> the batches of this rank, only the last epoch is kept
+        self.cached = dict()
+
+    def set_epoch(self, epoch):
+        """set the epoch of this sampler, it is used to seed the shuffle"""
+        self.epoch = epoch
+
+    def pack(self, indices):
+        """Pack the indices first-fit decreasing into rows of at most seq_len interactions.
+
+        Args:
+            indices (np.ndarray): the indices to pack
+
+        Returns:
+            list[list[int]]: the packed rows
+        """
+        indices = indices[np.argsort(-self.lengths[indices], kind="stable")]
+        rows, free = [], np.zeros(len(indices), dtype=np.int64)
+        for idx in indices.tolist():
+            length = self.lengths[idx]
+            fits = free[:len(rows)] >= length
+            if fits.any():
+                j = int(np.argmax(fits))
+            else:
+                j = len(rows)
+                rows.append([])
+                free[j] = self.seq_len
+            rows[j].append(idx)
+            free[j] -= length
+        return rows
+
+    def __batches__(self):
+        key = (self.seed, self.epoch)
+        if key not in self.cached:
+            self.cached = {key: self.__pack_batches__()}
+        return self.cached[key]
+
+    def __pack_batches__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=g).numpy()
+        else:
+            indices = np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            rows = self.pack(indices[start:start + pool_size])
+            for j in range(0, len(rows), self.batch_size):
+                batches.append(rows[j:j + self.batch_size])
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        # repeat the first batches so that every rank gets the same number of batches
+        num_batches = -(-len(batches) // self.num_replicas) * self.num_replicas
+        batches += batches[:num_batches - len(batches)]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.__batches__())
+
+    def __len__(self):
+        return len(self.__batches__())
+
+
+class MixtureBatchSampler(Sampler):
+    """Batch sampler which draws the items of every epoch from several datasets with given proportions.
+
+    Dataset d is drawn with probability proportional to weights[d] * n_d ** (1 / temperature), where n_d
+    is its number of items: weights 1 and temperature 1 give the natural mixture, a higher temperature
+    moves it towards uniform. The draws go through a random permutation of each dataset's index pool,
+    which is repeated only if a dataset is drawn more often than its size, so no resampled copy of the
+    data is made. The mixture realized in the epoch is printed and kept in self.realized.
+
+    Args:
+        dataset_ids (torch.tensor or np.ndarray): the dataset id of every item
+        batch_size (int): batch size
+        weights (dict, optional): dataset id -> weight, 1.0 for the datasets not in it. Defaults to None.
+        temperature (float, optional): sampling temperature. Defaults to 1.0.
+        num_samples (int, optional): items per epoch over all ranks, the dataset length if None. Defaults to None.
+        num_replicas (int, optional): number of ranks. Defaults to 1.
+        rank (int, optional): rank of this process. Defaults to 0.
+        seed (int, optional): random seed, combined with the epoch. Defaults to 0.
+    """
+    def __init__(self, dataset_ids, batch_size, weights=None, temperature=1.0, num_samples=None, num_replicas=1, rank=0, seed=0):
+        dataset_ids = np.asarray(dataset_ids)
+        self.datasets = np.unique(dataset_ids)
+        self.pools = [np.flatnonzero(dataset_ids == d) for d in self.datasets]
+        sizes = np.array([len(pool) for pool in self.pools], dtype=np.float64)
+        weights = weights or dict()
+        unknown = sorted(set(weights) - set(self.datasets.tolist()))
+        if len(unknown) > 0:
+            raise ValueError(f"the mixture weights have unknown dataset ids {unknown}, the datasets are {self.datasets.tolist()}")
+        probs = np.array([weights.get(int(d), 1.0) for d in self.datasets]) * sizes ** (1.0 / temperature)
+        self.probs = probs / probs.sum()
+        self.batch_size = batch_size
+        self.num_samples = len(dataset_ids) if num_samples is None else num_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.realized = dict()
+
+    def set_epoch(self, epoch):
+        """set the epoch of this sampler, it is used to seed the draws"""
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = np.random.default_rng(self.seed + self.epoch)
+        counts = g.multinomial(self.num_samples, self.probs)
+        picks = []
+        for pool, count in zip(self.pools, counts):
+            reps = -(-count // len(pool))
+            picks.append(np.concatenate([g.permutation(pool) for _ in range(reps)] + [pool[:0]])[:count])
+        indices = g.permutation(np.concatenate(picks))
+        self.realized = {int(d): int(c) for d, c in zip(self.datasets, counts)}
+        if self.rank == 0:
+            mixture = ", ".join([f"{d}: {c} ({c / self.num_samples:.2%})" for d, c in self.realized.items()])
+            print(f"epoch {self.epoch} dataset mixture: {mixture}")
+        batches = [indices[j:j + self.batch_size].tolist() for j in range(0, len(indices), self.batch_size)]
+        num_batches = -(-len(batches) // self.num_replicas) * self.num_replicas
+        batches += batches[:num_batches - len(batches)]
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        num_batches = -(-self.num_samples // self.batch_size)
+        return -(-num_batches // self.num_replicas)
+
+
+class BlockShuffleSampler(Sampler):
+    """Sampler which shuffles contiguous blocks of rows instead of single rows.
+
+    The rows are cut into blocks of block_size consecutive indices, the blocks are shuffled with the
+    same seed on every rank and the rows are shuffled again only inside windows of window_size
+    positions, so a memory-mapped store is read a few blocks at a time instead of with random page
+    faults. Every rank gets a contiguous part of the shuffled order, the ranks do not overlap and each
+    gets ceil(len / num_replicas) indices, the same as DistributedSampler (the first indices are repeated
+    to fill the last rank).
+
+    Args:
+        num_rows (int): the dataset length
+        block_size (int, optional): number of consecutive rows shuffled as one block. Defaults to 1024.
+        window_size (int, optional): the rows are shuffled within windows of this many positions, 4 blocks if None. Defaults to None.
+        num_replicas (int, optional): number of ranks. Defaults to 1.
+        rank (int, optional): rank of this process. Defaults to 0.
+        shuffle (bool, optional): shuffle the blocks and the rows, sequential order if False. Defaults to True.
+        seed (int, optional): random seed, combined with the epoch. Defaults to 0.
+    """
+    def __init__(self, num_rows, block_size=1024, window_size=None, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.num_rows = num_rows
+        self.block_size = block_size
+        self.window_size = 4 * block_size if window_size is None else window_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = -(-num_rows // num_replicas)
+
+    def set_epoch(self, epoch):
+        """set the epoch of this sampler, it is used to seed the shuffle"""
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = np.arange(self.num_rows)
+        if self.shuffle:
+            g = np.random.default_rng(self.seed + self.epoch)
+            starts = g.permutation(np.arange(0, self.num_rows, self.block_size))
+            sizes = np.minimum(starts + self.block_size, self.num_rows) - starts
+            indices = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(self.num_rows)
+        indices = np.resize(indices, self.num_samples * self.num_replicas)
+        indices = indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+        if self.shuffle:
+            # every rank shuffles its own windows
+            g = np.random.default_rng([self.seed, self.epoch, self.rank])
+            windows = np.arange(len(indices)) // self.window_size
+            indices = indices[np.lexsort((g.random(len(indices)), windows))]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class CurriculumSampler(Sampler):
+    """Sampler which yields only the easiest part of the rows, the part grows during the training.
+
+    The rows are ordered once by their difficulty score (e.g. KTQueDataset.get_difficulty), every epoch
+    the easiest fraction of them (see set_fraction, paced by sample4cl) is shuffled and dealt out to the
+    ranks, so the rows of the later stages are never read in the early epochs. Every rank gets
+    ceil(num_rows * fraction / num_replicas) indices.
+
+    Args:
+        scores (torch.tensor or np.ndarray): the difficulty of every row, lower is easier
+        fraction (float, optional): the part of the rows sampled at the start. Defaults to 1.0.
+        num_replicas (int, optional): number of ranks. Defaults to 1.
+        rank (int, optional): rank of this process. Defaults to 0.
+        shuffle (bool, optional): shuffle the sampled rows, easiest first if False. Defaults to True.
+        seed (int, optional): random seed, combined with the epoch. Defaults to 0.
+    """
+    def __init__(self, scores, fraction=1.0, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.order = np.argsort(np.asarray(scores), kind="stable")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.set_fraction(fraction)
+
+    def set_epoch(self, epoch):
+        """set the epoch of this sampler, it is used to seed the shuffle"""
+        self.epoch = epoch
+
+    def set_fraction(self, fraction):
+        """set the part of the rows sampled from now on"""
+        self.fraction = min(1.0, max(0.0, fraction))
+        self.num_rows = max(1, int(round(self.fraction * len(self.order))))
+        self.num_samples = -(-self.num_rows // self.num_replicas)
+
+    def __iter__(self):
+        indices = self.order[:self.num_rows]
+        if self.shuffle:
+            indices = np.random.default_rng(self.seed + self.epoch).permutation(indices)
+        indices = np.resize(indices, self.num_samples * self.num_replicas)
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import json
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from .data_cache import save_tensor_cache, load_tensor_cache, atomic_dir
+from .que_data_loader import ragged_index, gather_ragged, split_gaps, ROW_KEYS
+
+SHARD_INDEX_NAME = "shards.json"
+
+
+def has_shards(shard_dir):
+    """Check whether shard_dir holds a complete set of shards written by write_shards"""
+    return os.path.exists(os.path.join(shard_dir, SHARD_INDEX_NAME))
+
+
+def write_shards(dori, shard_dir, rows_per_shard=100000, index=None):
+    """Split the rows of a ragged store (see to_ragged) into shards of rows_per_shard sequences.
+
+    Every shard is a columnar tensor cache of its own. The shards are written to a temporary directory
+    which is renamed to shard_dir at the end, use build_once to write them from one process only.
+
+    Args:
+        dori (dict): the ragged store, e.g. KTQueDataset(..., ragged=True).dori
+        shard_dir (str): the output directory
+        rows_per_shard (int, optional): number of sequences per shard. Defaults to 100000.
+        index (torch.tensor, optional): the rows to write, e.g. KTQueDataset.index, all rows if None. Defaults to None.
+    """
+    offsets = dori["offsets"]
+    if index is None:
+        index = torch.arange(len(offsets) - 1)
+    num_rows = len(index)
+    shards = []
+    with atomic_dir(shard_dir) as tmp_dir:
+        for sid, start in enumerate(range(0, num_rows, rows_per_shard)):
+            rows = index[start:start + rows_per_shard]
+            lens = offsets[rows + 1] - offsets[rows]
+            flat_index, valid = ragged_index(offsets[rows], lens)
+            flat_index = flat_index[valid]
+            shard = dict()
+            for key, value in dori.items():
+                if key == "offsets":
+                    shard[key] = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(lens, dim=0)])
+                elif key in ROW_KEYS:
+                    shard[key] = value[rows]
+                elif len(value) == 0:
+                    shard[key] = value
+                else:
+                    shard[key] = value[flat_index]
+            name = f"shard_{sid:05d}"
+            save_tensor_cache(shard, os.path.join(tmp_dir, name))
+            shards.append({"dir": name, "num_rows": len(rows)})
+        with open(os.path.join(tmp_dir, SHARD_INDEX_NAME), "w") as fout:
+            json.dump({"num_rows": num_rows, "shards": shards}, fout, indent=4)
+    print(f"write {len(shards)} shards of {num_rows} sequences to {shard_dir}")
+
+
+def collate_ragged(samples, pad_val=-1):
+    """Build a batch from single sequences, padded to the longest one.
+
+    Args:
+        samples (list[dict]): field name -> the unpadded values of one sequence, "dataset" is a scalar
+
+    Returns:
+        dict or tuple: the same as KTQueDataset.__getitem__
+    """
+    lens = torch.as_tensor([len(sample["rseqs"]) for sample in samples])
+    dori = dict()
+    for key in samples[0]:
+        if key in ROW_KEYS:
+            continue
+        dori[key] = torch.cat([sample[key] for sample in samples])
+    flat_index, valid = ragged_index(torch.cumsum(lens, dim=0) - lens, lens)
+    dcur = gather_ragged(dori, flat_index, valid, pad_val)
+    dcur["dataset_id"] = torch.stack([sample["dataset"] for sample in samples])
+    return split_gaps(dcur)
+
+
+class KTQueShardDataset(IterableDataset):
+    """Streaming dataset over the shards written by write_shards, yields whole batches.
+
+    Each epoch the shards are shuffled with the same seed on every rank and concatenated, rank r reads
+    the rows [r * num_samples, (r + 1) * num_samples) of the concatenation and its DataLoader workers
+    read consecutive parts of that range, so every sequence is read once per epoch by one worker (the
+    last num_rows % num_replicas rows are dropped). Only the shard being read is mapped and at most
+    buffer_size sequences are held for the shuffle, so the memory of a rank does not depend on the
+    size of the corpus. Every rank yields exactly num_samples = num_rows // num_replicas sequences per epoch.
+
+    Args:
+        shard_dir (str): the directory written by write_shards
+        batch_size (int): batch size
+        buffer_size (int, optional): number of sequences in the shuffle buffer. Defaults to 10000.
+        shuffle (bool, optional): shuffle the shards, the rows and the buffer. Defaults to True.
+        seed (int, optional): random seed, combined with the epoch. Defaults to 0.
+        num_replicas (int, optional): number of ranks, from torch.distributed if None. Defaults to None.
+        rank (int, optional): rank of this process, from torch.distributed if None. Defaults to None.
+    """
+    def __init__(self, shard_dir, batch_size, buffer_size=10000, shuffle=True, seed=0, num_replicas=None, rank=None):
+        super(KTQueShardDataset, self).__init__()
+        with open(os.path.join(shard_dir, SHARD_INDEX_NAME)) as fin:
+            index = json.load(fin)
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        self.shard_dir = shard_dir
+        self.shards = index["shards"]
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.ragged = True
+        self.num_samples = index["num_rows"] // num_replicas
+        print(f"shards: {len(self.shards)}, sequences: {index['num_rows']}, sequences per rank: {self.num_samples}")
+
+    def set_epoch(self, epoch):
+        """set the epoch, it is used to seed the shuffle"""
+        self.epoch = epoch
+
+    def __len__(self):
+        """return the number of batches of this rank"""
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __worker_count__(self, worker_id, num_workers):
+        """the number of sequences of a worker, the batches of the rank are dealt out to the workers
+        and only the last batch may be smaller"""
+        num_batches = len(self)
+        count = len(range(worker_id, num_batches, num_workers)) * self.batch_size
+        if num_batches > 0 and (num_batches - 1) % num_workers == worker_id:
+            count -= num_batches * self.batch_size - self.num_samples
+        return count
+
+    def __worker_plan__(self):
+        """The (shard, first row, end row) parts read by this worker in order and the number of sequences it yields"""
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(order)
+        # the global rows of this worker in the concatenation of the shards in order
+        start = self.rank * self.num_samples
+        start += sum(self.__worker_count__(w, num_workers) for w in range(worker_id))
+        count = self.__worker_count__(worker_id, num_workers)
+        end = start + count
+        bounds = np.cumsum([0] + [self.shards[sid]["num_rows"] for sid in order]).tolist()
+        plan = []
+        for i, sid in enumerate(order.tolist()):
+            lo, hi = max(start, bounds[i]), min(end, bounds[i + 1])
+            if lo < hi:
+                plan.append((sid, lo - bounds[i], hi - bounds[i]))
+        return plan, count, worker_id
+
+    def __read_shard__(self, sid, start, end, rng):
+        """yield the sequences start..end-1 of one shard, in random order if shuffle"""
+        dori, _ = load_tensor_cache(os.path.join(self.shard_dir, self.shards[sid]["dir"]))
+        offsets = dori["offsets"].tolist()
+        rows = np.arange(start, end)
+        if self.shuffle:
+            rows = rng.permutation(rows)
+        for row in rows.tolist():
+            lo, hi = offsets[row], offsets[row + 1]
+            sample = dict()
+            for key, value in dori.items():
+                if key == "offsets":
+                    continue
+                if key in ROW_KEYS:
+                    sample[key] = value[row].clone()
+                else:
+                    sample[key] = value[lo:hi].clone() if len(value) > 0 else value[:0].clone()
+            yield sample
+
+    def __samples__(self, plan, count, rng):
+        """yield the count sequences of the parts of plan through the shuffle buffer"""
+        source = (sample for sid, start, end in plan for sample in self.__read_shard__(sid, start, end, rng))
+        if not self.shuffle:
+            yield from source
+            return
+        buffer = [next(source) for _ in range(min(self.buffer_size, count))]
+        pulled = len(buffer)
+        for _ in range(count):
+            j = int(rng.integers(len(buffer)))
+            sample = buffer[j]
+            if pulled < count:
+                buffer[j] = next(source)
+                pulled += 1
+            else:
+                buffer[j] = buffer[-1]
+                buffer.pop()
+            yield sample
+
+    def __iter__(self):
+        plan, count, worker_id = self.__worker_plan__()
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+        batch = []
+        for sample in self.__samples__(plan, count, rng):
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield collate_ragged(batch)
+                batch = []
+        if len(batch) > 0:
+            yield collate_ragged(batch)
@@ -4,6 +4,8 @@ from torch import nn
 from torch.nn.functional import one_hot, binary_cross_entropy
 from sklearn import metrics
 from pykt.config import que_type_models
+from ..datasets.que_data_loader import upcast_batch
+from ..datasets.prefetcher import BatchPrefetcher
 import pandas as pd
 import json
 
@@ -87,6 +89,8 @@ def save_cur_predict_result(dres, q, r, d, t, m, sm, p):
     return "\n".join(results)
 
 def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name="", fold="", attn_cnt_path=""):
+    # the batches of BatchPrefetcher are upcast already
+    upcast = not isinstance(test_loader, BatchPrefetcher)
     if save_path != "":
         fout = open(save_path, "w", encoding="utf8")
     with torch.no_grad():
@@ -105,8 +109,12 @@ def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name=
                 dcur, dgaps = data
             elif model_name in ["gpt4kt","unikt"] and model.emb_type.find("pt") != -1:
                 dcur, dgaps = data
+                if upcast:
+                    dgaps = upcast_batch(dgaps, device)
             else:
                 dcur = data
+            if model_name in ["gpt4kt","unikt"] and upcast:
+                dcur = upcast_batch(dcur, device)
             q, c, r = dcur["qseqs"], dcur["cseqs"], dcur["rseqs"]
             qshft, cshft, rshft = dcur["shft_qseqs"], dcur["shft_cseqs"], dcur["shft_rseqs"]
             m, sm = dcur["masks"], dcur["smasks"]
@@ -236,6 +244,8 @@ def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name=
     return auc, acc
 
 def evaluate(model, test_loader, model_name, save_path="", dataset_name="", fold="", attn_cnt_path=""):
+    # the batches of BatchPrefetcher are upcast already
+    upcast = not isinstance(test_loader, BatchPrefetcher)
     if save_path != "":
         fout = open(save_path, "w", encoding="utf8")
     with torch.no_grad():
@@ -254,8 +264,12 @@ def evaluate(model, test_loader, model_name, save_path="", dataset_name="", fold
                 dcur, dgaps = data
             elif model_name in ["gpt4kt","unikt"] and model.module.emb_type.find("pt") != -1:
                 dcur, dgaps = data
+                if upcast:
+                    dgaps = upcast_batch(dgaps, device)
             else:
                 dcur = data
+            if model_name in ["gpt4kt","unikt"] and upcast:
+                dcur = upcast_batch(dcur, device)
             q, c, r = dcur["qseqs"], dcur["cseqs"], dcur["rseqs"]
             qshft, cshft, rshft = dcur["shft_qseqs"], dcur["shft_cseqs"], dcur["shft_rseqs"]
             m, sm = dcur["masks"], dcur["smasks"]
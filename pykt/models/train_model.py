@@ -7,6 +7,9 @@ import numpy as np
 from .evaluate_model import evaluate
 from torch.autograd import Variable, grad
 from ..utils.utils import debug_print
+from ..datasets.que_data_loader import upcast_batch
+from ..datasets.prefetcher import BatchPrefetcher
+from ..datasets.samplers import BlockShuffleSampler, CurriculumSampler
 from pykt.config import que_type_models
 import pickle
 from torch.utils.data import DataLoader
@@ -65,7 +68,7 @@ def cal_loss(model, ys, r, rshft, sm, preloss=[]):
     return loss
 
 
-def model_forward(model, data, attn_grads=None):
+def model_forward(model, data, attn_grads=None, upcast=True):
     model_name = model.module.model_name
     # if model_name in ["dkt_forget", "lpkt"]:
     #     q, c, r, qshft, cshft, rshft, m, sm, d, dshft = data
@@ -76,8 +79,13 @@ def model_forward(model, data, attn_grads=None):
         dcur, dgaps = data
     elif model_name in ["gpt4kt","unikt"] and model.module.emb_type.find("pt") != -1:
         dcur, dgaps = data
+        if upcast:
+            dgaps = upcast_batch(dgaps, device)
     else:
         dcur = data
+    # the batches of BatchPrefetcher are upcast already
+    if model_name in ["gpt4kt","unikt"] and upcast:
+        dcur = upcast_batch(dcur, device)
     if model_name in ["dimkt"]:
         q, c, r, t, sd, qd = (
             dcur["qseqs"].to(device),
@@ -187,6 +195,12 @@ def train_model(
     simple_size = 0
     cl_bn = 10000
 
+    prefetch = getattr(args, "prefetch", 0)
+    if prefetch > 0 and model.module.model_name in ["gpt4kt", "unikt"]:
+        # prepare and copy the next batches to the device on a background thread
+        train_loader = BatchPrefetcher(train_loader, device, depth=prefetch, transform=upcast_batch)
+        valid_loader = BatchPrefetcher(valid_loader, device, depth=prefetch, transform=upcast_batch)
+
     for i in range(pretrain_epoch + 1, num_epochs + 1):
         start_time = time.time()
         loss_mean = []
@@ -197,7 +211,21 @@ def train_model(
                 simple_size, cl_bn = sample4cl(
                     curtrain, batch_size, i, model.module.c0, model.module.max_epoch
                 )
+                curriculum = getattr(train_loader.sampler, "sampler", None)
+                if isinstance(curriculum, CurriculumSampler):
+                    # the sampler yields only the easiest simple_size of the rows, no batch is skipped below
+                    curriculum.set_fraction(simple_size)
+                    cl_bn = len(train_loader)
         step = 0
+        if hasattr(train_loader.dataset, "set_epoch"):
+            # KTQueWindowDataset cuts its windows with new random offsets
+            train_loader.dataset.set_epoch(i)
+        if train_loader.batch_size is None and hasattr(train_loader.sampler, "set_epoch"):
+            # batch level samplers, e.g. BucketBatchSampler, reshuffle their batches every epoch
+            train_loader.sampler.set_epoch(i)
+        elif train_loader.batch_size is None and isinstance(getattr(train_loader.sampler, "sampler", None), (BlockShuffleSampler, CurriculumSampler)):
+            # a plain BatchSampler over the block shuffle or the curriculum
+            train_loader.sampler.sampler.set_epoch(i)
         for j, data in enumerate(train_loader):
             step += 1
             # if j>=1: break
@@ -221,7 +249,7 @@ def train_model(
                 #     if j != 0:pre_attn_weights = model.module.attn_weights
                 loss = model_forward(model, data, attn_grads)
             else:
-                loss = model_forward(model, data, i)
+                loss = model_forward(model, data, i, upcast=not isinstance(train_loader, BatchPrefetcher))
 
             loss = loss / gradient_accumulation_steps
             # print(f"loss:{loss}")
@@ -233,6 +261,8 @@ def train_model(
             loss_mean.append(loss.detach().cpu().numpy())
 
         rank0_print(f"One epoch total step is {step}")
+        if isinstance(train_loader, BatchPrefetcher):
+            rank0_print(f"waited {train_loader.wait_time:.2f}s for {train_loader.num_batches} batches")
         loss_mean = np.mean(loss_mean)
 
         if model.module.model_name == "rkt":
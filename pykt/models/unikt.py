@@ -6,7 +6,7 @@ import math
 import torch.nn.functional as F
 from enum import IntEnum
 import numpy as np
-from .utils import transformer_FFN, ut_mask, pos_encode, get_clones
+from .utils import transformer_FFN, ut_mask, pos_encode, get_clones, segment_positions, segment_mask
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout, LayerNorm, TransformerEncoder, TransformerEncoderLayer, \
         MultiLabelMarginLoss, MultiLabelSoftMarginLoss, CrossEntropyLoss, BCELoss, MultiheadAttention
 from torch.nn.functional import one_hot, cross_entropy, multilabel_margin_loss, binary_cross_entropy
@@ -135,12 +135,13 @@ class UNIKT(nn.Module):
         return concept_avg
 
     def forward(self, dcur, qtest=False, train=False, dgaps=None):
-        q, c, r = dcur["qseqs"].long().to(device), dcur["cseqs"].long().to(device), dcur["rseqs"].long().to(device)
-        qshft, cshft, rshft = dcur["shft_qseqs"].long().to(device), dcur["shft_cseqs"].long().to(device), dcur["shft_rseqs"].long().to(device)
+        q, c, r = dcur["qseqs"].to(device).long(), dcur["cseqs"].to(device).long(), dcur["rseqs"].to(device).long()
+        qshft, cshft, rshft = dcur["shft_qseqs"].to(device).long(), dcur["shft_cseqs"].to(device).long(), dcur["shft_rseqs"].to(device).long()
         # print(f"q:{q.shape}")
         batch_size = q.size(0)
 
-        dataset_id = dcur["dataset_id"].long().to(device)
+        dataset_id = dcur["dataset_id"].to(device).long()
+        segments = dcur["segments"].to(device).long() if "segments" in dcur else None
         pid_data = torch.cat((q[:,0:1], qshft), dim=1) # shape[batch,200]
         q_data = torch.cat((c[:,0:1], cshft), dim=1) # shape[batch,200,7]
         target = torch.cat((r[:,0:1], rshft), dim=1)
@@ -150,6 +151,10 @@ class UNIKT(nn.Module):
             aug_pids= pid_data.unfold(1, self.q_window_size, 1)
             aug_pids = aug_pids.sum(dim=2)
             aug_pid_data = torch.where(aug_pids >= 200000, -1, aug_pids)
+            if segments is not None:
+                # a window over two sequences of a packed row is padding
+                seg_windows = segments.unfold(1, self.q_window_size, 1)
+                aug_pid_data = torch.where(seg_windows.max(dim=2).values != seg_windows.min(dim=2).values, -1, aug_pid_data)
 
             # new cids
             if q_data.size(2) <  self.c_window_size:
@@ -184,12 +189,20 @@ class UNIKT(nn.Module):
             # embedding
             emb_q = self.emb_q(all_pid_data) #[batch,max_len-1,emb_size]
             emb_c = self.get_avg_skill_emb(all_cid_data) #[batch,max_len-1,emb_size]
-            dataset_embed_data = self.dataset_emb(dataset_id).unsqueeze(1).repeat(2,1,1)
+            dataset_embed_data = self.dataset_emb(dataset_id)
+            if dataset_id.dim() == 1: # packed rows have one dataset_id per position
+                dataset_embed_data = dataset_embed_data.unsqueeze(1)
+            dataset_embed_data = dataset_embed_data.repeat(2,1,1)
+            if segments is not None:
+                # the augmented rows keep the segments of their packed rows
+                segments = segments.repeat(2,1)
             qa_embed_data = self.qa_embed(all_target_data)
         else:
             emb_q = self.emb_q(pid_data)#[batch,max_len-1,emb_size]
             emb_c = self.get_avg_skill_emb(q_data)#[batch,max_len-1,emb_size]
-            dataset_embed_data = self.dataset_emb(dataset_id).unsqueeze(1)
+            dataset_embed_data = self.dataset_emb(dataset_id)
+            if dataset_id.dim() == 1: # packed rows have one dataset_id per position
+                dataset_embed_data = dataset_embed_data.unsqueeze(1)
             # print(f"dataset_embed_data:{dataset_embed_data.shape}")
             try:
                 qa_embed_data = self.qa_embed(target)
@@ -210,7 +223,7 @@ class UNIKT(nn.Module):
 
         # BS.seqlen,d_model
         y2, y3 = 0, 0
-        d_output = self.model((q_embed_data, qa_embed_data))
+        d_output = self.model((q_embed_data, qa_embed_data), segments)
         concat_q = torch.cat([d_output, q_embed_data], dim=-1)
         output = self.out(concat_q).squeeze(-1)
         m = nn.Sigmoid()
@@ -290,14 +303,15 @@ class Architecture(nn.Module):
             ])
         self.position_emb = CosinePositionalEmbedding(d_model=self.d_model, max_len=seq_len)
 
-    def forward(self, inputs):
+    def forward(self, inputs, segments=None):
         # target shape  bs, seqlen
+        # segments: bs, seqlen, only for packed rows, the id of the sequence each position belongs to
         q_embed_data, qa_embed_data = inputs
         seqlen, batch_size = q_embed_data.size(1), q_embed_data.size(0)
 
-        q_posemb = self.position_emb(q_embed_data)
+        q_posemb = self.position_emb(q_embed_data, segments)
         q_embed_data = q_embed_data + q_posemb
-        qa_posemb = self.position_emb(qa_embed_data)
+        qa_posemb = self.position_emb(qa_embed_data, segments)
         qa_embed_data = qa_embed_data + qa_posemb
 
         qa_pos_embed = qa_embed_data
@@ -316,7 +330,7 @@ class Architecture(nn.Module):
             #     return block(mask, query, key, values, apply_pos)
             # x = checkpoint(run_block, mask, x, x, y, apply_pos)
             
-            x = checkpoint(block, x, x, y)
+            x = checkpoint(block, x, x, y, segments)
             # x = block(mask=0, query=x, key=x, values=y, apply_pos=True) # True: +FFN+残差+laynorm 非第一层与0~t-1的的q的attention, 对应图中Knowledge Retriever
             # mask=0，不能看到当前的response, 在Knowledge Retrever的value全为0，因此，实现了第一题只有question信息，无qa信息的目的
             # print(x[0,0,:])
@@ -347,7 +361,7 @@ class TransformerLayer(nn.Module):
         self.layer_norm2 = nn.LayerNorm(d_model)
         self.dropout2 = nn.Dropout(dropout)
 
-    def forward(self, query, key, values):
+    def forward(self, query, key, values, segments=None):
         """
         Input:
             block : object of type BasicBlock(nn.Module). It contains masked_attn_head objects which is of type MultiHeadAttention(nn.Module).
@@ -366,6 +380,8 @@ class TransformerLayer(nn.Module):
         nopeek_mask = np.triu(
             np.ones((1, 1, seqlen, seqlen)), k=mask).astype('uint8')
         src_mask = (torch.from_numpy(nopeek_mask) == 0).to(device)
+        if segments is not None:
+            src_mask = src_mask & segment_mask(segments)
         if mask == 0:  # If 0, zero-padding is needed.
             # Calls block.masked_attn_head.forward() method
             query2 = self.masked_attn_head(
@@ -464,8 +480,8 @@ def attention(q, k, v, d_k, mask, dropout, zero_pad):
     # print(f"before zero pad scores: {scores.shape}")
     # print(zero_pad)
     if zero_pad:
-        pad_zero = torch.zeros(bs, head, 1, seqlen).to(device)
-        scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2) # 第一行score置0
+        # 第一行score置0, the same for the first position of every segment in packed rows
+        scores = scores.masked_fill(~mask.any(dim=-1, keepdim=True), 0.)
     # print(f"after zero pad scores: {scores}")
     scores = dropout(scores)
     output = torch.matmul(scores, v)
@@ -499,5 +515,8 @@ class CosinePositionalEmbedding(nn.Module):
         pe = pe.unsqueeze(0)
         self.weight = nn.Parameter(pe, requires_grad=False)
 
-    def forward(self, x):
+    def forward(self, x, segments=None):
+        if segments is not None:
+            # restart the position at each segment of packed rows
+            return self.weight[0, segment_positions(segments)]  # ( bs,seq,  Feature)
         return self.weight[:, :x.size(Dim.seq), :]  # ( 1,seq,  Feature)
@@ -54,3 +54,31 @@ def pos_encode(seq_len):
 def get_clones(module, N):
     """Cloning nn modules"""
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
+
+
+def segment_positions(segments):
+    """Position of every interaction inside its own segment of a packed row
+
+    Args:
+        segments (torch.tensor): [batch_size, seqlen], the segment id of every position, -1 for padding
+
+    Returns:
+        torch.tensor: [batch_size, seqlen], restarts from 0 at each segment
+    """
+    idx = torch.arange(segments.size(1), device=segments.device).unsqueeze(0)
+    starts = torch.ones_like(segments, dtype=torch.bool)
+    starts[:, 1:] = segments[:, 1:] != segments[:, :-1]
+    start_idx = torch.where(starts, idx, torch.zeros_like(idx)).cummax(dim=1).values
+    return idx - start_idx
+
+
+def segment_mask(segments):
+    """Block diagonal mask of packed rows, a position can only see positions of the same segment
+
+    Args:
+        segments (torch.tensor): [batch_size, seqlen], the segment id of every position
+
+    Returns:
+        torch.tensor: [batch_size, 1, seqlen, seqlen] bool mask
+    """
+    return (segments.unsqueeze(-1) == segments.unsqueeze(-2)).unsqueeze(1)
@@ -1,11 +1,12 @@
 import pandas as pd
-from .utils import sta_infos, write_txt, format_list2str, change2timestamp, replace_text
+from .utils import sta_infos, write_data, format_list2str, change2timestamp, replace_text
+from .utils import ChunkStats, UserPartitions, index_chunks
 import json
 
 KEYS = ["stu_id", "concept_id", "que_id"]
-def read_data_from_csv(read_file, write_file, dq2c):
-    stares = []
-    df = pd.read_csv(read_file, low_memory=False)
+
+
+def add_concepts(df, dq2c):
     # 合并知识点信息
     cs = []
     for i, row in df.iterrows():
@@ -13,21 +14,17 @@ def read_data_from_csv(read_file, write_file, dq2c):
         cid = dq2c[qid]
         cs.append(cid)
     df["concept_id"] = cs
+    return df
 
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares)
-    print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
-
-    df["index"] = range(df.shape[0])
 
+def drop_rows(df):
     df = df.dropna(subset=["stu_id", "timestamp", "que_id", "label"])
     df = df[df['label'].isin([0,1])] #filter responses
     df['label'] = df['label'].astype(int)
-    
+    return df
 
 
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares)
-    print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
-    
+def get_user_inters(df):
     ui_df = df.groupby(['stu_id'], sort=False)
 
     user_inters = []
@@ -45,8 +42,56 @@ def read_data_from_csv(read_file, write_file, dq2c):
 
         user_inters.append(
             [[str(user), str(seq_len)], seq_problems, seq_skills, seq_ans, seq_start_time, seq_response_cost])
+    return user_inters
+
+
+def read_data_from_csv(read_file, write_file, dq2c, chunksize=None, num_partitions=64):
+    """Preprocess the competition log into write_file.
+
+    Args:
+        read_file (str): the raw csv
+        write_file (str): the data.txt path or the columnar directory, see write_data
+        dq2c (dict): question -> concepts, see load_q2c
+        chunksize (int, optional): read the log in chunks of chunksize rows and partition it by student
+            on disk (see UserPartitions), the output is the same. In memory if None. Defaults to None.
+        num_partitions (int, optional): number of student partitions of the chunked mode. Defaults to 64.
+    """
+    stares = []
+
+    if chunksize is not None:
+        ori_stats, drop_stats = ChunkStats(KEYS), ChunkStats(KEYS)
+        partitions = UserPartitions(write_file + ".spill", "stu_id", num_partitions)
+        chunks = pd.read_csv(read_file, dtype={"stu_id": str}, chunksize=chunksize)
+        for df in index_chunks(chunks, "index"):
+            df = add_concepts(df, dq2c)
+            ori_stats.update(df)
+            df = drop_rows(df)
+            drop_stats.update(df)
+            partitions.add(df)
+        ins, us, qs, cs, avgins, avgcq, na = ori_stats.finish(stares)
+        print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+        ins, us, qs, cs, avgins, avgcq, na = drop_stats.finish(stares)
+        print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+        partitions.write_students(write_file, get_user_inters, "index")
+        print("\n".join(stares))
+        return
+
+    df = pd.read_csv(read_file, low_memory=False)
+    df = add_concepts(df, dq2c)
+
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares)
+    print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+
+    df["index"] = range(df.shape[0])
+
+    df = drop_rows(df)
+
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares)
+    print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+
+    user_inters = get_user_inters(df)
 
-    write_txt(write_file, user_inters)
+    write_data(write_file, user_inters)
 
     print("\n".join(stares))
 
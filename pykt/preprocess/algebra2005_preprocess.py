@@ -2,27 +2,20 @@
 # coding=utf-8
 
 import pandas as pd
-from .utils import sta_infos, write_txt, format_list2str, change2timestamp, replace_text
+from .utils import sta_infos, write_data, change2timestamps, replace_text_col, sort_user_runs
+from .utils import ChunkStats, UserPartitions, index_chunks
 
 KEYS = ["Anon Student Id", "KC(Default)", "Questions"]
 
 
-def read_data_from_csv(read_file, write_file):
-    stares = []
+def add_questions(df):
+    df["Problem Name"] = replace_text_col(df["Problem Name"])
+    df["Step Name"] = replace_text_col(df["Step Name"])
+    df["Questions"] = df["Problem Name"].str.cat(df["Step Name"], sep="----")
+    return df
 
-    df = pd.read_table(read_file, encoding="utf-8", low_memory=False)
-    df["Problem Name"] = df["Problem Name"].apply(replace_text)
-    df["Step Name"] = df["Step Name"].apply(replace_text)
-    df["Questions"] = df.apply(
-        lambda x: f"{x['Problem Name']}----{x['Step Name']}", axis=1
-    )
-
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares, "~~")
-    print(
-        f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
-    )
 
-    df["index"] = range(df.shape[0])
+def drop_rows(df):
     df = df.dropna(
         subset=[
             "Anon Student Id",
@@ -43,51 +36,88 @@ def read_data_from_csv(read_file, write_file):
             "Correct First Attempt",
         ]
     ]
-    df["KC(Default)"] = df["KC(Default)"].apply(replace_text)
+    df["KC(Default)"] = replace_text_col(df["KC(Default)"])
+    return df
 
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares, "~~")
-    print(
-        f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
-    )
 
-    data = []
-    ui_df = df.groupby(["Anon Student Id"], sort=False)
-
-    for ui in ui_df:
-        u, curdf = ui[0], ui[1]
-        curdf.loc[:, "First Transaction Time"] = curdf.loc[
-            :, "First Transaction Time"
-        ].apply(lambda t: change2timestamp(t))
-        curdf = curdf.sort_values(by=["First Transaction Time", "index"])
-        curdf["First Transaction Time"] = curdf["First Transaction Time"].astype(str)
-
-        seq_skills = [x.replace("~~", "_") for x in curdf["KC(Default)"].values]
-        seq_ans = curdf["Correct First Attempt"].values
-        seq_start_time = curdf["First Transaction Time"].values
-        seq_problems = curdf["Questions"].values
-        seq_len = len(seq_ans)
-        seq_use_time = ["NA"]
-
-        assert (
-            seq_len
-            == len(seq_problems)
-            == len(seq_skills)
-            == len(seq_ans)
-            == len(seq_start_time)
-        )
+def get_user_inters(df):
+    # one sort of all the students by (student, time, index), then one run per student
+    df["First Transaction Time"] = change2timestamps(df["First Transaction Time"])
+    df, starts, ends = sort_user_runs(df, "Anon Student Id", ["First Transaction Time", "index"])
+    users = df["Anon Student Id"].astype(str).tolist()
+    skills = df["KC(Default)"].str.replace("~~", "_", regex=False).tolist()
+    answers = df["Correct First Attempt"].astype(str).tolist()
+    start_times = df["First Transaction Time"].astype(str).tolist()
+    problems = df["Questions"].tolist()
 
+    data = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
         data.append(
             [
-                [u, str(seq_len)],
-                seq_problems,
-                seq_skills,
-                format_list2str(seq_ans),
-                seq_start_time,
-                seq_use_time,
+                [users[start], str(end - start)],
+                problems[start:end],
+                skills[start:end],
+                answers[start:end],
+                start_times[start:end],
+                ["NA"],
             ]
         )
+    return data
+
+
+def read_data_from_csv(read_file, write_file, chunksize=None, num_partitions=64):
+    """Preprocess the algebra2005 log into write_file.
+
+    Args:
+        read_file (str): the raw tsv
+        write_file (str): the data.txt path or the columnar directory, see write_data
+        chunksize (int, optional): read the log in chunks of chunksize rows and partition it by student
+            on disk (see UserPartitions), the output is the same. In memory if None. Defaults to None.
+        num_partitions (int, optional): number of student partitions of the chunked mode. Defaults to 64.
+    """
+    stares = []
+
+    if chunksize is not None:
+        ori_stats, drop_stats = ChunkStats(KEYS, "~~"), ChunkStats(KEYS, "~~")
+        partitions = UserPartitions(write_file + ".spill", "Anon Student Id", num_partitions)
+        chunks = pd.read_table(read_file, encoding="utf-8", dtype={"Anon Student Id": str}, chunksize=chunksize)
+        for df in index_chunks(chunks, "index"):
+            df = add_questions(df)
+            ori_stats.update(df)
+            df = drop_rows(df)
+            drop_stats.update(df)
+            partitions.add(df)
+        ins, us, qs, cs, avgins, avgcq, na = ori_stats.finish(stares)
+        print(
+            f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
+        )
+        ins, us, qs, cs, avgins, avgcq, na = drop_stats.finish(stares)
+        print(
+            f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
+        )
+        partitions.write_students(write_file, get_user_inters, "index")
+        print("\n".join(stares))
+        return
+
+    df = pd.read_table(read_file, encoding="utf-8", low_memory=False)
+    df = add_questions(df)
+
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares, "~~")
+    print(
+        f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
+    )
+
+    df["index"] = range(df.shape[0])
+    df = drop_rows(df)
+
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares, "~~")
+    print(
+        f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
+    )
+
+    data = get_user_inters(df)
 
-    write_txt(write_file, data)
+    write_data(write_file, data)
 
     print("\n".join(stares))
 
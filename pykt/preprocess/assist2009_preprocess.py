@@ -1,24 +1,16 @@
 # _*_ coding:utf-8 _*_
 
 import pandas as pd
-from .utils import sta_infos, write_txt, format_list2str
+from .utils import sta_infos, write_data, format_list2str, ChunkStats, UserPartitions, index_chunks
 
 KEYS = ["user_id", "skill_id", "problem_id"]
 
-def read_data_from_csv(read_file, write_file):
-    stares = []
 
-    df = pd.read_csv(read_file, encoding = 'utf-8', dtype=str)
+def drop_rows(df):
+    return df.dropna(subset=["user_id","problem_id", "skill_id", "correct", "order_id"])
 
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares)
-    print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
-    
-    df['tmp_index'] = range(len(df))
-    _df = df.dropna(subset=["user_id","problem_id", "skill_id", "correct", "order_id"])
-
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(_df, KEYS, stares)
-    print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
 
+def get_user_inters(_df):
     ui_df = _df.groupby(['user_id'], sort=False)
 
     user_inters = []
@@ -36,10 +28,53 @@ def read_data_from_csv(read_file, write_file):
 
         user_inters.append(
             [[str(user), str(seq_len)], format_list2str(seq_problems), format_list2str(seq_skills), format_list2str(seq_ans), seq_start_time, seq_response_cost])
+    return user_inters
+
+
+def read_data_from_csv(read_file, write_file, chunksize=None, num_partitions=64):
+    """Preprocess the assist2009 log into write_file.
 
-    write_txt(write_file, user_inters)
+    Args:
+        read_file (str): the raw csv
+        write_file (str): the data.txt path or the columnar directory, see write_data
+        chunksize (int, optional): read the log in chunks of chunksize rows and partition it by user
+            on disk (see UserPartitions), the output is the same. In memory if None. Defaults to None.
+        num_partitions (int, optional): number of user partitions of the chunked mode. Defaults to 64.
+    """
+    stares = []
+
+    if chunksize is not None:
+        ori_stats, drop_stats = ChunkStats(KEYS), ChunkStats(KEYS)
+        partitions = UserPartitions(write_file + ".spill", "user_id", num_partitions)
+        chunks = pd.read_csv(read_file, encoding = 'utf-8', dtype=str, chunksize=chunksize)
+        for df in index_chunks(chunks, "tmp_index"):
+            ori_stats.update(df)
+            _df = drop_rows(df)
+            drop_stats.update(_df)
+            partitions.add(_df)
+        ins, us, qs, cs, avgins, avgcq, na = ori_stats.finish(stares)
+        print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+        ins, us, qs, cs, avgins, avgcq, na = drop_stats.finish(stares)
+        print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+        partitions.write_students(write_file, get_user_inters, "tmp_index")
+        print("\n".join(stares))
+        return
+
+    df = pd.read_csv(read_file, encoding = 'utf-8', dtype=str)
+
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares)
+    print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+
+    df['tmp_index'] = range(len(df))
+    _df = drop_rows(df)
+
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos(_df, KEYS, stares)
+    print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+
+    user_inters = get_user_inters(_df)
+
+    write_data(write_file, user_inters)
 
     print("\n".join(stares))
 
     return
-
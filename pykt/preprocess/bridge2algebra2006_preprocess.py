@@ -3,7 +3,7 @@
 
 import pandas as pd
 import numpy as np
-from .utils import sta_infos, write_txt, format_list2str, change2timestamp, replace_text
+from .utils import sta_infos, write_data, change2timestamps, replace_text_col, sort_user_runs
 
 KEYS = ["Anon Student Id", "KC(SubSkills)", "Questions"]
 
@@ -12,9 +12,9 @@ def read_data_from_csv(read_file, write_file):
 
     df = pd.read_table(read_file, low_memory=False)
     #concat problem name & step_name
-    df["Problem Name"] = df["Problem Name"].apply(replace_text)
-    df["Step Name"] = df["Step Name"].apply(replace_text)
-    df["Questions"] = df.apply(lambda x:f"{x['Problem Name']}----{x['Step Name']}",axis=1)
+    df["Problem Name"] = replace_text_col(df["Problem Name"])
+    df["Step Name"] = replace_text_col(df["Step Name"])
+    df["Questions"] = df["Problem Name"].str.cat(df["Step Name"], sep="----")
     
     ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares, '~~')
     print(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
@@ -23,30 +23,26 @@ def read_data_from_csv(read_file, write_file):
     df = df.dropna(subset=["Anon Student Id", "KC(SubSkills)", "Questions", "Correct First Attempt", "First Transaction Time"])
     #filter invalid record
     df = df[df["Correct First Attempt"].isin([0,1])]
-    df.loc[:, "First Transaction Time"] = df.loc[:, "First Transaction Time"].apply(lambda t: change2timestamp(t))
-    df["KC(SubSkills)"] = df["KC(SubSkills)"].apply(replace_text)
+    df["First Transaction Time"] = change2timestamps(df["First Transaction Time"])
+    df["KC(SubSkills)"] = replace_text_col(df["KC(SubSkills)"])
 
     ins, us, qs, cs, avgins, avgcq, na = sta_infos(df, KEYS, stares, "~~")
     print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
 
+    # one sort of all the students by (student, time, index), then one run per student
+    df, starts, ends = sort_user_runs(df, "Anon Student Id", ["First Transaction Time", "index"])
+    users = df["Anon Student Id"].astype(str).tolist()
+    problems = df["Questions"].tolist()
+    answers = df["Correct First Attempt"].astype(str).tolist()
+    start_times = df["First Transaction Time"].astype(str).tolist()
+    skills = df["KC(SubSkills)"].str.replace("~~", "_", regex=False).tolist()
+
     user_inters = []
-    for user, group in df.groupby("Anon Student Id", sort=False):
-        group = group.sort_values(by=["First Transaction Time", "index"], ascending=True)
-        group["First Transaction Time"] = group["First Transaction Time"].astype(str)
-
-        seq_problems = group["Questions"].tolist()
-        seq_ans = group["Correct First Attempt"].tolist()
-        seq_start_time = group["First Transaction Time"].tolist()
-        seq_skills = [x.replace("~~","_") for x in group["KC(SubSkills)"].tolist()]
-        seq_len = len(seq_ans)
-        seq_use_time = ["NA"]
-
-        assert seq_len == len(seq_problems) == len(seq_skills) == len(seq_ans) == len(seq_start_time)
-        
+    for start, end in zip(starts.tolist(), ends.tolist()):
         user_inters.append(
-            [[user, str(seq_len)], seq_problems, seq_skills, format_list2str(seq_ans), seq_start_time, seq_use_time])
+            [[users[start], str(end - start)], problems[start:end], skills[start:end], answers[start:end], start_times[start:end], ["NA"]])
 
-    write_txt(write_file, user_inters)
+    write_data(write_file, user_inters)
 
     print("\n".join(stares))
 
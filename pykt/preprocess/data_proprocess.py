@@ -1,11 +1,47 @@
 import os, sys
 
 
-def process_raw_data(dataset_name, dname2paths):
+# the datasets whose read_data_from_csv has the chunked mode
+CHUNKED_DATASETS = ["assist2009", "algebra2005", "peiyou"]
+
+
+def raw_data_paths(dataset_name, dname2paths, data_format="columnar"):
+    """the dataset directory and the data file process_raw_data returns, without running it"""
+    readf = dname2paths[dataset_name]
+    dname = "/".join(readf.split("/")[0:-1])
+    writef = os.path.join(dname, "data.txt" if data_format == "txt" else "data_columnar")
+    if dataset_name in ["ednet", "ednet5w", "ednet_all"]:
+        # see ednet_preprocess.read_data_from_csv
+        dname = readf.replace("/ednet/", f"/{dataset_name}")
+        writef = writef.replace("/ednet/", f"/{dataset_name}/")
+    return dname, writef
+
+
+def process_raw_data(dataset_name, dname2paths, data_format="columnar", chunksize=None, num_partitions=64, num_workers=None):
+    """Preprocess a raw dataset into the students file read by the splits.
+
+    Args:
+        dataset_name (str): the dataset
+        dname2paths (dict): dataset name -> raw file path
+        data_format (str, optional): "columnar" writes the data_columnar directory (see write_columnar), "txt" writes data.txt. Defaults to "columnar".
+        chunksize (int, optional): stream the raw log in chunks of chunksize rows and partition it by user on disk,
+            for the datasets of CHUNKED_DATASETS, see UserPartitions. In memory if None. Defaults to None.
+        num_partitions (int, optional): number of user partitions of the chunked mode. Defaults to 64.
+        num_workers (int, optional): number of processes reading the EdNet users, all cpus if None. Defaults to None.
+
+    Returns:
+        (tuple): the dataset directory and the written file
+    """
     readf = dname2paths[dataset_name]
     dname = "/".join(readf.split("/")[0:-1])
-    writef = os.path.join(dname, "data.txt")
+    writef = os.path.join(dname, "data.txt" if data_format == "txt" else "data_columnar")
     print(f"Start preprocessing data: {dataset_name}")
+    chunk_args = dict()
+    if chunksize is not None:
+        if dataset_name in CHUNKED_DATASETS:
+            chunk_args = {"chunksize": chunksize, "num_partitions": num_partitions}
+        else:
+            print(f"{dataset_name} has no chunked mode, read it in memory")
     if dataset_name == "assist2009":
         from .assist2009_preprocess import read_data_from_csv
     elif dataset_name == "assist2012":
@@ -41,15 +77,15 @@ def process_raw_data(dataset_name, dname2paths):
     elif dataset_name == "peiyou":
         fname = readf.split("/")[-1]
         dq2c = load_q2c(readf.replace(fname, "questions.json"))
-        read_data_from_csv(readf, writef, dq2c)
+        read_data_from_csv(readf, writef, dq2c, **chunk_args)
     elif dataset_name == "ednet":
-        dname, writef = read_data_from_csv(readf, writef, dataset_name=dataset_name)
+        dname, writef = read_data_from_csv(readf, writef, dataset_name=dataset_name, num_workers=num_workers)
     elif dataset_name == "ednet5w":
-        dname, writef = read_data_from_csv(readf, writef, dataset_name=dataset_name)
+        dname, writef = read_data_from_csv(readf, writef, dataset_name=dataset_name, num_workers=num_workers)
     elif dataset_name == "ednet_all":
-        dname, writef = read_data_from_csv(readf, writef, dataset_name=dataset_name)
+        dname, writef = read_data_from_csv(readf, writef, dataset_name=dataset_name, num_workers=num_workers)
     elif dataset_name != "nips_task34":  # default case
-        read_data_from_csv(readf, writef)
+        read_data_from_csv(readf, writef, **chunk_args)
     else:
         metap = os.path.join(dname, "metadata")
         read_data_from_csv(readf, metap, "task_3_4", writef)
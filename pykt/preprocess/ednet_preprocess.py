@@ -1,60 +1,94 @@
 import pandas as pd
+import numpy as np
 import random
 import os
-from .utils import sta_infos, write_txt
+from multiprocessing import Pool
+from .utils import write_data, write_df_shard, reset_shard_dir, ChunkStats
 from tqdm import tqdm
 
 KEYS = ["user_id", "tags", "question_id"]
+# the number of KT1 user ids the samples are drawn from
+NUM_USER_IDS = 840473
+# users read by one task of the pool
+CHUNK_USERS = 2000
 
+_questions = None
 
-def read_data_from_csv(read_file, write_file, dataset_name=None):
-    if not dataset_name is None:
-        write_file = write_file.replace("/ednet/", f"/{dataset_name}/")
-        write_dir = read_file.replace("/ednet/", f"/{dataset_name}")
-        print(f"write_dir is {write_dir}")
-        print(f"write_file is {write_file}")
-    stares = []
 
-    file_list = list()
+def list_user_files(read_file):
+    """List the KT1 directory once.
 
-    random.seed(2)
-    samp = [i for i in range(840473)]
-    random.shuffle(samp)
+    Args:
+        read_file (str): the ednet directory
 
-    count = 0
-
-    for unum in tqdm(samp):
-        str_unum = str(unum)
-        df_path = os.path.join(read_file, f"KT1/u{str_unum}.csv")
-        if os.path.exists(df_path):
-            df = pd.read_csv(df_path)
-            df["user_id"] = unum
-
-            file_list.append(df)
-            count = count + 1
-
-        if dataset_name == "ednet" and count == 5000:
-            start_i = 0
-            break
-        elif dataset_name == "ednet5w" and count == 50000 + 5000:
-            start_i = 5000
-            break
-        if dataset_name == "ednet_all":
-            start_i = 0
-
-    print(f"total user num: {count}")
-    all_sa = pd.concat(file_list[start_i:])
-    print(f"after sub all_sa: {len(all_sa)}")
-    all_sa["index"] = range(all_sa.shape[0])
-    ca = pd.read_csv(os.path.join(read_file, "contents", "questions.csv"))
+    Returns:
+        dict: user id -> path of KT1/u{user id}.csv
+    """
+    users = dict()
+    with os.scandir(os.path.join(read_file, "KT1")) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith("u") and name.endswith(".csv") and name[1:-4].isdigit():
+                users[int(name[1:-4])] = entry.path
+    return users
 
-    if not dataset_name is None:
-        read_file = write_dir
 
-    all_sa.to_csv(os.path.join(read_file, "ednet_sample.csv"), index=False)
+def select_users(user_files, dataset_name):
+    """The users of a sample, the same selection as walking the seeded shuffle of all ids.
+
+    ednet takes the first 5000 users in the shuffled order, ednet5w the next 50000 and ednet_all all of them.
+
+    Args:
+        user_files (dict): user id -> path, see list_user_files
+        dataset_name (str): ednet, ednet5w or ednet_all
+
+    Returns:
+        list[int]: the user ids in the shuffled order
+    """
+    random.seed(2)
+    samp = [i for i in range(NUM_USER_IDS)]
+    random.shuffle(samp)
+    users = [unum for unum in samp if unum in user_files]
+    if dataset_name == "ednet":
+        return users[:5000]
+    elif dataset_name == "ednet5w":
+        return users[5000:50000 + 5000]
+    elif dataset_name == "ednet_all":
+        return users
+    raise ValueError(f"unknown ednet sample: {dataset_name}")
+
+
+def load_questions(read_file):
+    """read contents/questions.csv, the questions without concepts are dropped"""
+    ca = pd.read_csv(os.path.join(read_file, "contents", "questions.csv"))
     ca["tags"] = ca["tags"].apply(lambda x: x.replace(";", "_"))
     ca = ca[ca["tags"] != "-1"]
-    co = all_sa.merge(ca, sort=False, how="left")
+    return ca
+
+
+def _init_worker(questions):
+    global _questions
+    _questions = questions
+
+
+def read_chunk(chunk):
+    """Read the files of a chunk of users and join the questions, runs in the pool.
+
+    Args:
+        chunk (list[tuple]): (user id, path) of every user of the chunk
+
+    Returns:
+        (tuple): the raw interactions with an "index" local to the chunk, the joined interactions
+            and the sequences of the users (see write_txt)
+    """
+    frames = []
+    for unum, path in chunk:
+        df = pd.read_csv(path)
+        df["user_id"] = unum
+        frames.append(df)
+    sa = pd.concat(frames, ignore_index=True)
+    sa["index"] = range(sa.shape[0])
+    co = sa.merge(_questions, sort=False, how="left")
     co = co.dropna(
         subset=[
             "user_id",
@@ -65,38 +99,37 @@ def read_data_from_csv(read_file, write_file, dataset_name=None):
             "user_answer",
         ]
     )
-    co["correct"] = (co["correct_answer"] == co["user_answer"]).apply(int)
+    co["correct"] = (co["correct_answer"] == co["user_answer"]).astype(int)
+    return sa, co, user_sequences(co)
 
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(co, KEYS, stares)
-    print(
-        f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
-    )
 
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(co, KEYS, stares)
-    print(
-        f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
-    )
+def user_sequences(co):
+    """Build the sequence of every user with one sort of the chunk.
 
-    co.to_csv(os.path.join(read_file, "ednet_sample_process.csv"), index=False)
+    The users keep their order of first appearance and the interactions of a user are sorted by timestamp and index.
 
-    ui_df = co.groupby(["user_id"], sort=False)
+    Args:
+        co (pd.DataFrame): the joined interactions
 
+    Returns:
+        list: the sequences in the format of write_txt
+    """
+    user_rank = pd.factorize(co["user_id"])[0]
+    order = np.lexsort((co["index"].to_numpy(), co["timestamp"].to_numpy(), user_rank))
+    co = co.iloc[order]
+    user_rank = user_rank[order]
+    bounds = np.flatnonzero(np.diff(user_rank)) + 1
+    starts, ends = np.concatenate([[0], bounds]), np.concatenate([bounds, [len(co)]])
+    cols = [co[key].astype(str).tolist() for key in ["question_id", "tags", "correct", "timestamp", "elapsed_time"]]
+    users = co["user_id"].tolist()
     user_inters = []
-    for ui in tqdm(ui_df):
-        user, tmp_inter = ui[0], ui[1]
-        tmp_inter = tmp_inter.sort_values(by=["timestamp", "index"])
-        seq_len = len(tmp_inter)
-        seq_skills = tmp_inter["tags"].astype(str)
-        seq_ans = tmp_inter["correct"].astype(str)
-        seq_problems = tmp_inter["question_id"].astype(str)
-        seq_start_time = tmp_inter["timestamp"].astype(str)
-        seq_response_cost = tmp_inter["elapsed_time"].astype(str)
-
-        assert seq_len == len(seq_problems) == len(seq_ans)
-
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if start == end:
+            continue
+        seq_problems, seq_skills, seq_ans, seq_start_time, seq_response_cost = [col[start:end] for col in cols]
         user_inters.append(
             [
-                [str(user), str(seq_len)],
+                [str(users[start]), str(end - start)],
                 seq_problems,
                 seq_skills,
                 seq_ans,
@@ -104,7 +137,85 @@ def read_data_from_csv(read_file, write_file, dataset_name=None):
                 seq_response_cost,
             ]
         )
+    return user_inters
+
+
+def read_students(chunks, ca, sample_dir, process_dir, stats, num_workers=None):
+    """Read the chunks of users in a process pool and yield their sequences in order.
+
+    The shards of every chunk are written as soon as it is read and only the distinct keys are kept
+    for the statistics, so the memory does not grow with the number of users.
+
+    Args:
+        chunks (list): the (user id, path) pairs of every chunk
+        ca (pd.DataFrame): the questions, see load_questions
+        sample_dir (str): the directory of the raw interaction shards
+        process_dir (str): the directory of the joined interaction shards
+        stats (ChunkStats): updated with the joined interactions of every chunk
+        num_workers (int, optional): number of processes, all cpus if None. Defaults to None.
+    """
+    offset = 0
+    with Pool(num_workers, initializer=_init_worker, initargs=(ca,)) as pool:
+        # imap keeps the chunks in order, the index of the rows is made global here
+        for sid, (sa, co, inters) in enumerate(tqdm(pool.imap(read_chunk, chunks), total=len(chunks))):
+            sa["index"] += offset
+            co["index"] += offset
+            offset += sa.shape[0]
+            write_df_shard(sa, sample_dir, sid)
+            write_df_shard(co, process_dir, sid)
+            stats.update(co[KEYS])
+            yield from inters
+    print(f"after sub all_sa: {offset}")
+
+
+def read_data_from_csv(read_file, write_file, dataset_name=None, num_workers=None):
+    """Sample the EdNet KT1 users, join the questions and write the sequences to write_file.
+
+    The user files are read in a process pool, chunk by chunk, and the sequences are streamed to write_file.
+    The raw and the joined interactions are written as compressed shards to the ednet_sample and
+    ednet_sample_process directories (see write_df_shard).
+
+    Args:
+        read_file (str): the ednet directory with KT1 and contents
+        write_file (str): the data.txt path or the columnar directory, see write_data
+        dataset_name (str, optional): ednet, ednet5w or ednet_all. Defaults to None.
+        num_workers (int, optional): number of processes, all cpus if None. Defaults to None.
+
+    Returns:
+        (tuple): the directory of the sample and write_file
+    """
+    if not dataset_name is None:
+        write_file = write_file.replace("/ednet/", f"/{dataset_name}/")
+        write_dir = read_file.replace("/ednet/", f"/{dataset_name}")
+        print(f"write_dir is {write_dir}")
+        print(f"write_file is {write_file}")
+    stares = []
+
+    user_files = list_user_files(read_file)
+    users = select_users(user_files, dataset_name)
+    print(f"total user num: {len(users)}")
+    chunks = [[(unum, user_files[unum]) for unum in users[i:i + CHUNK_USERS]] for i in range(0, len(users), CHUNK_USERS)]
+    ca = load_questions(read_file)
+
+    if not dataset_name is None:
+        read_file = write_dir
+    sample_dir = os.path.join(read_file, "ednet_sample")
+    process_dir = os.path.join(read_file, "ednet_sample_process")
+    reset_shard_dir(sample_dir)
+    reset_shard_dir(process_dir)
+
+    stats = ChunkStats(KEYS)
+    write_data(write_file, read_students(chunks, ca, sample_dir, process_dir, stats, num_workers))
+
+    ins, us, qs, cs, avgins, avgcq, na = stats.finish(stares)
+    print(
+        f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
+    )
+
+    ins, us, qs, cs, avgins, avgcq, na = stats.finish(stares)
+    print(
+        f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}"
+    )
 
-    write_txt(write_file, user_inters)
     print("\n".join(stares))
     return write_dir, write_file
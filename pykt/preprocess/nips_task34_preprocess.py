@@ -1,6 +1,6 @@
 import os
 import pandas as pd
-from .utils import sta_infos, write_txt, change2timestamp,format_list2str
+from .utils import sta_infos, write_data, change2timestamps, sort_user_runs
 
 
 
@@ -26,28 +26,30 @@ def load_nips_data(primary_data_path,meta_data_dir,task_name):
     print(f"len df_primary is {len(df_primary)}")
     #add timestamp
     df_answer = pd.read_csv(answer_metadata_path)
-    df_answer['answer_timestamp'] = df_answer['DateAnswered'].apply(change2timestamp)
+    df_answer['answer_timestamp'] = change2timestamps(df_answer['DateAnswered'])
     df_question = pd.read_csv(question_metadata_path)
     # df_student = pd.read_csv(student_metadata_path)
     df_subject = pd.read_csv(subject_metadata_path)
     
-    #only keep level 3
-    keep_subject_ids = set(df_subject[df_subject['Level']==3]['SubjectId'])
-    df_question['SubjectId_level3'] = df_question['SubjectId'].apply(lambda x:set(eval(x))&keep_subject_ids)
-    
-    
+    #only keep level 3, once per question: "[3, 71, 98]" -> one row per subject -> "_" joined level 3 subjects
+    keep_subject_ids = df_subject[df_subject['Level']==3]['SubjectId']
+    df_qs = df_question[["QuestionId"]].assign(SubjectId=df_question['SubjectId'].str.strip("[]").str.split(",")).explode("SubjectId")
+    df_qs = df_qs[df_qs['SubjectId'].str.strip() != ""]
+    df_qs['SubjectId'] = df_qs['SubjectId'].str.strip().astype(int)
+    df_qs = df_qs[df_qs['SubjectId'].isin(keep_subject_ids)].drop_duplicates()
+    level3 = df_qs.groupby("QuestionId", sort=False)['SubjectId'].agg(lambda x: "_".join(x.astype(str)))
+    # the questions without a level 3 subject keep an empty string
+    df_question['SubjectId_level3_str'] = df_question['QuestionId'].map(level3).fillna("")
+
     #merge data
     df_merge = df_primary.merge(df_answer[['AnswerId','answer_timestamp']],how='left')#merge answer time
-    df_merge = df_merge.merge(df_question[["QuestionId","SubjectId_level3"]],how='left')#merge question subjects
-    df_merge['SubjectId_level3_str'] = df_merge['SubjectId_level3'].apply(lambda x:"_".join([str(i) for i in x]))
+    df_merge = df_merge.merge(df_question[["QuestionId","SubjectId_level3_str"]],how='left')#merge question subjects
     print(f"len df_merge is {len(df_merge)}")
     print("Finish load data")
     print(f"Num of student {df_merge['UserId'].unique().size}")
     print(f"Num of question {df_merge['QuestionId'].unique().size}")
-    kcs =[]
-    for item in df_merge['SubjectId_level3'].values:
-        kcs.extend(item)
-    print(f"Num of knowledge {len(set(kcs))}")
+    kcs = df_qs[df_qs['QuestionId'].isin(df_merge['QuestionId'])]['SubjectId']
+    print(f"Num of knowledge {kcs.unique().size}")
     return df_merge
 
 def get_user_inters(df):
@@ -59,23 +61,22 @@ def get_user_inters(df):
     Returns:
         List: user_inters
     """
+    # one sort of all the users by (user, time, index), then one run per user
+    df, starts, ends = sort_user_runs(df, "UserId", ["answer_timestamp", "tmp_index"])
+    users = df['UserId'].astype(str).tolist()
+    skills = df['SubjectId_level3_str'].astype(str).tolist()
+    answers = df['IsCorrect'].astype(str).tolist()
+    start_times = df['answer_timestamp'].astype(str).tolist()
+    problems = df['QuestionId'].astype(str).tolist()
     user_inters = []
-    for user, group in df.groupby("UserId", sort=False):
-        group = group.sort_values(["answer_timestamp","tmp_index"], ascending=True)
-
-        seq_skills = group['SubjectId_level3_str'].tolist()
-        seq_ans = group['IsCorrect'].tolist()
-        seq_response_cost = ["NA"]
-        seq_start_time = group['answer_timestamp'].tolist()
-        seq_problems = group['QuestionId'].tolist()
-        seq_len = len(group)
+    for start, end in zip(starts.tolist(), ends.tolist()):
         user_inters.append(
-            [[str(user), str(seq_len)],
-             format_list2str(seq_problems),
-             format_list2str(seq_skills),
-             format_list2str(seq_ans),
-             format_list2str(seq_start_time),
-             format_list2str(seq_response_cost)])
+            [[users[start], str(end - start)],
+             problems[start:end],
+             skills[start:end],
+             answers[start:end],
+             start_times[start:end],
+             ["NA"]])
     return user_inters
 
 
@@ -95,5 +96,5 @@ def read_data_from_csv(primary_data_path,meta_data_dir,task_name,write_file):
     print(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
 
     user_inters = get_user_inters(df)
-    write_txt(write_file, user_inters)
+    write_data(write_file, user_inters)
     
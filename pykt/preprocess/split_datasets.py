@@ -1,9 +1,12 @@
 import os
 import sys
+import glob
+import shutil
 import pandas as pd
 import numpy as np
 import json
 import copy
+from .utils import DATA_FIELDS, parse_uid_line, is_columnar, ColumnarData, file_lock, write_atomic
 
 ALL_KEYS = [
     "fold",
@@ -24,6 +27,8 @@ ONE_KEYS = ["fold", "uid"]
 
 
 def read_data(fname, min_seq_len=3, response_set=[0, 1]):
+    if is_columnar(fname):
+        return read_columnar_data(fname, min_seq_len, response_set)
     effective_keys = set()
     dres = dict()
     delstu, delnum, badr = 0, 0, 0
@@ -36,11 +41,7 @@ def read_data(fname, min_seq_len=3, response_set=[0, 1]):
             line = lines[i].strip()
             if i % 6 == 0:  # stuid
                 effective_keys.add("uid")
-                tmps = line.split(",")
-                if "(" in tmps[0]:
-                    stuid, seq_len = tmps[0].replace("(", ""), int(tmps[2])
-                else:
-                    stuid, seq_len = tmps[0], int(tmps[1])
+                stuid, seq_len = parse_uid_line(line)
                 if seq_len < min_seq_len:  # delete use seq len less than min_seq_len
                     i += 6
                     dcur = dict()
@@ -112,6 +113,62 @@ def read_data(fname, min_seq_len=3, response_set=[0, 1]):
     return df, effective_keys
 
 
+def parse_responses(line, response_set):
+    """return the responses of a line as ints, None if one of them is not in response_set"""
+    rs = []
+    for r in line.split(","):
+        try:
+            r = int(r)
+        except:
+            return None
+        if r not in response_set:
+            return None
+        rs.append(r)
+    return rs
+
+
+def read_columnar_data(fname, min_seq_len=3, response_set=[0, 1]):
+    """read_data for a directory written by write_columnar, the same students and columns as from data.txt.
+
+    The lines are sliced from the memory-mapped columns, only the responses are split to be checked.
+    """
+    data = ColumnarData(fname)
+    str_responses = set([str(r) for r in response_set])
+    keep = np.flatnonzero(data.seq_lens >= min_seq_len)
+    delstu, delnum = len(data) - len(keep), int(data.seq_lens.sum() - data.seq_lens[keep].sum())
+    dres = {key: [] for key in DATA_FIELDS}
+    kept, badr = [], 0
+    for i in keep.tolist():
+        line = data.get("responses", i)
+        if line.find("NA") == -1:
+            if not set(line.split(",")) <= str_responses:
+                # the slow path also accepts e.g. "01"
+                rs = parse_responses(line, response_set)
+                if rs is None:
+                    print(f"error response in line: {i * 6 + 3}")
+                    badr += 1
+                    continue
+                line = ",".join([str(r) for r in rs])
+        else:
+            line = ""
+        dres["responses"].append(line)
+        kept.append(i)
+    effective_keys = {"uid", "responses"}
+    dres["uid"] = [data.get("uid", i) for i in kept]
+    for key in ["questions", "concepts", "timestamps", "usetimes"]:
+        lines = [data.get(key, i) for i in kept]
+        has_na = [line.find("NA") != -1 for line in lines]
+        if not all(has_na):
+            effective_keys.add(key)
+            dres[key] = ["" if na else line for line, na in zip(lines, has_na)]
+    goodnum = int(data.seq_lens[keep].sum())
+    df = pd.DataFrame({key: dres[key] for key in DATA_FIELDS if key in effective_keys})
+    print(
+        f"delete bad stu num of len: {delstu}, delete interactions: {delnum}, of r: {badr}, good num: {goodnum}"
+    )
+    return df, effective_keys
+
+
 def extend_multi_concepts(df, effective_keys):
     if "questions" not in effective_keys or "concepts" not in effective_keys:
         print("has no questions or concepts! return original.")
@@ -151,10 +208,11 @@ def extend_multi_concepts(df, effective_keys):
     return finaldf, effective_keys
 
 
-def id_mapping(df):
+def id_mapping(df, dkeyid2idx=None):
     id_keys = ["questions", "concepts", "uid"]
     dres = dict()
-    dkeyid2idx = dict()
+    # with an existing mapping (append mode) only the unseen ids get new indices
+    dkeyid2idx = dict() if dkeyid2idx is None else dkeyid2idx
     print(f"df.columns: {df.columns}")
     for key in df.columns:
         if key not in id_keys:
@@ -320,10 +378,10 @@ def generate_window_sequences(df, effective_keys, maxlen=200, pad_val=-1):
     return finaldf
 
 
-def get_inter_qidx(df):
-    """add global id for each interaction"""
+def get_inter_qidx(df, bias=0):
+    """add global id for each interaction, starting from bias"""
     qidx_ids = []
-    bias = 0
+    start = bias
     inter_num = 0
     for _, row in df.iterrows():
         ids_list = [str(x + bias) for x in range(len(row["responses"].split(",")))]
@@ -331,7 +389,7 @@ def get_inter_qidx(df):
         ids = ",".join(ids_list)
         qidx_ids.append(ids)
         bias += len(ids_list)
-    assert inter_num - 1 == int(ids_list[-1])
+    assert start + inter_num - 1 == int(ids_list[-1])
 
     return qidx_ids
 
@@ -394,15 +452,15 @@ def expand_question(dcur, global_qidx, pad_val=-1):
 
 
 def generate_question_sequences(
-    df, effective_keys, window=True, min_seq_len=3, maxlen=200, pad_val=-1
+    df, effective_keys, window=True, min_seq_len=3, maxlen=200, pad_val=-1, global_qidx=-1, rows=None
 ):
     if "questions" not in effective_keys or "concepts" not in effective_keys:
         print(f"has no questions or concepts, has no question sequences!")
         return False, None
     save_keys = list(effective_keys) + ["selectmasks", "qidxs", "rest", "orirow"]
     dres = {}  # "selectmasks": []}
-    global_qidx = -1
-    df["index"] = list(range(0, df.shape[0]))
+    # rows: the row of every sequence in test.csv (orirow), 0..n-1 if None
+    df["index"] = list(range(0, df.shape[0])) if rows is None else list(rows)
     for i, row in df.iterrows():
         dcur = save_dcur(row, effective_keys)
         dcur["orirow"] = [row["index"]] * len(dcur["responses"])
@@ -548,21 +606,22 @@ def write_config(
         dconfig["test_question_file"] = "test_question_sequences.csv"
         dconfig["test_question_window_file"] = "test_question_window_sequences.csv"
 
-    # load old config
-    with open(configf) as fin:
-        read_text = fin.read()
-        if read_text.strip() == "":
-            data_config = {dataset_name: dconfig}
-        else:
-            data_config = json.loads(read_text)
-            if dataset_name in data_config:
-                data_config[dataset_name].update(dconfig)
+    # the datasets of a batch (see stages.preprocess_many) update configf concurrently
+    with file_lock(configf):
+        # load old config
+        with open(configf) as fin:
+            read_text = fin.read()
+            if read_text.strip() == "":
+                data_config = {dataset_name: dconfig}
             else:
-                data_config[dataset_name] = dconfig
+                data_config = json.loads(read_text)
+                if dataset_name in data_config:
+                    data_config[dataset_name].update(dconfig)
+                else:
+                    data_config[dataset_name] = dconfig
 
-    with open(configf, "w") as fout:
         data = json.dumps(data_config, ensure_ascii=False, indent=4)
-        fout.write(data)
+        write_atomic(configf, data)
 
 
 def calStatistics(df, stares, key):
@@ -602,27 +661,12 @@ def get_max_concepts(df):
     return max_concepts
 
 
-def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5):
-    """split main function
-
-    Args:
-        dname (str): data folder path
-        fname (str): the data file used to split, needs 6 columns, format is: (NA indicates the dataset has no corresponding info)
-            uid,seqlen: 50121,4
-            quetion ids: NA
-            concept ids: 7014,7014,7014,7014
-            responses: 0,1,1,1
-            timestamps: NA
-            cost times: NA
-        dataset_name (str): dataset name
-        configf (str): the dataconfig file path
-        min_seq_len (int, optional): the min seqlen, sequences less than this value will be filtered out. Defaults to 3.
-        maxlen (int, optional): the max seqlen. Defaults to 200.
-        kfold (int, optional): the folds num needs to split. Defaults to 5.
+def split_students(dname, fname, stares, kfold=5):
+    """The id mapping and the fold split of main: keyid2idx.json, train_valid.csv and test.csv.
 
+    Returns:
+        (tuple): the train+valid students, the test students, the effective keys and the id mapping
     """
-    stares = []
-
     total_df, effective_keys = read_data(fname)
     # cal max_concepts
     if "concepts" in effective_keys:
@@ -646,19 +690,57 @@ def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5
 
     save_id2idx(dkeyid2idx, os.path.join(dname, "keyid2idx.json"))
     effective_keys.add("fold")
+    # train test split
+    train_df, test_df = train_test_split(total_df, 0.2)
+    splitdf = KFold_split(train_df, kfold)
+    splitdf, test_df = write_students(dname, splitdf, test_df, effective_keys, stares)
+    return splitdf, test_df, effective_keys, dkeyid2idx
+
+
+def write_students(dname, splitdf, test_df, effective_keys, stares):
+    """write train_valid.csv and test.csv, the test students get the fold -1 and the global ids of their interactions
+
+    Returns:
+        (tuple): the train+valid and the test students
+    """
     config = []
     for key in ALL_KEYS:
         if key in effective_keys:
             config.append(key)
-    # train test split & generate sequences
-    train_df, test_df = train_test_split(total_df, 0.2)
-    splitdf = KFold_split(train_df, kfold)
     # TODO
     splitdf[config].to_csv(os.path.join(dname, "train_valid.csv"), index=None)
     ins, ss, qs, cs, seqnum = calStatistics(splitdf, stares, "original train+valid")
     print(
         f"train+valid original interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}"
     )
+
+    # add default fold -1 to test!
+    test_df["fold"] = [-1] * test_df.shape[0]
+    test_df["cidxs"] = get_inter_qidx(test_df)  # add index
+    test_df = test_df[config + ["cidxs"]]
+    test_df.to_csv(os.path.join(dname, "test.csv"), index=None)
+    ins, ss, qs, cs, seqnum = calStatistics(test_df, stares, "test original")
+    print(
+        f"original test interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}"
+    )
+    return splitdf, test_df
+
+
+def load_split(dname, train_file="train_valid.csv", test_file="test.csv"):
+    """Read the files written by split_students back, to generate the sequences without splitting again.
+
+    Returns:
+        (tuple): the same as split_students, the columns are strings (see read_split_csv)
+    """
+    splitdf = read_split_csv(os.path.join(dname, train_file))
+    test_df = read_split_csv(os.path.join(dname, test_file))
+    effective_keys = set(splitdf.columns)
+    dkeyid2idx = load_id2idx(os.path.join(dname, "keyid2idx.json"))
+    return splitdf, test_df, effective_keys, dkeyid2idx
+
+
+def write_split_sequences(dname, splitdf, test_df, effective_keys, stares, min_seq_len=3, maxlen=200):
+    """write train_valid_sequences.csv and test_sequences.csv, the students come from split_students or load_split"""
     split_seqs = generate_sequences(splitdf, effective_keys, min_seq_len, maxlen)
     ins, ss, qs, cs, seqnum = calStatistics(split_seqs, stares, "train+valid sequences")
     print(
@@ -667,36 +749,22 @@ def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5
     split_seqs.to_csv(os.path.join(dname, "train_valid_sequences.csv"), index=None)
     # print(f"split seqs dtypes: {split_seqs.dtypes}")
 
-    # add default fold -1 to test!
-    test_df["fold"] = [-1] * test_df.shape[0]
-    test_df["cidxs"] = get_inter_qidx(test_df)  # add index
     test_seqs = generate_sequences(
         test_df, list(effective_keys) + ["cidxs"], min_seq_len, maxlen
     )
-    ins, ss, qs, cs, seqnum = calStatistics(test_df, stares, "test original")
-    print(
-        f"original test interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}"
-    )
     ins, ss, qs, cs, seqnum = calStatistics(test_seqs, stares, "test sequences")
     print(
         f"test sequences interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}"
     )
     print("=" * 20)
+    test_seqs.to_csv(os.path.join(dname, "test_sequences.csv"), index=None)
 
+
+def write_window_sequences(dname, test_df, effective_keys, stares, maxlen=200):
+    """write test_window_sequences.csv"""
     test_window_seqs = generate_window_sequences(
         test_df, list(effective_keys) + ["cidxs"], maxlen
     )
-    flag, test_question_seqs = generate_question_sequences(
-        test_df, effective_keys, False, min_seq_len, maxlen
-    )
-    flag, test_question_window_seqs = generate_question_sequences(
-        test_df, effective_keys, True, min_seq_len, maxlen
-    )
-
-    test_df = test_df[config + ["cidxs"]]
-
-    test_df.to_csv(os.path.join(dname, "test.csv"), index=None)
-    test_seqs.to_csv(os.path.join(dname, "test_sequences.csv"), index=None)
     test_window_seqs.to_csv(
         os.path.join(dname, "test_window_sequences.csv"), index=None
     )
@@ -706,6 +774,20 @@ def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5
         f"test window interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}"
     )
 
+
+def write_question_sequences(dname, test_df, effective_keys, stares, min_seq_len=3, maxlen=200):
+    """write test_question_sequences.csv and test_question_window_sequences.csv
+
+    Returns:
+        bool: False if the dataset has no questions or no concepts, nothing is written then
+    """
+    flag, test_question_seqs = generate_question_sequences(
+        test_df.copy(), effective_keys, False, min_seq_len, maxlen
+    )
+    flag, test_question_window_seqs = generate_question_sequences(
+        test_df.copy(), effective_keys, True, min_seq_len, maxlen
+    )
+
     if flag:
         test_question_seqs.to_csv(
             os.path.join(dname, "test_question_sequences.csv"), index=None
@@ -726,6 +808,246 @@ def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5
         print(
             f"test question window interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}"
         )
+    return flag
+
+
+def load_id2idx(save_path):
+    with open(save_path) as fin:
+        return json.load(fin)
+
+
+def read_split_csv(path):
+    """read a file written by the split as strings, the unchanged rows are written back as they were"""
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def remove_file_caches(path):
+    """remove the dataset caches built from path (path + "_qlevel*" and older path + "_*.pkl"), they are rebuilt on the next load"""
+    for cache in glob.glob(glob.escape(path) + "_qlevel*") + glob.glob(glob.escape(path) + "_*.pkl"):
+        if os.path.isdir(cache):
+            shutil.rmtree(cache)
+        else:
+            os.remove(cache)
+
+
+def read_new_students(fname, dkeyid2idx, tables, min_seq_len=3):
+    """Read the new interactions for the append mode.
+
+    The rows of the students already in tables are kept whatever their length, they are appended to
+    the histories of the students. The new students need at least min_seq_len interactions like in main.
+
+    Args:
+        fname (str): the data file of the new interactions, in the format of main
+        dkeyid2idx (dict): the existing id mapping (keyid2idx.json)
+        tables (list[pd.DataFrame]): the existing train+valid and test files, see read_split_csv
+        min_seq_len (int, optional): the min seqlen of the new students. Defaults to 3.
+
+    Returns:
+        (tuple): the new interactions and their effective keys
+    """
+    new_df, effective_keys = read_data(fname, min_seq_len=1)
+    fields = [key for key in DATA_FIELDS if key != "uid"]
+    old_keys = set([key for key in fields if key in tables[0].columns])
+    new_keys = set([key for key in fields if key in effective_keys])
+    if old_keys != new_keys:
+        raise ValueError(f"the new data has the fields {sorted(new_keys)}, the existing split has {sorted(old_keys)}")
+    uids = set()
+    for table in tables:
+        uids |= set(table["uid"])
+    old_uids = set([uid for uid, idx in dkeyid2idx.get("uid", dict()).items() if str(idx) in uids])
+    is_old = new_df["uid"].isin(old_uids)
+    seq_lens = new_df["responses"].str.count(",") + 1
+    new_df = new_df[is_old | (seq_lens >= min_seq_len)].reset_index(drop=True)
+    print(f"append: {int(is_old.sum())} existing students, {int((~is_old & (seq_lens >= min_seq_len)).sum())} new students")
+    return new_df, effective_keys
+
+
+def split_new_students(new_df, tables, kfold=5):
+    """Split the mapped new interactions into the rows of existing students and the new students.
+
+    The new students are split into train+valid folds and test with the same functions as main.
+
+    Returns:
+        (tuple): the rows of the existing students, the new train+valid students and the new test students
+    """
+    uids = set()
+    for table in tables:
+        uids |= set(table["uid"])
+    is_old = new_df["uid"].isin(uids)
+    train_df, test_df = train_test_split(new_df[~is_old], 0.2)
+    splitdf = KFold_split(train_df, kfold)
+    test_df = test_df.copy()
+    test_df["fold"] = [-1] * test_df.shape[0]
+    return new_df[is_old], splitdf, test_df
+
+
+def extend_table(table, old_df, new_students, seq_keys, cidxs=False):
+    """Append the new interactions to the histories of the students of table and add the new students at the end.
+
+    The new interactions are assumed to come after the existing ones, the histories are not sorted again.
+
+    Args:
+        table (pd.DataFrame): the existing train+valid or test file, see read_split_csv
+        old_df (pd.DataFrame): the new interactions of existing students, only those of the students of table are used
+        new_students (pd.DataFrame): the new students of table with their fold
+        seq_keys (list): the sequence columns to extend
+        cidxs (bool, optional): also extend the global interaction ids of the test file, see get_inter_qidx. Defaults to False.
+
+    Returns:
+        (tuple): the new table and the uids of the students whose rows changed
+    """
+    table = table.copy()
+    rows = old_df[old_df["uid"].isin(set(table["uid"]))].copy()
+    pos = pd.Series(np.arange(len(table)), index=table["uid"].to_numpy())
+    idx = pos[rows["uid"].to_numpy()].to_numpy()
+    new_students = new_students.copy()
+    if cidxs:
+        seq_keys = seq_keys + ["cidxs"]
+        bias = max([int(i) for ids in table["cidxs"] for i in ids.split(",")] + [-1]) + 1
+        for df in [rows, new_students]:
+            if df.shape[0] > 0:
+                df["cidxs"] = get_inter_qidx(df, bias)
+                bias += int((df["responses"].str.count(",") + 1).sum())
+            else:
+                df["cidxs"] = []
+    for key in seq_keys:
+        col = table[key].to_numpy(dtype=object)
+        col[idx] = col[idx] + "," + rows[key].to_numpy(dtype=object)
+        table[key] = col
+    table = pd.concat([table, new_students[table.columns].astype(str)], ignore_index=True)
+    affected = set(rows["uid"]) | set(new_students["uid"])
+    return table, affected
+
+
+def merge_sequences(path, seqs, affected, uids):
+    """Replace the sequences of the affected students in the file path by seqs.
+
+    The sequences of the other students are kept as they were, the rows follow the order of the students in uids.
+    The dataset caches of the file are removed.
+
+    Args:
+        path (str): the sequence file
+        seqs (pd.DataFrame): the new sequences of the affected students
+        affected (set): the uids of the regenerated students
+        uids (pd.Series): the uids of the students file the sequences are generated from
+    """
+    old = read_split_csv(path)
+    merged = pd.concat([old[~old["uid"].isin(affected)], seqs[old.columns].astype(str)], ignore_index=True)
+    pos = pd.Series(np.arange(len(uids)), index=uids.to_numpy())
+    order = np.argsort(pos[merged["uid"].to_numpy()].to_numpy(), kind="stable")
+    merged.iloc[order].to_csv(path, index=None)
+    remove_file_caches(path)
+    print(f"append: regenerate {seqs.shape[0]} sequences of {len(affected)} students in {path}")
+
+
+def max_qidx(path):
+    """the largest question index of a test question sequence file"""
+    df = read_split_csv(path)
+    return max([int(i) for ids in df["qidxs"] for i in ids.split(",")] + [-1])
+
+
+def append_main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5):
+    """Append the interactions of fname to the existing split of dname, see main.
+
+    The ids keep the indices of keyid2idx.json, only unseen questions, concepts and students get new ones.
+    The new interactions of existing students extend their histories and keep their fold, the new students
+    are split like in main. Only the sequences of these students are generated again, and only the caches
+    of the rewritten files are removed.
+    """
+    stares = []
+    id2idx_path = os.path.join(dname, "keyid2idx.json")
+    dkeyid2idx = load_id2idx(id2idx_path)
+    train_valid = read_split_csv(os.path.join(dname, "train_valid.csv"))
+    test_df = read_split_csv(os.path.join(dname, "test.csv"))
+
+    new_df, effective_keys = read_new_students(fname, dkeyid2idx, [train_valid, test_df], min_seq_len)
+    if "concepts" in effective_keys:
+        dkeyid2idx["max_concepts"] = max(dkeyid2idx["max_concepts"], get_max_concepts(new_df))
+    new_df, effective_keys = extend_multi_concepts(new_df, effective_keys)
+    new_df, dkeyid2idx = id_mapping(new_df, dkeyid2idx)
+    save_id2idx(dkeyid2idx, id2idx_path)
+    effective_keys.add("fold")
+    seq_keys = [key for key in ALL_KEYS if key in effective_keys and key not in ONE_KEYS]
+
+    old_df, new_train, new_test = split_new_students(new_df, [train_valid, test_df], kfold)
+    train_valid, train_uids = extend_table(train_valid, old_df, new_train, seq_keys)
+    test_df, test_uids = extend_table(test_df, old_df, new_test, seq_keys, cidxs=True)
+
+    if len(train_uids) > 0:
+        train_valid.to_csv(os.path.join(dname, "train_valid.csv"), index=None)
+        remove_file_caches(os.path.join(dname, "train_valid.csv"))
+        split_seqs = generate_sequences(train_valid[train_valid["uid"].isin(train_uids)], effective_keys, min_seq_len, maxlen)
+        merge_sequences(os.path.join(dname, "train_valid_sequences.csv"), split_seqs, train_uids, train_valid["uid"])
+    ins, ss, qs, cs, seqnum = calStatistics(train_valid, stares, "appended train+valid")
+    print(f"train+valid original interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+
+    flag = "questions" in effective_keys and "concepts" in effective_keys
+    if len(test_uids) > 0:
+        test_df.to_csv(os.path.join(dname, "test.csv"), index=None)
+        remove_file_caches(os.path.join(dname, "test.csv"))
+        is_affected = test_df["uid"].isin(test_uids).to_numpy()
+        affected_df = test_df[is_affected].copy()
+        test_keys = list(effective_keys) + ["cidxs"]
+        test_seqs = generate_sequences(affected_df, test_keys, min_seq_len, maxlen)
+        merge_sequences(os.path.join(dname, "test_sequences.csv"), test_seqs, test_uids, test_df["uid"])
+        test_window_seqs = generate_window_sequences(affected_df, test_keys, maxlen)
+        merge_sequences(os.path.join(dname, "test_window_sequences.csv"), test_window_seqs, test_uids, test_df["uid"])
+        if flag:
+            # the regenerated questions get new indices after the existing ones, orirow is the row in test.csv
+            global_qidx = max_qidx(os.path.join(dname, "test_question_sequences.csv"))
+            rows = np.flatnonzero(is_affected)
+            for window, name in [(False, "test_question_sequences.csv"), (True, "test_question_window_sequences.csv")]:
+                _, question_seqs = generate_question_sequences(
+                    affected_df.copy(), effective_keys, window, min_seq_len, maxlen, global_qidx=global_qidx, rows=rows
+                )
+                merge_sequences(os.path.join(dname, name), question_seqs, test_uids, test_df["uid"])
+    ins, ss, qs, cs, seqnum = calStatistics(test_df, stares, "appended test")
+    print(f"original test interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+
+    write_config(
+        dataset_name=dataset_name,
+        dkeyid2idx=dkeyid2idx,
+        effective_keys=effective_keys,
+        configf=configf,
+        dpath=dname,
+        k=kfold,
+        min_seq_len=min_seq_len,
+        maxlen=maxlen,
+        flag=flag,
+    )
+
+    print("=" * 20)
+    print("\n".join(stares))
+
+
+def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5, append=False):
+    """split main function
+
+    Args:
+        dname (str): data folder path
+        fname (str): the data file used to split, needs 6 columns, format is: (NA indicates the dataset has no corresponding info)
+            uid,seqlen: 50121,4
+            quetion ids: NA
+            concept ids: 7014,7014,7014,7014
+            responses: 0,1,1,1
+            timestamps: NA
+            cost times: NA
+        dataset_name (str): dataset name
+        configf (str): the dataconfig file path
+        min_seq_len (int, optional): the min seqlen, sequences less than this value will be filtered out. Defaults to 3.
+        maxlen (int, optional): the max seqlen. Defaults to 200.
+        kfold (int, optional): the folds num needs to split. Defaults to 5.
+        append (bool, optional): append the interactions of fname to the existing split of dname
+            with the existing id mapping, see append_main. Defaults to False.
+
+    """
+    if append:
+        return append_main(dname, fname, dataset_name, configf, min_seq_len, maxlen, kfold)
+    stares = []
+    splitdf, test_df, effective_keys, dkeyid2idx = split_students(dname, fname, stares, kfold)
+    write_split_sequences(dname, splitdf, test_df, effective_keys, stares, min_seq_len, maxlen)
+    write_window_sequences(dname, test_df, effective_keys, stares, maxlen)
+    flag = write_question_sequences(dname, test_df, effective_keys, stares, min_seq_len, maxlen)
 
     write_config(
         dataset_name=dataset_name,
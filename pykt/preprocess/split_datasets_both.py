@@ -0,0 +1,108 @@
+import os
+from .split_datasets import read_data, extend_multi_concepts, id_mapping, train_test_split, KFold_split
+from .split_datasets import calStatistics, get_max_concepts, save_id2idx, write_config
+from .split_datasets import write_students, write_split_sequences, write_window_sequences, write_question_sequences
+from .split_datasets_que import id_mapping_que, write_students_que, write_split_sequences_que, write_window_sequences_que
+from .split_datasets_que import QUE_OTHER_CONFIG
+
+
+def has_sub_ids(df, keys):
+    """whether an id of keys contains "_", id_mapping_que maps its parts and id_mapping the whole id"""
+    return any(df[key].str.contains("_", regex=False).any() for key in keys if key in df.columns)
+
+
+def split_students_both(dname, fname, stares, kfold=5):
+    """The id mapping and the fold split of both levels in one pass, see split_datasets.split_students
+    and split_datasets_que.split_students_que.
+
+    The data file is read and mapped once (id_mapping_que) and the concept level rows are the mapped rows
+    extended by extend_multi_concepts: the parts of a multi concept are mapped in the order id_mapping
+    would meet them, so the ids are the same as mapping the extended rows. Only when a question or a
+    user id contains "_" the concept level is mapped on its own. The students and the folds are drawn
+    once and shared by both levels.
+
+    Returns:
+        (tuple): (train+valid students, test students, effective keys, id mapping) of the concept level
+            and of the question level
+    """
+    total_df, effective_keys = read_data(fname)
+    # cal max_concepts
+    if "concepts" in effective_keys:
+        max_concepts = get_max_concepts(total_df)
+    else:
+        max_concepts = -1
+
+    oris, _, qs, cs, seqnum = calStatistics(total_df, stares, "original")
+    print("=" * 20)
+    print(f"original total interactions: {oris}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+
+    que_keys = set(effective_keys)
+    que_df, que_keyid2idx = id_mapping_que(total_df)
+    que_keyid2idx["max_concepts"] = max_concepts
+
+    # the keys id_mapping maps as whole ids, the concepts are split by extend_multi_concepts
+    whole_keys = ["questions", "uid"]
+    if "questions" not in effective_keys or "concepts" not in effective_keys:
+        whole_keys.append("concepts")
+    if has_sub_ids(total_df, whole_keys):
+        df, effective_keys = extend_multi_concepts(total_df, effective_keys)
+        df, dkeyid2idx = id_mapping(df)
+        dkeyid2idx["max_concepts"] = max_concepts
+    else:
+        df, effective_keys = extend_multi_concepts(que_df, effective_keys)
+        dkeyid2idx = que_keyid2idx
+
+    extends, _, qs, cs, seqnum = calStatistics(df, stares, "extend multi")
+    print("=" * 20)
+    print(f"after extend multi, total interactions: {extends}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+
+    # both levels have the same ids, the question level mapping is the one kept, as after running both mains
+    save_id2idx(que_keyid2idx, os.path.join(dname, "keyid2idx.json"))
+    effective_keys.add("fold")
+    que_keys.add("fold")
+
+    # train test split, the rows of df and que_df are the same students in the same order
+    train_df, test_df = train_test_split(que_df, 0.2)
+    que_splitdf = KFold_split(train_df, kfold)
+    splitdf = df.loc[que_splitdf.index].copy()
+    splitdf["fold"] = que_splitdf["fold"]
+
+    splitdf, ctest_df = write_students(dname, splitdf, df.loc[test_df.index].copy(), effective_keys, stares)
+    que_splitdf, test_df = write_students_que(dname, que_splitdf, test_df.copy(), que_keys, stares)
+    return (splitdf, ctest_df, effective_keys, dkeyid2idx), (que_splitdf, test_df, que_keys, que_keyid2idx)
+
+
+def main(dname, fname, dataset_name, configf, min_seq_len=3, maxlen=200, kfold=5):
+    """split main function of both levels, the same files as split_datasets.main and then
+    split_datasets_que.main with one read, id mapping and fold split (see split_students_both)
+
+    Args:
+        dname (str): data folder path
+        fname (str): the data file used to split, see split_datasets.main
+        dataset_name (str): dataset name
+        configf (str): the dataconfig file path
+        min_seq_len (int, optional): the min seqlen, sequences less than this value will be filtered out. Defaults to 3.
+        maxlen (int, optional): the max seqlen. Defaults to 200.
+        kfold (int, optional): the folds num needs to split. Defaults to 5.
+    """
+    stares = []
+    concept, question = split_students_both(dname, fname, stares, kfold)
+
+    # for concept level model
+    splitdf, test_df, effective_keys, dkeyid2idx = concept
+    write_split_sequences(dname, splitdf, test_df, effective_keys, stares, min_seq_len, maxlen)
+    write_window_sequences(dname, test_df, effective_keys, stares, maxlen)
+    flag = write_question_sequences(dname, test_df, effective_keys, stares, min_seq_len, maxlen)
+    write_config(dataset_name=dataset_name, dkeyid2idx=dkeyid2idx, effective_keys=effective_keys,
+                 configf=configf, dpath=dname, k=kfold, min_seq_len=min_seq_len, maxlen=maxlen, flag=flag)
+
+    # for question level model
+    splitdf, test_df, effective_keys, dkeyid2idx = question
+    write_split_sequences_que(dname, splitdf, test_df, effective_keys, stares, min_seq_len, maxlen)
+    write_window_sequences_que(dname, test_df, effective_keys, stares, maxlen)
+    write_config(dataset_name=dataset_name, dkeyid2idx=dkeyid2idx, effective_keys=effective_keys,
+                 configf=configf, dpath=dname, k=kfold, min_seq_len=min_seq_len, maxlen=maxlen,
+                 other_config=QUE_OTHER_CONFIG)
+
+    print("=" * 20)
+    print("\n".join(stares))
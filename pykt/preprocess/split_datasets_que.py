@@ -4,6 +4,7 @@ import numpy as np
 import json, copy
 from .split_datasets import read_data,ALL_KEYS,ONE_KEYS,extend_multi_concepts,save_dcur
 from .split_datasets import train_test_split,KFold_split,calStatistics,get_max_concepts,id_mapping,write_config
+from .split_datasets import load_id2idx,read_split_csv,remove_file_caches,read_new_students,split_new_students,extend_table,merge_sequences
 
 
 def generate_sequences(df, effective_keys, min_seq_len=3, maxlen = 200, pad_val = -1):
@@ -94,10 +95,11 @@ def save_id2idx(dkeyid2idx, save_path):
     with open(save_path, "w+") as fout:
         fout.write(json.dumps(dkeyid2idx))
     
-def id_mapping_que(df):
+def id_mapping_que(df, dkeyid2idx=None):
     id_keys = ["questions", "concepts","uid"]
     dres = dict()
-    dkeyid2idx = dict()
+    # with an existing mapping (append mode) only the unseen ids get new indices
+    dkeyid2idx = dict() if dkeyid2idx is None else dkeyid2idx
     print(f"df.columns: {df.columns}")
     for key in df.columns:
         if key not in id_keys:
@@ -121,27 +123,8 @@ def id_mapping_que(df):
     finaldf = pd.DataFrame(dres)
     return finaldf, dkeyid2idx
 
-def main(dname, fname, dataset_name, configf, min_seq_len = 3, maxlen = 200, kfold = 5):
-    """split main function
-
-    Args:
-        dname (str): data folder path
-        fname (str): the data file used to split, needs 6 columns, format is: (NA indicates the dataset has no corresponding info)
-            uid,seqlen: 50121,4
-            quetion ids: NA
-            concept ids: 7014,7014,7014,7014
-            responses: 0,1,1,1
-            timestamps: NA
-            cost times: NA
-        dataset_name (str): dataset name
-        configf (str): the dataconfig file path
-        min_seq_len (int, optional): the min seqlen, sequences less than this value will be filtered out. Defaults to 3.
-        maxlen (int, optional): the max seqlen. Defaults to 200.
-        kfold (int, optional): the folds num needs to split. Defaults to 5.
-        
-    """
-    stares = []
-
+def split_students_que(dname, fname, stares, kfold = 5):
+    """The id mapping and the fold split of main: keyid2idx.json, train_valid_quelevel.csv and test_quelevel.csv, see split_datasets.split_students"""
     total_df, effective_keys = read_data(fname)
     #cal max_concepts
     if 'concepts' in effective_keys:
@@ -160,60 +143,137 @@ def main(dname, fname, dataset_name, configf, min_seq_len = 3, maxlen = 200, kfo
     save_id2idx(dkeyid2idx, os.path.join(dname, "keyid2idx.json"))
     effective_keys.add("fold")
 
+    # train test split
+    train_df, test_df = train_test_split(total_df, 0.2)
+    splitdf = KFold_split(train_df, kfold)
+    splitdf, test_df = write_students_que(dname, splitdf, test_df, effective_keys, stares)
+    return splitdf, test_df, effective_keys, dkeyid2idx
+
+def write_students_que(dname, splitdf, test_df, effective_keys, stares):
+    """write train_valid_quelevel.csv and test_quelevel.csv, the test students get the fold -1"""
     df_save_keys = []
     for key in ALL_KEYS:
         if key in effective_keys:
             df_save_keys.append(key)
 
-    # train test split
-    train_df, test_df = train_test_split(total_df, 0.2)
-    splitdf = KFold_split(train_df, kfold)
     splitdf[df_save_keys].to_csv(os.path.join(dname, "train_valid_quelevel.csv"), index=None)
     ins, ss, qs, cs, seqnum = calStatistics(splitdf, stares, "original train+valid question level")
     print(f"train+valid original interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
 
+    # for test dataset
+    # add default fold -1 to test!
+    test_df["fold"] = [-1] * test_df.shape[0]  
+    test_df = test_df[df_save_keys]
+    test_df.to_csv(os.path.join(dname, "test_quelevel.csv"), index=None)
+    ins, ss, qs, cs, seqnum = calStatistics(test_df, stares, "test original question level")
+    print(f"original test interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+    return splitdf, test_df
+
+def write_split_sequences_que(dname, splitdf, test_df, effective_keys, stares, min_seq_len = 3, maxlen = 200):
+    """write train_valid_sequences_quelevel.csv and test_sequences_quelevel.csv"""
     # generate sequences
     split_seqs = generate_sequences(splitdf, effective_keys, min_seq_len, maxlen)
     ins, ss, qs, cs, seqnum = calStatistics(split_seqs, stares, "train+valid sequences question level")
     print(f"train+valid sequences interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
     split_seqs.to_csv(os.path.join(dname, "train_valid_sequences_quelevel.csv"), index=None)
-    # print(f"split seqs dtypes: {split_seqs.dtypes}")
-
 
-
-    # for test dataset
-    # add default fold -1 to test!
-    test_df["fold"] = [-1] * test_df.shape[0]  
     test_seqs = generate_sequences(test_df, list(effective_keys), min_seq_len, maxlen)
-    ins, ss, qs, cs, seqnum = calStatistics(test_df, stares, "test original question level")
-    print(f"original test interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
     ins, ss, qs, cs, seqnum = calStatistics(test_seqs, stares, "test sequences question level")
     print(f"test sequences interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
     print("="*20)
+    test_seqs.to_csv(os.path.join(dname, "test_sequences_quelevel.csv"), index=None)
 
+def write_window_sequences_que(dname, test_df, effective_keys, stares, maxlen = 200):
+    """write test_window_sequences_quelevel.csv"""
     test_window_seqs = generate_window_sequences(test_df, list(effective_keys), maxlen)
-
-    
-    test_df = test_df[df_save_keys]
-    test_df.to_csv(os.path.join(dname, "test_quelevel.csv"), index=None)
-    test_seqs.to_csv(os.path.join(dname, "test_sequences_quelevel.csv"), index=None)
     test_window_seqs.to_csv(os.path.join(dname, "test_window_sequences_quelevel.csv"), index=None)
 
     ins, ss, qs, cs, seqnum = calStatistics(test_window_seqs, stares, "test window question level")
     print(f"test window interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
-    
 
-    other_config = {
-        "train_valid_original_file_quelevel": "train_valid_quelevel.csv", 
-        "train_valid_file_quelevel": "train_valid_sequences_quelevel.csv",
-        "test_file_quelevel": "test_sequences_quelevel.csv",
-        "test_window_file_quelevel": "test_window_sequences_quelevel.csv",
-        "test_original_file_quelevel": "test_quelevel.csv"
-    }
-    
+QUE_OTHER_CONFIG = {
+    "train_valid_original_file_quelevel": "train_valid_quelevel.csv", 
+    "train_valid_file_quelevel": "train_valid_sequences_quelevel.csv",
+    "test_file_quelevel": "test_sequences_quelevel.csv",
+    "test_window_file_quelevel": "test_window_sequences_quelevel.csv",
+    "test_original_file_quelevel": "test_quelevel.csv"
+}
+
+def append_main(dname, fname, dataset_name, configf, min_seq_len = 3, maxlen = 200, kfold = 5):
+    """Append the interactions of fname to the existing question level split of dname, see split_datasets.append_main"""
+    stares = []
+    id2idx_path = os.path.join(dname, "keyid2idx.json")
+    dkeyid2idx = load_id2idx(id2idx_path)
+    train_valid = read_split_csv(os.path.join(dname, "train_valid_quelevel.csv"))
+    test_df = read_split_csv(os.path.join(dname, "test_quelevel.csv"))
+
+    new_df, effective_keys = read_new_students(fname, dkeyid2idx, [train_valid, test_df], min_seq_len)
+    if 'concepts' in effective_keys:
+        dkeyid2idx["max_concepts"] = max(dkeyid2idx["max_concepts"], get_max_concepts(new_df))
+    new_df, dkeyid2idx = id_mapping_que(new_df, dkeyid2idx)
+    save_id2idx(dkeyid2idx, id2idx_path)
+    effective_keys.add("fold")
+    seq_keys = [key for key in ALL_KEYS if key in effective_keys and key not in ONE_KEYS]
+
+    old_df, new_train, new_test = split_new_students(new_df, [train_valid, test_df], kfold)
+    train_valid, train_uids = extend_table(train_valid, old_df, new_train, seq_keys)
+    test_df, test_uids = extend_table(test_df, old_df, new_test, seq_keys)
+
+    if len(train_uids) > 0:
+        train_valid.to_csv(os.path.join(dname, "train_valid_quelevel.csv"), index=None)
+        remove_file_caches(os.path.join(dname, "train_valid_quelevel.csv"))
+        split_seqs = generate_sequences(train_valid[train_valid["uid"].isin(train_uids)], effective_keys, min_seq_len, maxlen)
+        merge_sequences(os.path.join(dname, "train_valid_sequences_quelevel.csv"), split_seqs, train_uids, train_valid["uid"])
+    ins, ss, qs, cs, seqnum = calStatistics(train_valid, stares, "appended train+valid question level")
+    print(f"train+valid original interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+
+    if len(test_uids) > 0:
+        test_df.to_csv(os.path.join(dname, "test_quelevel.csv"), index=None)
+        remove_file_caches(os.path.join(dname, "test_quelevel.csv"))
+        affected_df = test_df[test_df["uid"].isin(test_uids)]
+        test_seqs = generate_sequences(affected_df, list(effective_keys), min_seq_len, maxlen)
+        merge_sequences(os.path.join(dname, "test_sequences_quelevel.csv"), test_seqs, test_uids, test_df["uid"])
+        test_window_seqs = generate_window_sequences(affected_df, list(effective_keys), maxlen)
+        merge_sequences(os.path.join(dname, "test_window_sequences_quelevel.csv"), test_window_seqs, test_uids, test_df["uid"])
+    ins, ss, qs, cs, seqnum = calStatistics(test_df, stares, "appended test question level")
+    print(f"original test interactions num: {ins}, select num: {ss}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+
     write_config(dataset_name=dataset_name, dkeyid2idx=dkeyid2idx, effective_keys=effective_keys, 
-                configf=configf, dpath = dname, k=kfold,min_seq_len = min_seq_len, maxlen=maxlen,other_config=other_config)
-    
+                configf=configf, dpath = dname, k=kfold,min_seq_len = min_seq_len, maxlen=maxlen,other_config=QUE_OTHER_CONFIG)
+
     print("="*20)
     print("\n".join(stares))
 
+def main(dname, fname, dataset_name, configf, min_seq_len = 3, maxlen = 200, kfold = 5, append = False):
+    """split main function
+
+    Args:
+        dname (str): data folder path
+        fname (str): the data file used to split, needs 6 columns, format is: (NA indicates the dataset has no corresponding info)
+            uid,seqlen: 50121,4
+            quetion ids: NA
+            concept ids: 7014,7014,7014,7014
+            responses: 0,1,1,1
+            timestamps: NA
+            cost times: NA
+        dataset_name (str): dataset name
+        configf (str): the dataconfig file path
+        min_seq_len (int, optional): the min seqlen, sequences less than this value will be filtered out. Defaults to 3.
+        maxlen (int, optional): the max seqlen. Defaults to 200.
+        kfold (int, optional): the folds num needs to split. Defaults to 5.
+        append (bool, optional): append the interactions of fname to the existing split of dname
+            with the existing id mapping, see append_main. Defaults to False.
+        
+    """
+    if append:
+        return append_main(dname, fname, dataset_name, configf, min_seq_len, maxlen, kfold)
+    stares = []
+    splitdf, test_df, effective_keys, dkeyid2idx = split_students_que(dname, fname, stares, kfold)
+    write_split_sequences_que(dname, splitdf, test_df, effective_keys, stares, min_seq_len, maxlen)
+    write_window_sequences_que(dname, test_df, effective_keys, stares, maxlen)
+
+    write_config(dataset_name=dataset_name, dkeyid2idx=dkeyid2idx, effective_keys=effective_keys, 
+                configf=configf, dpath = dname, k=kfold,min_seq_len = min_seq_len, maxlen=maxlen,other_config=QUE_OTHER_CONFIG)
+    
+    print("="*20)
+    print("\n".join(stares))
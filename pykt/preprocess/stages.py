@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import sys
+import json
+import hashlib
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from .data_proprocess import process_raw_data, raw_data_paths
+from . import split_datasets as sd
+from . import split_datasets_que as sq
+from . import split_datasets_both as sb
+
+STAGE_FILE = "stages.json"
+
+
+def file_signature(path):
+    """The path, size and modification time of a file or a directory, the content is not read.
+
+    For a directory only its own entry is used, it changes when files are added or removed.
+    """
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        return [path, None, None]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+class StageGraph(object):
+    """The stages of a preprocessing, a stage runs only when its outputs are stale.
+
+    A stage has the stages it depends on, its parameters, the external files it reads and the files it writes.
+    Its fingerprint hashes its parameters, the signatures of its input files (see file_signature) and the
+    fingerprints of the stages it depends on. When a stage runs its fingerprint and the outputs it wrote are
+    recorded in dname/stages.json, it is stale when the fingerprint changed or a recorded output is missing.
+    The stages are run in the order they were added, add a stage after the stages it depends on.
+
+    Running a stage also removes the dataset caches of its outputs (see remove_file_caches), the loaders
+    build them again on the next load.
+
+    Args:
+        dname (str): the dataset directory, stages.json is written there
+    """
+    def __init__(self, dname):
+        self.dname = dname
+        self.record_path = os.path.join(dname, STAGE_FILE)
+        self.stages = dict()
+        self.fingerprints = dict()
+        self.record = dict()
+        if os.path.exists(self.record_path):
+            with open(self.record_path) as fin:
+                self.record = json.load(fin)
+
+    def add(self, name, run, deps=[], params=dict(), inputs=[], outputs=[]):
+        """Add a stage.
+
+        Args:
+            name (str): the stage name
+            run (function): run() builds the outputs
+            deps (list, optional): the names of the stages it depends on. Defaults to [].
+            params (dict, optional): the parameters, json serializable. Defaults to dict().
+            inputs (list, optional): the external files it reads. Defaults to [].
+            outputs (list, optional): the files it may write, the missing ones are not recorded. Defaults to [].
+        """
+        for dep in deps:
+            assert dep in self.stages, f"add {dep} before {name}"
+        self.stages[name] = {"run": run, "deps": deps, "params": params, "inputs": inputs, "outputs": outputs}
+
+    def fingerprint(self, name):
+        if name not in self.fingerprints:
+            stage = self.stages[name]
+            key = {
+                "name": name,
+                "params": stage["params"],
+                "inputs": [file_signature(path) for path in stage["inputs"]],
+                "deps": [self.fingerprint(dep) for dep in stage["deps"]],
+            }
+            self.fingerprints[name] = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest()
+        return self.fingerprints[name]
+
+    def stale_reason(self, name):
+        """the reason to run the stage, None if it is up to date"""
+        record = self.record.get(name)
+        if record is None:
+            return "never built"
+        if record["fingerprint"] != self.fingerprint(name):
+            return "inputs or parameters changed"
+        missing = [path for path in record["outputs"] if not os.path.exists(path)]
+        if len(missing) > 0:
+            return f"missing {', '.join(missing)}"
+        return None
+
+    def run(self, dry_run=False, force=False):
+        """Run the stale stages in order.
+
+        Args:
+            dry_run (bool, optional): only print what would be rebuilt. Defaults to False.
+            force (bool, optional): run every stage. Defaults to False.
+
+        Returns:
+            list: the names of the stages that were (or with dry_run would be) run
+        """
+        ran = []
+        for name, stage in self.stages.items():
+            reason = "forced" if force else self.stale_reason(name)
+            if reason is None:
+                print(f"[up to date] {name}")
+                continue
+            ran.append(name)
+            if dry_run:
+                print(f"[would rebuild] {name}: {reason}, outputs: {', '.join(stage['outputs'])}")
+                continue
+            print(f"[rebuild] {name}: {reason}")
+            stage["run"]()
+            for path in stage["outputs"]:
+                sd.remove_file_caches(path)
+            self.record[name] = {
+                "fingerprint": self.fingerprint(name),
+                "outputs": [os.path.abspath(path) for path in stage["outputs"] if os.path.exists(path)],
+            }
+            with open(self.record_path, "w") as fout:
+                json.dump(self.record, fout, indent=4)
+        return ran
+
+
+def raw_inputs(dataset_name, readf):
+    """the raw files read by process_raw_data for dataset_name"""
+    dname = os.path.dirname(readf)
+    if dataset_name == "nips_task34":
+        return [readf, os.path.join(dname, "metadata")]
+    elif dataset_name == "junyi2015":
+        return [readf, readf.replace("junyi_ProblemLog_original.csv", "junyi_Exercise_table.csv")]
+    elif dataset_name == "peiyou":
+        return [readf, os.path.join(dname, "questions.json")]
+    elif dataset_name in ["ednet", "ednet5w", "ednet_all"]:
+        return [os.path.join(readf, "KT1"), os.path.join(readf, "contents", "questions.csv")]
+    return [readf]
+
+
+def preprocess_stages(dataset_name, dname2paths, configf, data_format="columnar", min_seq_len=3, maxlen=200, kfold=5,
+                      chunksize=None, num_partitions=64, num_workers=None):
+    """The stage graph of examples/data_preprocess.py.
+
+    raw: the raw log -> the data file (process_raw_data). split: the id mapping and the fold split of
+    the concept and the question level, in one pass with the same folds (see split_students_both).
+    concept_sequences, concept_window_sequences, question_sequences (the test
+    question sequences of the concept level), quelevel_sequences and quelevel_window_sequences: the
+    sequence files, read from the split files. config: the entry of dataset_name in configf.
+
+    E.g. a new maxlen runs only the sequence stages and config, a new kfold also the split.
+
+    Returns:
+        StageGraph: the graph, call run() on it
+    """
+    readf = dname2paths[dataset_name]
+    dname, writef = raw_data_paths(dataset_name, dname2paths, data_format)
+    path = lambda *names: [os.path.join(dname, name) for name in names]
+    graph = StageGraph(dname)
+
+    graph.add(
+        "raw",
+        lambda: process_raw_data(dataset_name, dname2paths, data_format, chunksize, num_partitions, num_workers),
+        params={"dataset_name": dataset_name, "data_format": data_format},
+        inputs=raw_inputs(dataset_name, readf),
+        outputs=[writef],
+    )
+
+    graph.add(
+        "split",
+        lambda: sb.split_students_both(dname, writef, [], kfold),
+        deps=["raw"],
+        params={"kfold": kfold},
+        outputs=path("train_valid.csv", "test.csv", "train_valid_quelevel.csv", "test_quelevel.csv", "keyid2idx.json"),
+    )
+
+    def concept_sequences():
+        splitdf, test_df, effective_keys, _ = sd.load_split(dname)
+        sd.write_split_sequences(dname, splitdf, test_df, effective_keys, [], min_seq_len, maxlen)
+
+    def concept_window_sequences():
+        _, test_df, effective_keys, _ = sd.load_split(dname)
+        sd.write_window_sequences(dname, test_df, effective_keys, [], maxlen)
+
+    def question_sequences():
+        _, test_df, effective_keys, _ = sd.load_split(dname)
+        sd.write_question_sequences(dname, test_df, effective_keys, [], min_seq_len, maxlen)
+
+    graph.add(
+        "concept_sequences",
+        concept_sequences,
+        deps=["split"],
+        params={"min_seq_len": min_seq_len, "maxlen": maxlen},
+        outputs=path("train_valid_sequences.csv", "test_sequences.csv"),
+    )
+    graph.add(
+        "concept_window_sequences",
+        concept_window_sequences,
+        deps=["split"],
+        params={"maxlen": maxlen},
+        outputs=path("test_window_sequences.csv"),
+    )
+    graph.add(
+        "question_sequences",
+        question_sequences,
+        deps=["split"],
+        params={"min_seq_len": min_seq_len, "maxlen": maxlen},
+        outputs=path("test_question_sequences.csv", "test_question_window_sequences.csv"),
+    )
+
+    def load_split_que():
+        return sd.load_split(dname, "train_valid_quelevel.csv", "test_quelevel.csv")
+
+    def quelevel_sequences():
+        splitdf, test_df, effective_keys, _ = load_split_que()
+        sq.write_split_sequences_que(dname, splitdf, test_df, effective_keys, [], min_seq_len, maxlen)
+
+    def quelevel_window_sequences():
+        _, test_df, effective_keys, _ = load_split_que()
+        sq.write_window_sequences_que(dname, test_df, effective_keys, [], maxlen)
+
+    graph.add(
+        "quelevel_sequences",
+        quelevel_sequences,
+        deps=["split"],
+        params={"min_seq_len": min_seq_len, "maxlen": maxlen},
+        outputs=path("train_valid_sequences_quelevel.csv", "test_sequences_quelevel.csv"),
+    )
+    graph.add(
+        "quelevel_window_sequences",
+        quelevel_window_sequences,
+        deps=["split"],
+        params={"maxlen": maxlen},
+        outputs=path("test_window_sequences_quelevel.csv"),
+    )
+
+    def write_configs():
+        _, _, effective_keys, dkeyid2idx = sd.load_split(dname)
+        flag = "questions" in effective_keys and "concepts" in effective_keys
+        sd.write_config(dataset_name=dataset_name, dkeyid2idx=dkeyid2idx, effective_keys=effective_keys,
+                        configf=configf, dpath=dname, k=kfold, min_seq_len=min_seq_len, maxlen=maxlen, flag=flag)
+        _, _, effective_keys, dkeyid2idx = load_split_que()
+        sd.write_config(dataset_name=dataset_name, dkeyid2idx=dkeyid2idx, effective_keys=effective_keys,
+                        configf=configf, dpath=dname, k=kfold, min_seq_len=min_seq_len, maxlen=maxlen,
+                        other_config=sq.QUE_OTHER_CONFIG)
+
+    graph.add(
+        "config",
+        write_configs,
+        deps=["split"],
+        params={"dataset_name": dataset_name, "dpath": dname, "min_seq_len": min_seq_len, "maxlen": maxlen, "kfold": kfold},
+        outputs=[configf],
+    )
+    return graph
+
+
+@contextmanager
+def redirect_output(log_file):
+    """Send stdout and stderr to log_file at the file descriptor level, the subprocesses (e.g. the
+    ednet pool) and tqdm write there as well."""
+    os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(log_file, "w") as fout:
+        os.dup2(fout.fileno(), 1)
+        os.dup2(fout.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved:
+                os.close(fd)
+
+
+def preprocess_dataset(dataset_name, dname2paths, configf, log_file, dry_run=False, force=False, **kwargs):
+    """Run the stage graph of dataset_name (see preprocess_stages) with its output in log_file, a task of preprocess_many.
+
+    Returns:
+        list: the names of the stages that were run
+    """
+    with redirect_output(log_file):
+        try:
+            graph = preprocess_stages(dataset_name, dname2paths, configf, **kwargs)
+            return graph.run(dry_run=dry_run, force=force)
+        except Exception:
+            traceback.print_exc()
+            raise
+
+
+def preprocess_many(dataset_names, dname2paths, configf, log_dir, num_workers=None, dry_run=False, force=False, **kwargs):
+    """Preprocess several datasets in a process pool, every dataset runs its own stage graph.
+
+    The output of a dataset goes to log_dir/{dataset_name}.log. The datasets update configf under
+    a lock (see write_config). A failed dataset does not stop the others. The processes a dataset
+    may start itself (the EdNet readers) are the cpus divided by the datasets run at the same time.
+
+    Args:
+        dataset_names (list): the datasets, the repeated names are run once
+        dname2paths (dict): dataset name -> raw file path
+        configf (str): the dataconfig file path
+        log_dir (str): the directory of the logs
+        num_workers (int, optional): number of processes, all cpus if None. Defaults to None.
+        dry_run (bool, optional): only log the stages that would be rebuilt. Defaults to False.
+        force (bool, optional): run every stage. Defaults to False.
+        kwargs: the other arguments of preprocess_stages (data_format, min_seq_len, maxlen, kfold, ...)
+
+    Returns:
+        dict: the names of the datasets that failed -> their error
+    """
+    dataset_names = list(dict.fromkeys(dataset_names))
+    failed = dict()
+    # the cpus are shared by the datasets run at the same time, e.g. for the pool of ednet_preprocess
+    num_cpus = os.cpu_count() or 1
+    num_procs = max(1, num_cpus // min(num_workers or num_cpus, len(dataset_names)))
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = dict()
+        for dataset_name in dataset_names:
+            log_file = os.path.join(log_dir, f"{dataset_name}.log")
+            print(f"start {dataset_name}, log: {log_file}")
+            futures[dataset_name] = pool.submit(
+                preprocess_dataset, dataset_name, dname2paths, configf, log_file, dry_run, force,
+                num_workers=num_procs, **kwargs
+            )
+        for dataset_name, future in futures.items():
+            try:
+                ran = future.result()
+                print(f"finish {dataset_name}, stages run: {', '.join(ran) if len(ran) > 0 else 'none'}")
+            except Exception as e:
+                failed[dataset_name] = e
+                print(f"failed {dataset_name}: {e!r}, see {os.path.join(log_dir, f'{dataset_name}.log')}")
+    return failed
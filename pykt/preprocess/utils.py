@@ -1,37 +1,62 @@
+import os
+import json
+import heapq
+import hashlib
+import tempfile
+import shutil
+import numpy as np
 import pandas as pd
+from contextlib import contextmanager
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 def sta_infos(df, keys, stares, split_str="_"):
-    # keys: 0: uid , 1: concept, 2: question
-    uids = df[keys[0]].unique()
+    """Count the interactions, users, questions and concepts of df and append them to stares.
+
+    The question -> concepts sets are built with one split and explode of the concept column,
+    a question whose concept is NaN in every row has no concept.
+
+    Args:
+        df (pd.DataFrame): the interactions
+        keys (list): 0: uid , 1: concept, 2: question (optional)
+        stares (list): the statistics line is appended to it
+        split_str (str, optional): the separator of the concepts of a question. Defaults to "_".
+
+    Returns:
+        (tuple): interaction num, user num, question num, concept num, avg interactions per user,
+            avg concepts per question and the number of questions without concept ("NA" without keys[2])
+    """
+    cq = df.drop_duplicates(keys[:0:-1])[keys[:0:-1]]
+    return sta_counts(df.shape[0], df[keys[0]].unique(), cq, keys, stares, split_str)
+
+
+def sta_counts(ins, uids, cq, keys, stares, split_str="_"):
+    """sta_infos from the interaction num, the distinct users and the distinct (question, concept) pairs"""
     if len(keys) == 2:
-        cids = df[keys[1]].unique()
+        cids = cq[keys[1]].unique()
     elif len(keys) > 2:
-        qids = df[keys[2]].unique()
-        ctotal = 0
-        cq = df.drop_duplicates([keys[2], keys[1]])[[keys[2], keys[1]]]
-        cq[keys[1]] = cq[keys[1]].fillna("NANA")
-        cids, dq2c = set(), dict()
-        for i, row in cq.iterrows():
-            q = row[keys[2]]
-            ks = row[keys[1]]
-            dq2c.setdefault(q, set())
-            if ks == "NANA":
-                continue
-            for k in str(ks).split(split_str):
-                dq2c[q].add(k)
-                cids.add(k)
-        ctotal, na, qtotal = 0, 0, 0
-        for q in dq2c:
-            if len(dq2c[q]) == 0:
-                na += 1  # questions has no concept
-                continue
-            qtotal += 1
-            ctotal += len(dq2c[q])
+        qids = cq[keys[2]].unique()
+        ks = cq[keys[1]].fillna("NANA")
+        has = (ks != "NANA").to_numpy()
+        qc = pd.DataFrame({
+            "q": cq[keys[2]].to_numpy()[has],
+            "c": ks[has].astype(str).str.split(split_str, regex=False).to_numpy(),
+        }).explode("c")
+        cids = qc["c"].unique()
+        dq2n = qc.groupby("q", sort=False, dropna=False)["c"].nunique()
+        qtotal, ctotal = len(dq2n), int(dq2n.sum())
+        na = len(qids) - qtotal  # questions has no concept
 
         avgcq = round(ctotal / qtotal, 4)
-    avgins = round(df.shape[0] / len(uids), 4)
-    ins, us, qs, cs = df.shape[0], len(uids), "NA", len(cids)
+    avgins = round(ins / len(uids), 4)
+    ins, us, qs, cs = ins, len(uids), "NA", len(cids)
     avgcqf, naf = "NA", "NA"
     if len(keys) > 2:
         qs, avgcqf, naf = len(qids), avgcq, na
@@ -40,6 +65,34 @@ def sta_infos(df, keys, stares, split_str="_"):
     return ins, us, qs, cs, avgins, avgcqf, naf
 
 
+class ChunkStats(object):
+    """sta_infos over the chunks of a log, only the distinct users and (question, concept) pairs are kept.
+
+    Args:
+        keys (list): 0: uid , 1: concept, 2: question (optional)
+        split_str (str, optional): the separator of the concepts of a question. Defaults to "_".
+    """
+    def __init__(self, keys, split_str="_"):
+        self.keys = keys
+        self.split_str = split_str
+        self.ins = 0
+        self.uids, self.cq = [], []
+
+    def update(self, df):
+        self.ins += df.shape[0]
+        self.uids.append(pd.Series(df[self.keys[0]].unique()))
+        self.cq.append(df.drop_duplicates(self.keys[:0:-1])[self.keys[:0:-1]])
+        if len(self.cq) >= 16:
+            self.uids = [pd.concat(self.uids, ignore_index=True).drop_duplicates()]
+            self.cq = [pd.concat(self.cq, ignore_index=True).drop_duplicates()]
+
+    def finish(self, stares):
+        """append the statistics of all the chunks to stares and return them like sta_infos"""
+        uids = pd.concat(self.uids, ignore_index=True).unique()
+        cq = pd.concat(self.cq, ignore_index=True).drop_duplicates()
+        return sta_counts(self.ins, uids, cq, self.keys, stares, self.split_str)
+
+
 def write_txt(file, data):
     with open(file, "w") as f:
         for dd in data:
@@ -51,7 +104,275 @@ def write_txt(file, data):
                     exit(0)
 
 
-from datetime import datetime
+# the six lines of a student in data.txt, the first one is "uid,seq_len"
+DATA_FIELDS = ["uid", "questions", "concepts", "responses", "timestamps", "usetimes"]
+COLUMNAR_MANIFEST = "manifest.json"
+
+
+def parse_uid_line(line):
+    """return the uid and the sequence length of the first line of a student, like "uid,len" or "(uid,),len" """
+    tmps = line.split(",")
+    if "(" in tmps[0]:
+        return tmps[0].replace("(", ""), int(tmps[2])
+    return tmps[0], int(tmps[1])
+
+
+def write_data(file, data):
+    """Write the students to file, as data.txt if it ends with .txt, else as a columnar directory (see write_columnar)"""
+    if file.endswith(".txt"):
+        write_txt(file, data)
+    else:
+        write_columnar(file, data)
+
+
+def write_columnar(path, data):
+    """Write the students of data.txt as a columnar directory.
+
+    Every field of DATA_FIELDS is a string column: the utf8 bytes of the comma joined values of all
+    the students in {field}.bin and the int64 offsets of the students in {field}.offsets.npy, the
+    sequence lengths are in seq_len.npy. The students are streamed, so data can be a generator.
+
+    Args:
+        path (str): the output directory
+        data (iterable): the students in the format of write_txt
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    fouts = {key: open(os.path.join(tmp_path, f"{key}.bin"), "wb") for key in DATA_FIELDS}
+    sizes = {key: [0] for key in DATA_FIELDS}
+    seq_lens = []
+    try:
+        for dd in data:
+            uid, seq_len = parse_uid_line(",".join(dd[0]))
+            lines = [uid] + [",".join(d) for d in dd[1:]]
+            if len(lines) != len(DATA_FIELDS):
+                raise ValueError(f"student {uid} has {len(dd)} lines instead of {len(DATA_FIELDS)}")
+            for key, line in zip(DATA_FIELDS, lines):
+                value = line.encode("utf8")
+                fouts[key].write(value)
+                sizes[key].append(len(value))
+            seq_lens.append(seq_len)
+    finally:
+        for fout in fouts.values():
+            fout.close()
+    for key in DATA_FIELDS:
+        np.save(os.path.join(tmp_path, f"{key}.offsets.npy"), np.cumsum(sizes[key], dtype=np.int64))
+    np.save(os.path.join(tmp_path, "seq_len.npy"), np.array(seq_lens, dtype=np.int64))
+    with open(os.path.join(tmp_path, COLUMNAR_MANIFEST), "w") as fout:
+        json.dump({"version": 1, "num_students": len(seq_lens), "fields": DATA_FIELDS}, fout, indent=4)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def is_columnar(path):
+    """check whether path is a complete columnar directory written by write_columnar"""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, COLUMNAR_MANIFEST))
+
+
+class ColumnarData(object):
+    """Memory-mapped reader of a directory written by write_columnar.
+
+    Args:
+        path (str): the columnar directory
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, COLUMNAR_MANIFEST)) as fin:
+            self.manifest = json.load(fin)
+        self.seq_lens = np.load(os.path.join(path, "seq_len.npy"))
+        self.values, self.offsets = dict(), dict()
+        for key in self.manifest["fields"]:
+            fname = os.path.join(path, f"{key}.bin")
+            # np.memmap can not map an empty file
+            self.values[key] = np.memmap(fname, dtype=np.uint8, mode="r") if os.path.getsize(fname) > 0 else np.zeros(0, dtype=np.uint8)
+            self.offsets[key] = np.load(os.path.join(path, f"{key}.offsets.npy"))
+
+    def __len__(self):
+        return len(self.seq_lens)
+
+    def get(self, key, i):
+        """return the line of field key of student i"""
+        offsets = self.offsets[key]
+        return self.values[key][offsets[i]:offsets[i + 1]].tobytes().decode("utf8")
+
+
+def read_txt_students(fname):
+    """Stream the students of a data.txt file in the format of write_txt"""
+    with open(fname, "r", encoding="utf8") as fin:
+        block = []
+        for line in fin:
+            block.append(line.strip().split(","))
+            if len(block) == len(DATA_FIELDS):
+                yield block
+                block = []
+
+
+def txt_to_columnar(txt_file, path):
+    """Convert an existing data.txt into a columnar directory, see write_columnar.
+
+    Args:
+        txt_file (str): the data.txt path
+        path (str): the output directory
+    """
+    write_columnar(path, read_txt_students(txt_file))
+
+
+def write_df_shard(df, shard_dir, sid):
+    """Write one shard of a table as zstd compressed parquet, or as gzip csv without pyarrow.
+
+    Args:
+        df (pd.DataFrame): the rows of the shard
+        shard_dir (str): the directory of the shards, see reset_shard_dir
+        sid (int): the shard number, the shards are read back in this order
+
+    Returns:
+        str: the shard path
+    """
+    if pyarrow is not None:
+        path = os.path.join(shard_dir, f"part-{sid:05d}.parquet")
+        df.to_parquet(path, compression="zstd", index=False)
+    else:
+        path = os.path.join(shard_dir, f"part-{sid:05d}.csv.gz")
+        df.to_csv(path, index=False, compression="gzip")
+    return path
+
+
+def reset_shard_dir(shard_dir):
+    """create an empty shard directory, the shards of a previous run are removed"""
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path across processes, e.g. for a read-modify-write of a shared file.
+
+    The lock file is in the temporary directory, named after the absolute path, so nothing is left
+    next to path. Without fcntl (Windows) nothing is locked.
+    """
+    name = hashlib.sha1(os.path.abspath(path).encode("utf8")).hexdigest()[:16]
+    with open(os.path.join(tempfile.gettempdir(), f"pykt_{name}.lock"), "a") as flock:
+        if fcntl is not None:
+            fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+def write_atomic(path, text):
+    """write text to a temporary file and rename it to path, a reader never sees a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fout:
+        fout.write(text)
+    os.replace(tmp_path, path)
+
+
+def read_df_shards(shard_dir, columns=None):
+    """Read all the shards written by write_df_shard in order.
+
+    Args:
+        shard_dir (str): the directory of the shards
+        columns (list[str], optional): the columns to read, all if None. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the table
+    """
+    dfs = []
+    for name in sorted(os.listdir(shard_dir)):
+        path = os.path.join(shard_dir, name)
+        if name.endswith(".parquet"):
+            dfs.append(pd.read_parquet(path, columns=columns))
+        elif name.endswith(".csv.gz"):
+            dfs.append(pd.read_csv(path, usecols=columns))
+    return pd.concat(dfs, ignore_index=True)
+
+
+def index_chunks(chunks, index_key):
+    """add the row number in the whole log to every chunk of a chunked reader, like df[index_key] = range(len(df))"""
+    offset = 0
+    for chunk in chunks:
+        chunk[index_key] = range(offset, offset + chunk.shape[0])
+        offset += chunk.shape[0]
+        yield chunk
+
+
+class UserPartitions(object):
+    """Hash partition the rows of a log by user into spill files, for logs larger than memory.
+
+    The chunks of the log are added one by one, then the partitions (all the rows of a subset of the users)
+    are read and turned into students one at a time, so the memory is bounded by the size of a partition.
+    The spill files are pickles, they keep the dtypes of the chunks.
+
+    Args:
+        spill_dir (str): the directory of the spill files, removed by write_students
+        user_key (str): the user column, use the same dtype in every chunk (e.g. str) so a user always has the same hash
+        num_partitions (int, optional): number of partitions. Defaults to 64.
+    """
+    def __init__(self, spill_dir, user_key, num_partitions=64):
+        self.spill_dir = spill_dir
+        self.user_key = user_key
+        self.num_partitions = num_partitions
+        self.num_chunks = 0
+        reset_shard_dir(spill_dir)
+
+    def part_dir(self, p):
+        return os.path.join(self.spill_dir, f"part_{p:05d}")
+
+    def add(self, df):
+        """spill the rows of a chunk to the partitions of their users"""
+        parts = pd.util.hash_pandas_object(df[self.user_key], index=False).to_numpy() % self.num_partitions
+        for p in np.unique(parts).tolist():
+            os.makedirs(self.part_dir(p), exist_ok=True)
+            df[parts == p].to_pickle(os.path.join(self.part_dir(p), f"chunk_{self.num_chunks:06d}.pkl"))
+        self.num_chunks += 1
+
+    def read(self, p):
+        """the rows of partition p in the order of the log"""
+        pdir = self.part_dir(p)
+        return pd.concat([pd.read_pickle(os.path.join(pdir, name)) for name in sorted(os.listdir(pdir))], ignore_index=True)
+
+    def write_students(self, write_file, emit, index_key):
+        """Turn every partition into students and write them to write_file, see write_data.
+
+        The students are written in the order of the first row of the user in the log, i.e. the order of
+        groupby(sort=False) over the whole log. The students of a partition are spilled to a data.txt of
+        their own first and all of them are merged at the end.
+
+        Args:
+            write_file (str): the data.txt path or the columnar directory
+            emit (function): emit(df) returns the students of the rows df in the format of write_txt,
+                one per user in the order of their first row
+            index_key (str): the column with the row number in the log, see index_chunks
+        """
+        parts = []
+        for p in range(self.num_partitions):
+            if not os.path.exists(self.part_dir(p)):
+                continue
+            df = self.read(p)
+            codes = pd.factorize(df[self.user_key])[0]
+            first = df[index_key].to_numpy()[np.unique(codes, return_index=True)[1]]
+            students = emit(df)
+            assert len(first) == len(students)
+            write_txt(os.path.join(self.spill_dir, f"students_{p:05d}.txt"), students)
+            np.save(os.path.join(self.spill_dir, f"students_{p:05d}.npy"), first)
+            shutil.rmtree(self.part_dir(p))
+            parts.append(p)
+            del df, students
+        merged = heapq.merge(*[self.__read_students__(p) for p in parts], key=lambda item: item[0])
+        write_data(write_file, (student for _, student in merged))
+        shutil.rmtree(self.spill_dir)
+
+    def __read_students__(self, p):
+        """yield (first row, student) for the students of partition p"""
+        first = np.load(os.path.join(self.spill_dir, f"students_{p:05d}.npy")).tolist()
+        with open(os.path.join(self.spill_dir, f"students_{p:05d}.txt"), "r", encoding="utf8") as fin:
+            for key in first:
+                yield key, [fin.readline().rstrip("\n").split(",") for _ in DATA_FIELDS]
+
+
+from datetime import datetime, timedelta
 
 
 def change2timestamp(t, hasf=True):
@@ -62,6 +383,67 @@ def change2timestamp(t, hasf=True):
     return int(timeStamp)
 
 
+def change2timestamps(col, hasf=True):
+    """change2timestamp for a whole column with one pd.to_datetime, the values are identical.
+
+    The times are local times like in datetime.timestamp. The utc offset is looked up at the start
+    and the end of every hour, an hour with a transition inside (e.g. a 30 minutes DST shift, or one
+    not on the hour) is looked up per second.
+
+    Args:
+        col (pd.Series): the time strings
+        hasf (bool, optional): the times have fractional seconds. Defaults to True.
+
+    Returns:
+        np.ndarray: int64 timestamps in ms
+    """
+    fmt = "%Y-%m-%d %H:%M:%S.%f" if hasf else "%Y-%m-%d %H:%M:%S"
+    ns = pd.to_datetime(col, format=fmt).to_numpy().astype("datetime64[ns]").astype(np.int64)
+    sec, us = ns // 10**9, (ns // 1000) % 10**6
+    epoch = datetime(1970, 1, 1)
+    local_offset = lambda s: int((epoch + timedelta(seconds=int(s))).timestamp()) - int(s)
+    hours, inverse = np.unique(sec // 3600, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    starts = np.array([local_offset(h * 3600) for h in hours], dtype=np.int64)
+    ends = np.array([local_offset(h * 3600 + 3599) for h in hours], dtype=np.int64)
+    offsets = starts[inverse]
+    for i in np.flatnonzero(starts != ends).tolist():
+        rows = np.flatnonzero(inverse == i)
+        secs, sinv = np.unique(sec[rows], return_inverse=True)
+        offsets[rows] = np.array([local_offset(s) for s in secs], dtype=np.int64)[sinv.reshape(-1)]
+    sec = sec + offsets
+    # the same float arithmetic as datetime.timestamp() * 1000 and int()
+    return ((sec.astype(np.float64) + us / 1e6) * 1000).astype(np.int64)
+
+
+def sort_user_runs(df, user_key, sort_keys):
+    """Sort the interactions of all users at once and cut them into one run per user.
+
+    The users keep their order of first appearance (like groupby(sort=False)), the interactions
+    of a user are sorted by sort_keys.
+
+    Args:
+        df (pd.DataFrame): the interactions
+        user_key (str): the user column
+        sort_keys (list[str]): the sort columns, the last one should be unique, e.g. an index
+
+    Returns:
+        (tuple): the sorted df, the start and the end offset of the run of every user
+    """
+    user_rank = pd.factorize(df[user_key])[0]
+    order = np.lexsort([df[key].to_numpy() for key in sort_keys[::-1]] + [user_rank])
+    df = df.iloc[order]
+    bounds = np.flatnonzero(np.diff(user_rank[order])) + 1
+    starts = np.concatenate([[0], bounds]).astype(np.int64)
+    ends = np.concatenate([bounds, [len(df)]]).astype(np.int64)
+    return df, starts, ends
+
+
+def replace_text_col(col):
+    """replace_text for a whole column"""
+    return col.str.replace("_", "####", regex=False).str.replace(",", "@@@@", regex=False)
+
+
 def replace_text(text):
     text = text.replace("_", "####").replace(",", "@@@@")
     return text